@@ -0,0 +1,317 @@
+#!/bin/python3
+# Benchmarks for the host side of the streaming path
+#
+# For each canvas size, every sender code path is timed stage by stage
+# against local UDP sinks (sockets nobody reads, so only the host side is
+# measured):
+#   loop        - the old per-pixel loop with socket.htonl, one sendto per packet
+#   vectorized  - FrameEncoder, a bytes object per packet, one sendto per packet
+#   batched     - FrameEncoder straight into the packet matrix, sendmmsg per frame
+#   batched_v2  - the same with wire format v2 (packed pixels, one address per packet)
+#   batched_rgb444, batched_rgb333 - the reduced-depth packed formats
+#   batched_corrected - batched with host gamma and white balance, which cost
+#                 nothing extra since they live in the encoder's color tables
+#   signage_v2, signage_compressed - v2 with and without run/palette packets,
+#                 on a flat signage-like frame instead of noise
+# plus end-to-end frames/s through PanelSender. Walls bigger than 128x128 are
+# split across several boards (one local sink each) like a --wall config.
+#
+# Usage: ./bench.py [--iterations N] [--sizes 64x64,128x128,256x128,512x256] [--json out.json]
+import argparse
+import json
+import socket
+import sys
+import time
+import numpy as np
+
+from panel_encoder import FrameEncoder, PANEL_SIZE, MASK_BITS, OP_ADDRESSED, OP_PIXELS18, OPCODES
+from panel_geometry import WallGeometry, Board, Panel
+from panel_sender import PanelSender, parse_size
+from panel_tx import PacketTransmitter
+from wyrm_emu import decode_packet
+
+# Each board drives a 2x2 block of panels, like the 128x128 senders
+BOARD_SIZE = 2 * PANEL_SIZE
+# The loop path is slow enough that it only gets this fraction of the iterations
+LOOP_DIVISOR = 50
+
+
+def legacy_encode(cast, masks):
+    # The per-pixel loop the send_* scripts used before panel_encoder existed,
+    # kept here as the reference the vectorized encoder is checked against
+    fbuf = np.zeros((64*4), dtype='u4')
+    packets = []
+    segments_x = cast.shape[1] // 64
+    for i in range(len(masks)):
+        for y in range(64):
+            for x in range(64):
+                addr = ((y & 0x3F) << 6) | (x & 0x3F)
+
+                adj_y = y + 64 * (i // segments_x)
+                adj_x = x + 64 * (i % segments_x)
+                r = cast[adj_y][adj_x][2].item()
+                g = cast[adj_y][adj_x][0].item()
+                b = cast[adj_y][adj_x][1].item()
+
+                fbuf[x+(64*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
+                                                               | (((int(g))&0xFC) << 4)
+                                                               | (((int(b))&0xFC) >> 2))
+            if (y % 4) == 3:
+                tosend = bytearray()
+                tosend.append(masks[i])
+                tosend.append(0)
+                tosend.extend(fbuf.tobytes())
+                packets.append(bytes(tosend))
+    return packets
+
+
+def vectorized_encode(encoder, cast, masks):
+    encoder.encode(cast)
+    return [bytes(pkt) for _, pkt in encoder.packets_iter(masks)]
+
+
+def time_it(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def wall_for(width, height, ports):
+    """One board per 128x128 block (or one board for anything smaller),
+    each sending to its own local port."""
+    if width <= BOARD_SIZE and height <= BOARD_SIZE:
+        return WallGeometry.grid(width, height, "127.0.0.1", ports[0])
+    boards = []
+    for by in range(0, height, BOARD_SIZE):
+        for bx in range(0, width, BOARD_SIZE):
+            panels = [Panel(i, bx + x, by + y)
+                      for i, (y, x) in enumerate((y, x) for y in (0, PANEL_SIZE)
+                                                 for x in (0, PANEL_SIZE))]
+            boards.append(Board("127.0.0.1", ports[len(boards)], panels))
+    return WallGeometry(width, height, boards)
+
+
+def signage_frame(width, height):
+    """A flat background with a few solid bars and a band of text-like
+    strokes in three colors - the kind of thing we mostly show."""
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[...] = (16, 24, 96)
+    frame[height // 8:height // 4, width // 16:-width // 16] = (255, 255, 255)
+    band = frame[height // 2:height // 2 + 16]
+    strokes = (np.arange(width) // 3) % 3
+    band[::2, strokes == 0] = (255, 200, 0)
+    band[1::2, strokes == 1] = (200, 0, 0)
+    frame[-height // 8:] = (0, 0, 0)
+    return frame
+
+
+def same_pixels(a, b):
+    """Whether two encoders' current packets decode to the same writes."""
+    def writes(encoder):
+        out = {}
+        for seg, pkt in encoder.packets_iter():
+            mask, addr, fields = decode_packet(bytes(pkt))
+            out.setdefault(seg, []).append(np.stack((addr,) + tuple(fields)))
+        return {seg: np.concatenate(w, axis=1) for seg, w in out.items()}
+    wa, wb = writes(a), writes(b)
+    return wa.keys() == wb.keys() and all(np.array_equal(wa[k], wb[k]) for k in wa)
+
+
+class Sinks:
+    """Local UDP sockets that stand in for the boards."""
+
+    def __init__(self, count):
+        self.socks = []
+        for _ in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind(("127.0.0.1", 0))
+            self.socks.append(s)
+        self.ports = [s.getsockname()[1] for s in self.socks]
+
+    def close(self):
+        for s in self.socks:
+            s.close()
+
+
+def bench_size(width, height, iterations, with_loop=True):
+    n_boards = max(1, (width // BOARD_SIZE) * (height // BOARD_SIZE))
+    sinks = Sinks(n_boards)
+    geometry = wall_for(width, height, sinks.ports)
+    rng = np.random.default_rng(0)
+    cast = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def make_encoder(opcode=OP_ADDRESSED, compress=False, **kwargs):
+        # A single board uses the plain tiled path, like the scripts without --wall
+        if n_boards == 1:
+            encoder = FrameEncoder(width, height, opcode=opcode, compress=compress, **kwargs)
+        else:
+            encoder = geometry.encoder(opcode=opcode, compress=compress, **kwargs)
+        encoder.set_masks(geometry.masks())
+        return encoder
+
+    encoder = make_encoder()
+    results = []
+
+    def record(path, encode, build, send, iters, enc=encoder):
+        frame = encode + build + send
+        matrix = enc.packet_matrix()
+        results.append({
+            "size": "%dx%d" % (width, height),
+            "boards": n_boards,
+            "packets_per_frame": matrix.shape[0],
+            "bytes_per_frame": int(matrix.size if enc.lengths is None else enc.lengths.sum()),
+            "path": path,
+            "iterations": iters,
+            "encode_ms": encode * 1e3,
+            "build_ms": build * 1e3,
+            "send_ms": send * 1e3,
+            "frame_ms": frame * 1e3,
+            "fps": 1.0 / frame if frame else None,
+        })
+
+    # One plain socket per board for the unbatched paths
+    plain = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in sinks.ports]
+    board_of_packet = np.repeat(np.arange(n_boards),
+                                [len(b.panels) * encoder.packets_per_segment
+                                 for b in geometry.boards])
+    addrs = [("127.0.0.1", port) for port in sinks.ports]
+
+    def board_txs(enc):
+        per_board = np.cumsum([0] + [len(b.panels) * enc.packets_per_segment
+                                     for b in geometry.boards])
+        return [PacketTransmitter(s, enc.packet_matrix()[per_board[i]:per_board[i + 1]])
+                for i, s in enumerate(plain)]
+
+    def sendto_all(packets):
+        for board, pkt in zip(board_of_packet, packets):
+            plain[board].sendto(pkt, addrs[board])
+
+    # More panels than one header mask has bits must be refused up front
+    # rather than overflow in set_masks()
+    if (width // PANEL_SIZE) * (height // PANEL_SIZE) > MASK_BITS:
+        try:
+            FrameEncoder(width, height)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("plain grid encoder accepted %dx%d" % (width, height))
+
+    # The loop only knows the plain grid, so only compare it on one board
+    if with_loop and n_boards == 1:
+        masks = geometry.masks()
+        if legacy_encode(cast, masks) != vectorized_encode(encoder, cast, masks):
+            raise AssertionError("vectorized encoder disagrees with the legacy loop at %dx%d"
+                                 % (width, height))
+        loop_iters = max(1, iterations // LOOP_DIVISOR)
+        packets = legacy_encode(cast, masks)
+        record("loop",
+               time_it(lambda: legacy_encode(cast, masks), loop_iters), 0.0,
+               time_it(lambda: sendto_all(packets), loop_iters), loop_iters)
+
+    encode = time_it(lambda: encoder.encode(cast), iterations)
+    build = time_it(lambda: [bytes(pkt) for _, pkt in encoder.packets_iter()], iterations)
+    packets = [bytes(pkt) for _, pkt in encoder.packets_iter()]
+    record("vectorized", encode, build, time_it(lambda: sendto_all(packets), iterations),
+           iterations)
+
+    for board, s in enumerate(plain):
+        s.connect(addrs[board])
+    txs = board_txs(encoder)
+    record("batched", encode, 0.0,
+           time_it(lambda: [tx.send() for tx in txs], iterations), iterations)
+
+    corrected = make_encoder(gamma=2.2, white_balance=(1.0, 0.85, 0.7))
+    corrected_txs = board_txs(corrected)
+    record("batched_corrected", time_it(lambda: corrected.encode(cast), iterations), 0.0,
+           time_it(lambda: [tx.send() for tx in corrected_txs], iterations), iterations, corrected)
+
+    # v2 has to put the same colors at the same addresses as v1
+    v2 = make_encoder(OP_PIXELS18)
+    v2.encode(cast)
+    if not same_pixels(encoder, v2):
+        raise AssertionError("wire format v2 decodes differently from v1 at %dx%d" % (width, height))
+    for name in ("v2", "rgb444", "rgb333"):
+        packed = v2 if name == "v2" else make_encoder(OPCODES[name])
+        packed_txs = board_txs(packed)
+        record("batched_" + name, time_it(lambda: packed.encode(cast), iterations), 0.0,
+               time_it(lambda: [tx.send() for tx in packed_txs], iterations), iterations, packed)
+
+    # Run/palette packets have to decode to the same pixels as plain v2
+    signage = signage_frame(width, height)
+    v2.encode(signage)
+    compressed = make_encoder(OP_PIXELS18, compress=True)
+    compressed.encode(signage)
+    if not same_pixels(v2, compressed):
+        raise AssertionError("compressed packets decode differently from v2 at %dx%d"
+                             % (width, height))
+    for name, packed in (("signage_v2", v2), ("signage_compressed", compressed)):
+        packed_txs = board_txs(packed)
+        for tx, start in zip(packed_txs, np.cumsum([0] + [len(t.rows) for t in packed_txs])):
+            if packed.lengths is not None:
+                tx.set_lengths(packed.lengths[start:start + len(tx.rows)])
+        record(name, time_it(lambda: packed.encode(signage), iterations), 0.0,
+               time_it(lambda: [tx.send() for tx in packed_txs], iterations), iterations, packed)
+
+    # End to end through the sender the scripts use
+    sender = PanelSender(make_encoder(), masks=geometry.masks(), links=geometry.links())
+    e2e = time_it(lambda: sender.send_frame(cast), iterations)
+    results.append({
+        "size": "%dx%d" % (width, height),
+        "boards": n_boards,
+        "packets_per_frame": encoder.packet_matrix().shape[0],
+        "bytes_per_frame": encoder.packet_matrix().size,
+        "path": "panel_sender",
+        "iterations": iterations,
+        "frame_ms": e2e * 1e3,
+        "fps": 1.0 / e2e,
+        "batched": sender.tx.batched,
+    })
+
+    for s in plain:
+        s.close()
+    for link in sender.links:
+        link.sock.close()
+    sinks.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the host streaming path.")
+    parser.add_argument("--iterations", default=100, type=int, help="Frames per measurement.")
+    parser.add_argument("--sizes", default="64x64,128x128,256x128,512x256",
+                        type=lambda text: [parse_size(size) for size in text.split(",")],
+                        help="Comma separated canvas sizes; anything over 128x128 "
+                             "is split over one board per 128x128.")
+    parser.add_argument("--no-loop", action="store_true", help="Skip the slow per-pixel loop.")
+    parser.add_argument("--json", default=None, help="Write the results as JSON here ('-' for stdout).")
+    args = parser.parse_args()
+
+    results = []
+    for width, height in args.sizes:
+        if width % PANEL_SIZE or height % PANEL_SIZE:
+            parser.error("%dx%d isn't a whole number of panels" % (width, height))
+        results.extend(bench_size(width, height, args.iterations, not args.no_loop))
+
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print("%-9s %6s  %-18s %8s %9s %9s %9s %9s %9s" % ("size", "boards", "path", "KiB",
+                                                        "encode ms", "build ms", "send ms",
+                                                        "frame ms", "fps"))
+    for r in results:
+        print("%-9s %6d  %-18s %8.1f %9s %9s %9s %9.3f %9.1f"
+              % (r["size"], r["boards"], r["path"], r["bytes_per_frame"] / 1024.0,
+                 "%.3f" % r["encode_ms"] if "encode_ms" in r else "-",
+                 "%.3f" % r["build_ms"] if "build_ms" in r else "-",
+                 "%.3f" % r["send_ms"] if "send_ms" in r else "-",
+                 r["frame_ms"], r["fps"]))
+
+
+if __name__ == "__main__":
+    main()
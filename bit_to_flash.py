@@ -1,44 +1,45 @@
 #!/usr/bin/env python3
 
+import argparse
+import io
+import os
 import sys
-import textwrap
 
 # Very basic bitstream to SVF converter, tested with the ULX3S WiFi interface
+#
+# The SPI flash sees every byte LSB first, so each page goes out as its
+# header and data bit-reversed through one bytes.translate() and then
+# written backwards as a single hex string. The SVF is streamed through one
+# large write buffer instead of being built up in memory.
+#
+# Given --previous, the image last flashed to the same board, only the 64K
+# sectors that differ from it are erased and programmed. A firmware-only
+# rebuild usually changes a sector or two out of the whole bitstream.
+# flash_svf() keeps that image per named board for wyrm.py --flash.
+#
+# Every erase and page program is followed by a fixed wait long enough for
+# the slowest flash. With --poll the SVF instead reads the flash's status
+# register until its write-in-progress bit clears, in a LOOP ... ENDLOOP
+# block that gives up after the same worst-case time. LOOP is Lattice's SVF
+# extension, so --poll needs a player that implements it.
+#
+# Usage: ./bit_to_flash.py <bitstream> <svf> [--previous last_flashed.bit] [--poll]
 
 flash_page_size = 256
 erase_block_size = 64*1024
 
+# The image last flashed to each named board
+FLASH_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "wyrm", "flash")
 
-def bitreverse(x):
-    y = 0
-    for i in range(8):
-        if (x >> (7 - i)) & 1 == 1:
-            y |= (1 << i)
-    return y
+# Wrap width of the SDR lines, matching what textwrap.wrap(..., 100) gave
+LINE_WIDTH = 100
+IDCODE_CMD = bytes([0xE2, 0x00, 0x00, 0x00])
+WRITE_BUFFER = 1 << 20
 
-with open(sys.argv[1], 'rb') as bitf:
-    bs = bitf.read()
-    # Autodetect IDCODE from bitstream
-    idcode_cmd = bytes([0xE2, 0x00, 0x00, 0x00])
-    idcode = None
-    for i in range(len(bs) - 4):
-        if bs[i:i+4] == idcode_cmd:
-            idcode = bs[i+4] << 24
-            idcode |= bs[i+5] << 16
-            idcode |= bs[i+6] << 8
-            idcode |= bs[i+7]
-            break
-    if idcode is None:
-        print("Failed to find IDCODE in bitstream, check bitstream is valid")
-        sys.exit(1)
-    print("IDCODE in bitstream is 0x%08x" % idcode)
-    bitf.seek(0)
+# REVERSE[x] is x with its bits in the opposite order
+REVERSE = bytes(int("{:08b}".format(x)[::-1], 2) for x in range(256))
 
-    address = 0
-    last_page = -1
-
-    with open(sys.argv[2], 'w') as svf:
-        print("""
+HEADER = """
 STATE RESET;
 HDR	0;
 HIR	0;
@@ -47,14 +48,18 @@ TIR	0;
 ENDDR	DRPAUSE;
 ENDIR	IRPAUSE;
 STATE	IDLE;
-        """, file=svf)
-        print("""
+
+"""
+
+CHECK_IDCODE = """
 SIR	8	TDI  (E0);
 SDR	32	TDI  (00000000)
         TDO  ({:08X})
         MASK (FFFFFFFF);
-        """.format(idcode), file=svf)
-        print("""
+
+"""
+
+ENTER_SPI = """
 SIR	8	TDI  (1C);
 SDR	510	TDI  (3FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
              FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF);
@@ -108,34 +113,39 @@ SDR 16   TDI(0080);
 RUNTEST 1.00E-0 SEC;
 
 
-        """, file=svf)
-        while True:
-            if((address // 0x10000) != last_page):
-                last_page = (address // 0x10000)
-                print("""SDR	8	TDI  (60);
-                """, file=svf)
-                address_flipped = [bitreverse(x) for x in [0xd8,int(address // 0x10000),0x00,0x00]]
-                hex_address= ["{:02X}".format(x) for x in reversed(address_flipped)]
-                print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(hex_address), "".join(hex_address)), 100)), file=svf)
-                print("""RUNTEST	3.00 SEC;
-                """, file=svf)
-
-            chunk = bitf.read(flash_page_size)
-            if not chunk:
-                break
-            # Convert chunk to bit-reversed hex
-            br_chunk = [bitreverse(x) for x in bytes([0x02, int(address / 0x10000 % 0x100),int(address / 0x100 % 0x100),int(address % 0x100)]) + chunk]
-            address += len(chunk)
-            hex_chunk = ["{:02X}".format(x) for x in reversed(br_chunk)]
-            print("""
+
+"""
+
+WRITE_ENABLE = """SDR	8	TDI  (60);
+
+"""
+
+ERASE_WAIT = """RUNTEST	3.00 SEC;
+
+"""
+
+PAGE_WRITE_ENABLE = """
 SDR	8	TDI  (60);
-                """, file=svf)
-            print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(br_chunk), "".join(hex_chunk)), 100)), file=svf)
-            print("""
+
+"""
+
+PAGE_WAIT = """
 RUNTEST	2.50E-2 SEC;
-                """, file=svf)
 
-        print("""
+"""
+
+# RDSR, clocking out the status byte. Only WIP (bit 0) has to be clear.
+READ_STATUS = """SDR	16	TDI  ({})
+        TDO  ({})
+        MASK ({});
+"""
+
+# (seconds between status reads, reads) after erases and page programs -
+# as long in total as the fixed waits
+ERASE_POLL = (1.00E-2, 300)
+PAGE_POLL = (1.00E-4, 250)
+
+FOOTER = """
 // BYPASS
 SIR 8 TDI (FF);
 
@@ -147,4 +157,185 @@ STATE IDLE;
 RUNTEST 32 TCK;
 RUNTEST 2.00E-2 SEC;
 STATE RESET;
-        """, file=svf)
+
+"""
+
+
+def find_idcode(bs):
+    """The IDCODE the bitstream checks for, or None if it has none."""
+    i = bs.find(IDCODE_CMD)
+    if i < 0 or i + 8 > len(bs):
+        return None
+    return int.from_bytes(bs[i + 4:i + 8], "big")
+
+
+def spi_hex(data):
+    """data as the SDR TDI hex string that shifts it into the flash."""
+    return data.translate(REVERSE)[::-1].hex().upper()
+
+
+def sdr(bits, tdi):
+    """An SDR TDI line, wrapped at LINE_WIDTH columns."""
+    prefix = "SDR {} TDI ".format(bits)
+    word = "(" + tdi + ");"
+    if len(prefix) + len(word) <= LINE_WIDTH:
+        return prefix + word + "\n"
+    if len(word) <= LINE_WIDTH:
+        return prefix.rstrip() + "\n" + word + "\n"
+    # Too long for any line: fill the first one, then whole lines of it
+    first = LINE_WIDTH - len(prefix)
+    lines = [prefix + word[:first]]
+    lines.extend(word[i:i + LINE_WIDTH] for i in range(first, len(word), LINE_WIDTH))
+    return "\n".join(lines) + "\n"
+
+
+def wait_ready(svf, interval, tries):
+    """Read the status register until the flash is done, at most tries times."""
+    svf.write("LOOP {};\n".format(tries))
+    svf.write("RUNTEST\t{:.2E} SEC;\n".format(interval))
+    svf.write(READ_STATUS.format(spi_hex(bytes([0x05, 0x00])), spi_hex(bytes([0x00, 0x00])),
+                                 spi_hex(bytes([0x00, 0x01]))))
+    svf.write("ENDLOOP;\n\n")
+
+
+def erase_block(svf, block, poll=False):
+    """Erase the 64K block number block."""
+    svf.write(WRITE_ENABLE)
+    svf.write(sdr(32, spi_hex(bytes([0xd8, block & 0xFF, 0x00, 0x00]))))
+    if poll:
+        wait_ready(svf, *ERASE_POLL)
+    else:
+        svf.write(ERASE_WAIT)
+
+
+def write_page(svf, address, data, poll=False):
+    """Program up to a page of data at address."""
+    header = bytes([0x02, (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF])
+    svf.write(PAGE_WRITE_ENABLE)
+    svf.write(sdr(8 * (len(header) + len(data)), spi_hex(header + data)))
+    if poll:
+        svf.write("\n")
+        wait_ready(svf, *PAGE_POLL)
+    else:
+        svf.write(PAGE_WAIT)
+
+
+def sector_count(bs):
+    return (len(bs) + erase_block_size - 1) // erase_block_size
+
+
+def changed_sectors(bs, previous):
+    """The 64K sectors of bs whose contents differ from previous, the image
+    already in the flash. Anything past the end of previous counts as changed."""
+    bs, previous = memoryview(bs), memoryview(previous)
+    return [block for block in range(sector_count(bs))
+            if bs[block * erase_block_size:(block + 1) * erase_block_size]
+            != previous[block * erase_block_size:(block + 1) * erase_block_size]]
+
+
+def write_svf(bs, svf, idcode, sectors=None, poll=False):
+    """Write the SVF that flashes bitstream bs to the text stream svf.
+
+    sectors, if given, lists the only 64K sectors to erase and program.
+    poll waits on the flash's status register instead of fixed delays.
+    """
+    svf.write(HEADER)
+    svf.write(CHECK_IDCODE.format(idcode))
+    svf.write(ENTER_SPI)
+
+    data = memoryview(bs)
+    for block in range(sector_count(bs)) if sectors is None else sectors:
+        erase_block(svf, block, poll)
+        start = block * erase_block_size
+        for address in range(start, min(start + erase_block_size, len(bs)), flash_page_size):
+            write_page(svf, address, bytes(data[address:address + flash_page_size]), poll)
+
+    svf.write(FOOTER)
+
+
+def bit_to_svf(bs, previous=None, poll=False):
+    """The SVF for bitstream bs as a string, only touching the sectors that
+    differ from previous if that is given."""
+    idcode = find_idcode(bs)
+    if idcode is None:
+        raise ValueError("no IDCODE in bitstream")
+    out = io.StringIO()
+    write_svf(bs, out, idcode, None if previous is None else changed_sectors(bs, previous), poll)
+    return out.getvalue()
+
+
+def flash_svf(bitstream, svf, load, board=None, full=False, cache_dir=FLASH_CACHE_DIR, poll=False):
+    """Write the SVF that flashes the bitstream file to svf, then load(svf).
+
+    For a named board, only the sectors that changed since the image last
+    flashed to it (kept in cache_dir) are written, unless full is set, and
+    the image is remembered once load returns. Boards without a name always
+    get every sector, since there is no telling what they hold. Returns the
+    sectors written, or None for all of them.
+    """
+    # Never leave an older SVF where load would find it if this one fails
+    if os.path.exists(svf):
+        os.remove(svf)
+    with open(bitstream, 'rb') as f:
+        bs = f.read()
+    idcode = find_idcode(bs)
+    if idcode is None:
+        raise ValueError("no IDCODE in {}".format(bitstream))
+
+    cached = None if board is None else os.path.join(cache_dir, board + ".bit")
+    sectors = None
+    if cached is not None and not full and os.path.exists(cached):
+        with open(cached, 'rb') as f:
+            sectors = changed_sectors(bs, f.read())
+
+    with open(svf + ".tmp", 'w', buffering=WRITE_BUFFER) as f:
+        write_svf(bs, f, idcode, sectors, poll)
+    os.replace(svf + ".tmp", svf)
+
+    if cached is None:
+        load(svf)
+        return sectors
+    # A load that fails partway leaves the flash holding neither image, so
+    # forget the old one until the new one is known to be there
+    if os.path.exists(cached):
+        os.remove(cached)
+    load(svf)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cached + ".tmp", 'wb') as f:
+        f.write(bs)
+    os.replace(cached + ".tmp", cached)
+    return sectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an ECP5 bitstream to an SVF that writes it to the SPI flash.")
+    parser.add_argument("bitstream", help="Bitstream to flash.")
+    parser.add_argument("svf", help="SVF file to write.")
+    parser.add_argument("--previous", default=None,
+                        help="Image last flashed to the board, only sectors that differ from it are written.")
+    parser.add_argument("--poll", action="store_true",
+                        help="Poll the flash status after each erase and page instead of waiting "
+                             "the worst case (needs an SVF player with LOOP/ENDLOOP).")
+    args = parser.parse_args()
+
+    with open(args.bitstream, 'rb') as bitf:
+        bs = bitf.read()
+    # Autodetect IDCODE from bitstream
+    idcode = find_idcode(bs)
+    if idcode is None:
+        print("Failed to find IDCODE in bitstream, check bitstream is valid")
+        sys.exit(1)
+    print("IDCODE in bitstream is 0x%08x" % idcode)
+
+    sectors = None
+    if args.previous is not None:
+        with open(args.previous, 'rb') as f:
+            sectors = changed_sectors(bs, f.read())
+        print("%d of %d sectors changed" % (len(sectors), sector_count(bs)))
+
+    with open(args.svf, 'w', buffering=WRITE_BUFFER) as svf:
+        write_svf(bs, svf, idcode, sectors, args.poll)
+
+
+if __name__ == "__main__":
+    main()
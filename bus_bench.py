@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Simulated cycles-per-pixel for getting pixels from the CPU into ledpanel
+#
+# Puts BaseSoC's LedPanelController (without the ledpanel instances) on a
+# shared Wishbone interconnect, with its en and per-port addr<i>/wdat<i> CSRs
+# behind a Wishbone2CSR bridge the way SoCCore does it, and runs it in the
+# migen simulator. A bus master then replays the stores udp_cb makes, all to
+# the same two ports:
+#   csr        - panel_write(): en = 0, then wdat<i> and addr<i> for each
+#                port, en = mask per pixel
+#   csr_fill   - panel_fill() for one run: en = 0 and each wdat<i> once,
+#                then en = 0, each addr<i>, en = mask per pixel
+#   window     - one store per pixel into the framebuffer window
+#   window_fill - the same for a run, the color never changes
+# and then writes a different pixel to each port:
+#   csr_ports  - each port's own pair, then one en write stores them all in
+#                the same cycle
+#   window_ports - one store per port, through that port's own mask
+# The first four count a pixel per address (shown on both ports), the last
+# two per port. Every write that reaches a port's write channel is checked
+# against what was meant to be written, cycle by cycle. Only bus cycles are counted: the CPU's own
+# instructions between stores come on top, and there are fewer of those for
+# fewer stores too.
+#
+# Usage: ./bus_bench.py [--pixels 256] [--clock 50e6]
+import argparse
+
+from migen import *
+
+from litex.gen import *
+from litex.soc.interconnect import csr_bus, wishbone
+
+from wyrm import LedPanelController
+
+CSR_BASE   = 0xf0000000
+PANEL_BASE = 0x90000000
+PANEL_PIXELS = 64 * 64
+N_PORTS    = 4
+
+
+class _PanelBus(LiteXModule):
+    def __init__(self):
+        self.master = wishbone.Interface(data_width=32)
+        self.panel  = LedPanelController(n_ports=N_PORTS)
+
+        # The CSRs, bridged the way SoCCore does it.
+        self.csr = csr_bus.Interface(data_width=32, address_width=14)
+        self.csr_bank = csr_bus.CSRBank(self.panel.get_csrs(),
+            address = 0,
+            bus     = self.csr,
+        )
+        self.csr_bridge = wishbone.Wishbone2CSR(bus_csr=self.csr, register=True)
+
+        self.interconnect = wishbone.InterconnectShared([self.master], [
+            (lambda a: a[26:] == CSR_BASE >> 28,   self.csr_bridge.wishbone),
+            (lambda a: a[26:] == PANEL_BASE >> 28, self.panel.fb.bus),
+        ], register=True)
+
+
+def panel_wdat(color):
+    return ((color << 4) & (0x3f << 16)) | ((color << 2) & (0x3f << 8)) | (color & 0x3f)
+
+
+def _csr(index):
+    return (CSR_BASE >> 2) + index
+
+
+# en, then addr<i>, wdat<i> for each port, in LedPanelController's order
+_EN = _csr(0)
+
+
+def _addr(port):
+    return _csr(1 + 2*port)
+
+
+def _wdat(port):
+    return _csr(2 + 2*port)
+
+
+def _window(mask, addr):
+    return (PANEL_BASE >> 2) + (mask << 16) + addr
+
+
+def _ports(mask):
+    return [i for i in range(N_PORTS) if mask & (1 << i)]
+
+
+def csr_stores(mask, pixels):
+    for addr, color in pixels:
+        yield _EN, 0
+        for i in _ports(mask):
+            yield _wdat(i), panel_wdat(color)
+            yield _addr(i), addr
+        yield _EN, mask
+
+
+def csr_fill_stores(mask, pixels):
+    yield _EN, 0
+    for i in _ports(mask):
+        yield _wdat(i), panel_wdat(pixels[0][1])
+    for addr, _ in pixels:
+        yield _EN, 0
+        for i in _ports(mask):
+            yield _addr(i), addr
+        yield _EN, mask
+
+
+def window_stores(mask, pixels):
+    for addr, color in pixels:
+        yield _window(mask, addr), color
+
+
+# The per-port paths take ({port: (addr, color)}) per step
+def csr_ports_stores(mask, steps):
+    for step in steps:
+        yield _EN, 0
+        for i, (addr, color) in sorted(step.items()):
+            yield _wdat(i), panel_wdat(color)
+            yield _addr(i), addr
+        yield _EN, mask
+
+
+def window_ports_stores(mask, steps):
+    for step in steps:
+        for i, (addr, color) in sorted(step.items()):
+            yield _window(1 << i, addr), color
+
+
+PATHS = [
+    ("csr",          csr_stores,          "run"),
+    ("csr_fill",     csr_fill_stores,     "flat"),
+    ("window",       window_stores,       "run"),
+    ("window_fill",  window_stores,       "flat"),
+    ("csr_ports",    csr_ports_stores,    "ports"),
+    ("window_ports", window_ports_stores, "ports"),
+]
+
+
+def run_path(stores, mask, pixels):
+    """Replay the stores on a fresh bus, return (cycles, stores, port writes seen)."""
+    dut = _PanelBus()
+    result = {"cycles": 0, "stores": 0, "done": False}
+    seen = []
+
+    def master():
+        for _ in range(4):
+            yield
+        cycles = 0
+        for adr, dat in stores(mask, pixels):
+            yield dut.master.adr.eq(adr)
+            yield dut.master.dat_w.eq(dat)
+            yield dut.master.sel.eq(0xf)
+            yield dut.master.we.eq(1)
+            yield dut.master.cyc.eq(1)
+            yield dut.master.stb.eq(1)
+            yield
+            cycles += 1
+            while not (yield dut.master.ack):
+                yield
+                cycles += 1
+            yield dut.master.cyc.eq(0)
+            yield dut.master.stb.eq(0)
+            result["stores"] += 1
+        # Let the last write land
+        for _ in range(4):
+            yield
+        result["cycles"] = cycles
+        result["done"] = True
+
+    @passive
+    def monitor():
+        # One entry per change in what the channels write: the (addr, wdat)
+        # of each port, None for the ports not writing
+        last = None
+        while True:
+            now = []
+            for channel in dut.panel.channels:
+                if (yield channel.en):
+                    now.append(((yield channel.addr), (yield channel.wdat)))
+                else:
+                    now.append(None)
+            now = tuple(now)
+            if now != last and any(now):
+                seen.append(now)
+            last = now
+            yield
+
+    run_simulation(dut, [master(), monitor()])
+    assert result["done"]
+    return result["cycles"], result["stores"], seen
+
+
+def _color(addr, port=0):
+    return ((addr + 977*port) * 2654435761) & 0x3ffff
+
+
+def bench(n_pixels, clock):
+    mask = 0b0101
+    results = []
+    for name, stores, kind in PATHS:
+        if kind == "ports":
+            pixels = [{i: (addr ^ (i << 4), _color(addr, i)) for i in _ports(mask)}
+                      for addr in range(n_pixels)]
+            writes = [{i: (addr, panel_wdat(color)) for i, (addr, color) in step.items()}
+                      for step in pixels]
+            count = n_pixels * len(_ports(mask))
+        else:
+            pixels = [(addr, 0x2a5c3 if kind == "flat" else _color(addr)) for addr in range(n_pixels)]
+            writes = [{i: (addr, panel_wdat(color)) for i in _ports(mask)} for addr, color in pixels]
+            count = n_pixels
+        if name == "window_ports":
+            # One port at a time
+            expected = [tuple(step[i] if i == j else None for i in range(N_PORTS))
+                        for step in writes for j in sorted(step)]
+        else:
+            expected = [tuple(step.get(i) for i in range(N_PORTS)) for step in writes]
+        cycles, n_stores, seen = run_path(stores, mask, pixels)
+        results.append({
+            "path": name,
+            "pixels": count,
+            "stores_per_pixel": n_stores / count,
+            "cycles_per_pixel": cycles / count,
+            "pixels_per_s": clock * count / cycles,
+            "panel_ms": 1e3 * PANEL_PIXELS * cycles / count / clock,
+            "ok": seen == expected,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the bus cost of panel pixel writes.")
+    parser.add_argument("--pixels", default=256, type=int, help="Pixels to write per path.")
+    parser.add_argument("--clock", default=50e6, type=float, help="System clock frequency.")
+    args = parser.parse_args()
+
+    print("%-12s %8s %10s %12s %10s %4s" % ("path", "stores", "cycles/px", "Mpx/s", "panel ms", "ok"))
+    for r in bench(args.pixels, args.clock):
+        print("%-12s %8.2f %10.2f %12.2f %10.3f %4s"
+              % (r["path"], r["stores_per_pixel"], r["cycles_per_pixel"],
+                 r["pixels_per_s"] / 1e6, r["panel_ms"], "yes" if r["ok"] else "NO"))
+
+
+if __name__ == "__main__":
+    main()
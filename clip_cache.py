@@ -0,0 +1,215 @@
+#!/bin/python3
+# Pre-encoded clip cache for looping GIFs and videos
+#
+# Encoding a looping clip over and over costs the same CPU every pass. A
+# compiled clip holds the finished packets of every frame, plus how long each
+# frame should be shown, in one file we mmap and send straight out of.
+#
+# File layout (all little-endian):
+#   MAGIC, then uint32 format version, frame count, packets per frame, packet size
+#   uint8[frames][packets per frame][packet] - packets, ready to send
+#   float64[frames]                          - frame durations in seconds
+#   uint16[frames][packets per frame]        - bytes of each packet to send
+#
+# Clips are named after a hash of the source file's contents and the
+# encoder's layout_key() (canvas size, panel layout and masks, channel order,
+# packet format and ENCODER_VERSION), so changing any of those compiles a
+# fresh one.
+#
+# Usage: ./clip_cache.py compile <gif> [--size 64|128] [--panel-mask N]
+#        ./clip_cache.py play <gif> [--size 64|128] [--panel-mask N] [sender options]
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import time
+import numpy as np
+from PIL import Image
+from PIL import ImageOps
+from PIL import ImageSequence
+
+MAGIC = b"WYRMCLIP"
+FORMAT_VERSION = 2
+_HEADER = struct.Struct("<8sIIII")
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "wyrm", "clips")
+# Used for GIF frames that don't say how long they last
+DEFAULT_FRAME_TIME = 0.1
+
+
+def clip_key(path, encoder):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(("%s;f%d" % (encoder.layout_key(), FORMAT_VERSION)).encode())
+    return h.hexdigest()
+
+
+def clip_path(path, encoder, cache_dir=DEFAULT_CACHE_DIR):
+    return os.path.join(cache_dir, clip_key(path, encoder) + ".clip")
+
+
+def gif_frames(path, width, height):
+    """Yield (RGB frame array, duration in seconds) the same way the send_gif scripts prepare them."""
+    im = Image.open(path)
+    size = width, height
+    for frame in ImageSequence.Iterator(im):
+        duration = frame.info.get("duration", 0) / 1000.0 or DEFAULT_FRAME_TIME
+        thumb = ImageOps.pad(frame, size, Image.Resampling.LANCZOS)
+        thumb = thumb.convert("RGB")
+        yield np.array(thumb), duration
+
+
+def write_clip(out_path, encoder, frames):
+    """Encode (frame, duration) pairs and write them out as a clip file."""
+    durations = []
+    lengths = []
+    n_packets = encoder.packet_matrix().shape[0]
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp_path = out_path + ".tmp%d" % os.getpid()
+    try:
+        with open(tmp_path, 'wb') as f:
+            # The frame count isn't known until the end, so come back for it
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, 0, n_packets, encoder.packet_size))
+            for frame, duration in frames:
+                encoder.encode(frame)
+                f.write(encoder.packet_matrix().tobytes())
+                durations.append(duration)
+                if encoder.lengths is None:
+                    lengths.append(np.full(n_packets, encoder.packet_size))
+                else:
+                    lengths.append(encoder.lengths.copy())
+            if not durations:
+                raise ValueError("no frames to write to %s" % out_path)
+            f.write(np.asarray(durations, dtype='<f8').tobytes())
+            f.write(np.concatenate(lengths).astype('<u2').tobytes())
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(durations), n_packets, encoder.packet_size))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class Clip:
+    """A compiled clip, mmapped read-only.
+
+    packets is a (frames * packets_per_frame, packet_size) view of the file,
+    so frame i is rows i*packets_per_frame up to (i+1)*packets_per_frame.
+    lengths says how many bytes of each of those rows make up the packet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_frames, n_packets, packet_size = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._mmap.close()
+            raise ValueError("%s is not a version %d clip" % (path, FORMAT_VERSION))
+        if n_frames == 0:
+            # Playing it would spin without ever sending or sleeping
+            self._mmap.close()
+            raise ValueError("%s has no frames" % path)
+        self.num_frames = n_frames
+        self.packets_per_frame = n_packets
+        packet_bytes = n_frames * n_packets * packet_size
+        self.packets = np.frombuffer(self._mmap, dtype=np.uint8, count=packet_bytes,
+                                     offset=_HEADER.size).reshape(-1, packet_size)
+        self.durations = np.frombuffer(self._mmap, dtype='<f8', count=n_frames,
+                                       offset=_HEADER.size + packet_bytes)
+        self.lengths = np.frombuffer(self._mmap, dtype='<u2', count=n_frames * n_packets,
+                                     offset=_HEADER.size + packet_bytes + 8 * n_frames)
+
+    def frame_rows(self, i):
+        return i * self.packets_per_frame, (i + 1) * self.packets_per_frame
+
+
+def load_or_compile_gif(path, encoder, cache_dir=DEFAULT_CACHE_DIR):
+    """Open the clip for path as encoder would encode it, compiling it with
+    encoder first if it isn't cached yet."""
+    out_path = clip_path(path, encoder, cache_dir)
+    if not os.path.exists(out_path):
+        write_clip(out_path, encoder, gif_frames(path, encoder.width, encoder.height))
+    return Clip(out_path)
+
+
+class ClipPlayer:
+    """Plays a Clip through a PanelSender's sockets and pacers.
+
+    The clip must have been compiled with the sender's encoder, so each
+    frame's rows split between boards the same way.
+    """
+
+    def __init__(self, sender, clip):
+        self.sender = sender
+        self.clip = clip
+        self.txs = sender.add_transmitters(clip.packets)
+        for tx in self.txs:
+            tx.set_lengths(clip.lengths)
+
+    def send_frame(self, i):
+        self.sender.wait_for_present()
+        start = time.perf_counter()
+        base, stop = self.clip.frame_rows(i)
+        for link, tx in zip(self.sender.links, self.txs):
+            self.sender.transmit(link, tx, base + link.row_start, base + link.row_stop)
+        if self.sender.present:
+            self.sender.present_frame()
+        self.sender.record_frame(stop - base, int(self.clip.lengths[base:stop].sum()), start)
+        return stop - base
+
+    def play(self, frame_time=None, loops=None):
+        """Loop the clip forever (or loops times), showing each frame for its
+        recorded duration unless frame_time overrides it."""
+        played = 0
+        deadline = time.monotonic()
+        while loops is None or played < loops:
+            for i in range(self.clip.num_frames):
+                self.send_frame(i)
+                deadline += self.clip.durations[i] if frame_time is None else frame_time
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.monotonic()
+            played += 1
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", action="store_true",
+                        help="Play from a pre-encoded clip, compiling it first if needed.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Where compiled clips are kept.")
+
+
+def main():
+    from panel_sender import add_sender_arguments, sender_from_args
+
+    parser = argparse.ArgumentParser(description="Compile GIFs into pre-encoded clips and play them.")
+    parser.add_argument("command", choices=["compile", "play"])
+    parser.add_argument("gif", help="Animated image to compile or play.")
+    parser.add_argument("--size", default=128, type=int, choices=[64, 128],
+                        help="Square canvas size in pixels.")
+    parser.add_argument("--panel-mask", default=None, type=int,
+                        help="Panel enable mask for a 64x64 canvas (128x128 uses 1 << segment).")
+    parser.add_argument("--frame-time", default=None, type=float,
+                        help="Seconds per frame, overriding the durations stored in the GIF.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Where compiled clips are kept.")
+    add_sender_arguments(parser)
+    args = parser.parse_args()
+
+    masks = None if args.panel_mask is None else [args.panel_mask]
+    sender = sender_from_args(args, args.size, args.size, masks=masks)
+    clip = load_or_compile_gif(args.gif, sender.encoder, args.cache_dir)
+    print("%s: %d frames, %d packets each" % (clip.path, clip.num_frames, clip.packets_per_frame))
+
+    if args.command == "play":
+        ClipPlayer(sender, clip).play(args.frame_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# Conversion time per MB of bitstream for bit_to_flash.py
+#
+# Times the converter against the per-byte version it replaced, kept below
+# as the reference: a Python bit reversal loop per byte, a sliding compare
+# for the IDCODE and textwrap for every SDR line. Both write into memory so
+# only the conversion is measured, and their output has to agree line for
+# line (the old one also left the indentation of its templates at the end
+# of the blank lines, which is ignored). The old one also erased the sector
+# after an image that ends on a sector boundary, so the random image here
+# stops one page short of one.
+#
+# The SVFs with fixed waits and with --poll are then played into a model of
+# the board's SPI flash (SvfPlayer and SpiFlash below). It checks that every
+# command reaches a flash that is ready for it and that the flash ends up
+# holding the bitstream. It also adds up how long the JTAG side would take,
+# with the flash needing its typical, not worst-case, erase and program
+# times.
+#
+# Last, bit_to_flash.flash_svf (what wyrm.py --flash runs) flashes a
+# sequence of images to two modelled boards, which keep their flash
+# contents between flashes. It checks the following:
+#   - named boards only get their changed sectors;
+#   - unnamed boards and --flash-full get everything;
+#   - a failed load makes the next flash a full one;
+#   - every board ends up holding exactly the image last flashed to it.
+#
+# Usage: ./flash_bench.py [--size 1.0] [--bitstream file.bit] [--iterations 3] [--json out.json]
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import textwrap
+import time
+import numpy as np
+
+import bit_to_flash
+
+MB = 1 << 20
+
+
+def legacy_bitreverse(x):
+    y = 0
+    for i in range(8):
+        if (x >> (7 - i)) & 1 == 1:
+            y |= (1 << i)
+    return y
+
+
+def legacy_svf(bs):
+    idcode_cmd = bytes([0xE2, 0x00, 0x00, 0x00])
+    idcode = None
+    for i in range(len(bs) - 4):
+        if bs[i:i+4] == idcode_cmd:
+            idcode = (bs[i+4] << 24) | (bs[i+5] << 16) | (bs[i+6] << 8) | bs[i+7]
+            break
+    if idcode is None:
+        raise ValueError("no IDCODE in bitstream")
+
+    svf = io.StringIO()
+    svf.write(bit_to_flash.HEADER)
+    svf.write(bit_to_flash.CHECK_IDCODE.format(idcode))
+    svf.write(bit_to_flash.ENTER_SPI)
+    bitf = io.BytesIO(bs)
+    address = 0
+    last_page = -1
+    while True:
+        if (address // 0x10000) != last_page:
+            last_page = address // 0x10000
+            print("""SDR	8	TDI  (60);
+                """, file=svf)
+            address_flipped = [legacy_bitreverse(x) for x in [0xd8, int(address // 0x10000), 0x00, 0x00]]
+            hex_address = ["{:02X}".format(x) for x in reversed(address_flipped)]
+            print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(hex_address), "".join(hex_address)), 100)), file=svf)
+            print("""RUNTEST	3.00 SEC;
+                """, file=svf)
+
+        chunk = bitf.read(bit_to_flash.flash_page_size)
+        if not chunk:
+            break
+        br_chunk = [legacy_bitreverse(x) for x in bytes([0x02, int(address / 0x10000 % 0x100), int(address / 0x100 % 0x100), int(address % 0x100)]) + chunk]
+        address += len(chunk)
+        hex_chunk = ["{:02X}".format(x) for x in reversed(br_chunk)]
+        print("""
+SDR	8	TDI  (60);
+                """, file=svf)
+        print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(br_chunk), "".join(hex_chunk)), 100)), file=svf)
+        print("""
+RUNTEST	2.50E-2 SEC;
+                """, file=svf)
+    svf.write(bit_to_flash.FOOTER)
+    return svf.getvalue()
+
+
+class SpiFlash:
+    """Just enough of a 25-series SPI NOR flash to see what an SVF does to it.
+
+    Starts out all zeros, so anything programmed without an erase first
+    comes out wrong. Commands sent while an erase or program is still busy
+    are ignored like the real thing ignores them, and logged in errors.
+    """
+
+    def __init__(self, size=4 << 20, erase_time=0.15, page_time=0.0007, status_time=0.01):
+        self.data = bytearray(size)
+        self.erase_time = erase_time
+        self.page_time = page_time
+        self.status_time = status_time
+        self.busy_until = 0.0
+        self.write_enabled = False
+        self.errors = []
+
+    def transfer(self, now, mosi):
+        """One chip select's worth of bytes in at time now, returns the bytes out."""
+        miso = bytearray(len(mosi))
+        cmd = mosi[0]
+        busy = now < self.busy_until
+        if cmd == 0x05:
+            miso[1:] = bytes([1 if busy else 0]) * (len(mosi) - 1)
+        elif cmd == 0x9F:
+            miso[1:4] = bytes([0xEF, 0x40, 0x16])[:len(mosi) - 1]
+        elif cmd == 0xAB:
+            pass
+        elif busy:
+            self.errors.append("command 0x%02X at %.6f s while busy" % (cmd, now))
+        elif cmd == 0x06:
+            self.write_enabled = True
+        elif cmd in (0x01, 0xD8, 0x02):
+            if not self.write_enabled:
+                self.errors.append("command 0x%02X at %.6f s without write enable" % (cmd, now))
+                return bytes(miso)
+            self.write_enabled = False
+            address = int.from_bytes(mosi[1:4], "big")
+            if cmd == 0x01:
+                self.busy_until = now + self.status_time
+            elif cmd == 0xD8:
+                start = address & ~(bit_to_flash.erase_block_size - 1)
+                self.data[start:start + bit_to_flash.erase_block_size] = \
+                    b"\xff" * bit_to_flash.erase_block_size
+                self.busy_until = now + self.erase_time
+            else:
+                # Programming only clears bits, and wraps around within the page
+                page = address & ~(bit_to_flash.flash_page_size - 1)
+                for i, byte in enumerate(mosi[4:]):
+                    a = page + (address + i) % bit_to_flash.flash_page_size
+                    self.data[a] &= byte
+                self.busy_until = now + self.page_time
+        else:
+            self.errors.append("unknown command 0x%02X" % cmd)
+        return bytes(miso)
+
+
+class SvfPlayer:
+    """Plays the subset of SVF bit_to_flash.py writes into an SpiFlash.
+
+    After SIR 3A and the key scanned in after it, every SDR is one SPI
+    transaction. The ECP5's own registers aren't modelled, so SDRs outside
+    SPI mode always match. LOOP n ... ENDLOOP repeats its body until the TDO
+    checks in it all match, at most n times. now is the time spent so far:
+    the RUNTEST waits, every scan at frequency TCK, and scan_latency for
+    every scan whose TDO has to come back before the player can go on.
+    """
+
+    _FIELD = re.compile(r"(TDI|TDO|MASK|SMASK)\s*\(([^)]*)\)")
+
+    def __init__(self, flash, frequency=25e6, scan_latency=125e-6):
+        self.flash = flash
+        self.frequency = frequency
+        self.scan_latency = scan_latency
+        self.now = 0.0
+        self.spi = False
+        self.errors = []
+
+    @staticmethod
+    def statements(text):
+        text = "\n".join(line for line in text.splitlines()
+                         if not line.lstrip().startswith(("//", "!")))
+        for statement in text.split(";"):
+            statement = " ".join(statement.split())
+            if statement:
+                yield statement
+
+    def play(self, text):
+        body = None
+        for statement in self.statements(text):
+            words = statement.split()
+            if words[0] == "LOOP":
+                tries, body = int(words[1]), []
+            elif words[0] == "ENDLOOP":
+                for _ in range(tries):
+                    if all([self.run(s) for s in body]):
+                        break
+                else:
+                    self.errors.append("LOOP ran out at %.6f s" % self.now)
+                    return False
+                body = None
+            elif body is not None:
+                body.append(statement)
+            elif not self.run(statement):
+                self.errors.append("TDO mismatch at %.6f s: %s" % (self.now, statement[:60]))
+                return False
+        return True
+
+    def run(self, statement):
+        """Run one statement, returns whether its TDO (if any) matched."""
+        words = statement.split()
+        if words[0] == "RUNTEST":
+            seconds = [float(words[i - 1]) for i, w in enumerate(words) if w == "SEC"]
+            ticks = [int(words[i - 1]) for i, w in enumerate(words) if w == "TCK"]
+            self.now += max(seconds + [t / self.frequency for t in ticks])
+        elif words[0] == "SIR":
+            fields = dict(self._FIELD.findall(statement))
+            self.spi = int(fields["TDI"].replace(" ", ""), 16) == 0x3A and "key"
+        elif words[0] == "SDR":
+            bits = int(words[1])
+            fields = {k: v.replace(" ", "") for k, v in self._FIELD.findall(statement)}
+            self.now += bits / self.frequency
+            if self.spi == "key":
+                self.spi = True
+            elif self.spi:
+                mosi = bytes.fromhex(fields["TDI"].zfill(bits // 4))[::-1].translate(bit_to_flash.REVERSE)
+                miso = self.flash.transfer(self.now, mosi)
+                if "TDO" in fields:
+                    self.now += self.scan_latency
+                    tdo = int.from_bytes(miso.translate(bit_to_flash.REVERSE)[::-1], "big")
+                    mask = int(fields.get("MASK", "F" * (bits // 4)), 16)
+                    return (tdo ^ int(fields["TDO"], 16)) & mask == 0
+        return True
+
+
+def play_svf(svf, bs):
+    """(seconds, whether the flash ends up holding bs, errors) for playing svf."""
+    flash = SpiFlash()
+    player = SvfPlayer(flash)
+    player.play(svf)
+    errors = player.errors + flash.errors
+    return player.now, flash.data[:len(bs)] == bs and not errors, errors
+
+
+def random_bitstream(size):
+    """About size bytes of noise behind an IDCODE check, so every page is different."""
+    if size % bit_to_flash.erase_block_size == 0:
+        size -= bit_to_flash.flash_page_size
+    bs = bytearray(np.random.default_rng(0).integers(0, 256, size, dtype=np.uint8).tobytes())
+    bs[:12] = bytes([0xFF, 0x00, 0xBF, 0xB3, 0xE2, 0x00, 0x00, 0x00, 0x41, 0x11, 0x10, 0x43])
+    return bytes(bs)
+
+
+def same_svf(a, b):
+    return [l.rstrip() for l in a.splitlines()] == [l.rstrip() for l in b.splitlines()]
+
+
+def time_it(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        out = fn()
+    return (time.perf_counter() - start) / iterations, out
+
+
+def bench(bs, iterations):
+    results = []
+    reference = None
+    for name, convert in (("legacy", legacy_svf), ("translate", bit_to_flash.bit_to_svf)):
+        seconds, svf = time_it(lambda: convert(bs), iterations)
+        if reference is None:
+            reference = svf
+        results.append({
+            "path": name,
+            "bitstream_bytes": len(bs),
+            "svf_bytes": len(svf),
+            "seconds": seconds,
+            "seconds_per_mb": seconds * MB / len(bs),
+            "ok": same_svf(reference, svf),
+        })
+    return results
+
+
+def bench_flash(bs):
+    results = []
+    for name, poll in (("fixed", False), ("polled", True)):
+        svf = bit_to_flash.bit_to_svf(bs, poll=poll)
+        seconds, ok, errors = play_svf(svf, bs)
+        results.append({
+            "path": name,
+            "bitstream_bytes": len(bs),
+            "svf_bytes": len(svf),
+            "flash_seconds": seconds,
+            "flash_seconds_per_mb": seconds * MB / len(bs),
+            "ok": ok,
+            "errors": errors[:10],
+        })
+    return results
+
+
+class FakeBoards:
+    """Boards for flash_svf to load SVFs into, each with its own SpiFlash
+    that keeps its contents from one flash to the next. The board being
+    flashed is set in target; fail makes the next load stop halfway
+    through and raise, like a cable pulled mid-flash."""
+
+    def __init__(self):
+        self.flashes = {}
+        self.target = None
+        self.fail = False
+
+    def load(self, svf):
+        with open(svf) as f:
+            text = f.read()
+        flash = self.flashes.setdefault(self.target, SpiFlash())
+        # Each load starts its own clock, long after the last one finished
+        flash.busy_until = 0.0
+        if self.fail:
+            self.fail = False
+            SvfPlayer(flash).play(text[:text.rindex(";", 0, len(text) // 2) + 1])
+            raise OSError("load failed")
+        player = SvfPlayer(flash)
+        player.play(text)
+        if player.errors or flash.errors:
+            raise OSError("; ".join(player.errors + flash.errors))
+
+
+def bench_boards(bs):
+    """Flash a run of images to two boards through flash_svf and check that
+    each one ends up holding what was last flashed to it."""
+    rng = np.random.default_rng(1)
+
+    def changed(image, sectors):
+        image = bytearray(image)
+        for sector in sectors:
+            start = sector * bit_to_flash.erase_block_size + 64
+            image[start:start + 16] = rng.integers(0, 256, 16, dtype=np.uint8).tobytes()
+        return bytes(image)
+
+    n = bit_to_flash.sector_count(bs)
+    a = bs
+    b = changed(a, [1])
+    c = changed(b, [0, n - 1])
+    d = changed(a, [2])
+    # (image, physical board, --flash-board, --flash-full, fail the load,
+    #  sectors flash_svf should write, None for all)
+    steps = [
+        (a, "one", "one", False, False, None),
+        (b, "one", "one", False, False, [1]),
+        (c, "two", None,  False, False, None),
+        (b, "two", None,  False, False, None),
+        (c, "one", "one", False, True,  [0, n - 1]),
+        (c, "one", "one", False, False, None),
+        (d, "one", "one", False, False, [0, 1, 2, n - 1]),
+        (a, "one", "one", True,  False, None),
+    ]
+
+    boards = FakeBoards()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        bitstream = os.path.join(tmp, "image.bit")
+        svf = os.path.join(tmp, "flash.svf")
+        cache_dir = os.path.join(tmp, "cache")
+        for i, (image, target, name, full, fail, expected) in enumerate(steps):
+            with open(bitstream, 'wb') as f:
+                f.write(image)
+            boards.target = target
+            boards.fail = fail
+            try:
+                sectors = bit_to_flash.flash_svf(bitstream, svf, boards.load, name, full, cache_dir)
+                failed = False
+            except OSError:
+                sectors = expected
+                failed = True
+            flash = boards.flashes[target]
+            ok = sectors == expected and failed == fail
+            if not fail:
+                ok = ok and flash.data[:len(image)] == image
+            results.append({
+                "step": i,
+                "board": target,
+                "flash_board": name,
+                "full": full,
+                "failed": failed,
+                "sectors": n if sectors is None else len(sectors),
+                "ok": ok,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bitstream to SVF conversion.")
+    parser.add_argument("--size", default=1.0, type=float, help="MB of random bitstream to convert.")
+    parser.add_argument("--bitstream", default=None, help="Convert this bitstream instead.")
+    parser.add_argument("--iterations", default=3, type=int, help="Conversions per measurement.")
+    parser.add_argument("--json", default=None, help="Write the results as JSON here ('-' for stdout).")
+    args = parser.parse_args()
+
+    if args.bitstream is not None:
+        with open(args.bitstream, 'rb') as f:
+            bs = f.read()
+    else:
+        bs = random_bitstream(int(args.size * MB))
+    results = bench(bs, args.iterations)
+    flash_results = bench_flash(bs)
+    board_results = bench_boards(bs)
+
+    if args.json == "-":
+        json.dump(results + flash_results + board_results, sys.stdout, indent=2)
+        print()
+        return
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results + flash_results + board_results, f, indent=2)
+
+    print("%-10s %10s %10s %10s %8s %4s" % ("path", "KiB", "SVF KiB", "seconds", "s/MB", "ok"))
+    for r in results:
+        print("%-10s %10.1f %10.1f %10.3f %8.3f %4s"
+              % (r["path"], r["bitstream_bytes"] / 1024.0, r["svf_bytes"] / 1024.0,
+                 r["seconds"], r["seconds_per_mb"], "yes" if r["ok"] else "NO"))
+    print()
+    print("%-10s %10s %10s %10s %8s %4s" % ("flash", "KiB", "SVF KiB", "seconds", "s/MB", "ok"))
+    for r in flash_results:
+        print("%-10s %10.1f %10.1f %10.1f %8.1f %4s"
+              % (r["path"], r["bitstream_bytes"] / 1024.0, r["svf_bytes"] / 1024.0,
+                 r["flash_seconds"], r["flash_seconds_per_mb"], "yes" if r["ok"] else "NO"))
+        for error in r["errors"]:
+            print("    " + error)
+    print()
+    print("%-5s %-6s %-12s %5s %7s %8s %4s" % ("step", "board", "flash-board", "full", "failed",
+                                                 "sectors", "ok"))
+    for r in board_results:
+        print("%-5d %-6s %-12s %5s %7s %8d %4s"
+              % (r["step"], r["board"], r["flash_board"] or "-", "yes" if r["full"] else "no",
+                 "yes" if r["failed"] else "no", r["sectors"], "yes" if r["ok"] else "NO"))
+
+
+if __name__ == "__main__":
+    main()
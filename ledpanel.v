@@ -9,6 +9,12 @@
 // PANEL_[RGB]1 ... color channel for bottom half
 // taken from http://svn.clifford.at/handicraft/2015/c3demo/fpga/ledpanel.v
 // modified by Niklas Fauth 2020
+//
+// With DOUBLE_BUFFER set the video memories hold two frames: ctrl writes go
+// to the back one while the front one is scanned out, and a ctrl_swap pulse
+// swaps them at the end of the next full scan. ctrl_swap_pending stays high
+// until that has happened - writes made meanwhile land in the frame still on
+// display. Without DOUBLE_BUFFER, ctrl_swap does nothing.
 
 `default_nettype none
 module ledpanel (
@@ -17,6 +23,8 @@ module ledpanel (
     input wire ctrl_en,
     input wire [15:0] ctrl_addr,        // Addr to write color info on [col_info][row_info]
     input wire [23:0] ctrl_wdat,        // Data to be written [R][G][B]
+    input wire ctrl_swap,               // Show the back buffer from the next full scan on
+    output wire ctrl_swap_pending,      // Swap requested but not done yet
 
     input wire display_clock,
     output reg panel_r0, panel_g0, panel_b0, panel_r1, panel_g1, panel_b1,
@@ -26,12 +34,14 @@ module ledpanel (
 parameter integer INPUT_DEPTH          = 6;    // bits of color before gamma correction
 parameter integer COLOR_DEPTH          = 6;    // bits of color after gamma correction
 parameter integer CHAINED              = 1; // number of panels in chain
+parameter integer DOUBLE_BUFFER        = 0; // 1 = keep a back buffer, shown on ctrl_swap
 
 localparam integer SIZE_BITS = $clog2(CHAINED);
+localparam integer BUFFERS   = DOUBLE_BUFFER ? 2 : 1;
 
-reg [COLOR_DEPTH-1:0] video_mem_r [0:CHAINED*4096-1];
-reg [COLOR_DEPTH-1:0] video_mem_g [0:CHAINED*4096-1];
-reg [COLOR_DEPTH-1:0] video_mem_b [0:CHAINED*4096-1];
+reg [COLOR_DEPTH-1:0] video_mem_r [0:BUFFERS*CHAINED*4096-1];
+reg [COLOR_DEPTH-1:0] video_mem_g [0:BUFFERS*CHAINED*4096-1];
+reg [COLOR_DEPTH-1:0] video_mem_b [0:BUFFERS*CHAINED*4096-1];
 
 reg [COLOR_DEPTH-1:0] gamma_mem   [0:2**COLOR_DEPTH-1];
 
@@ -49,10 +59,31 @@ initial begin:video_mem_init
     $readmemh("blue.mem",video_mem_b);
 end
 
+// swap_req toggles once per accepted ctrl_swap, and the display side makes
+// front follow it at the end of a full scan. Whichever buffer swap_req
+// doesn't point at is the back buffer.
+reg       swap_req = 0;
+reg [1:0] swap_req_sync = 0;
+reg       front = 0;
+reg [1:0] front_sync = 0;
+
+assign ctrl_swap_pending = DOUBLE_BUFFER && swap_req != front_sync[1];
+
+always @(posedge ctrl_clk) begin
+    front_sync <= {front_sync[0], front};
+    if (DOUBLE_BUFFER && ctrl_swap && !ctrl_swap_pending) swap_req <= !swap_req;
+end
+
+always @(posedge display_clock) begin
+    swap_req_sync <= {swap_req_sync[0], swap_req};
+end
+
+wire [16:0] write_addr = DOUBLE_BUFFER ? {!swap_req, ctrl_addr[11+SIZE_BITS:0]} : ctrl_addr;
+
 always @(posedge ctrl_clk) begin
-    if (ctrl_en) video_mem_r[ctrl_addr] <= ctrl_wdat[16+INPUT_DEPTH-1:16];
-    if (ctrl_en) video_mem_g[ctrl_addr] <= ctrl_wdat[8+INPUT_DEPTH-1:8];
-    if (ctrl_en) video_mem_b[ctrl_addr] <= ctrl_wdat[0+INPUT_DEPTH-1:0];
+    if (ctrl_en) video_mem_r[write_addr] <= ctrl_wdat[16+INPUT_DEPTH-1:16];
+    if (ctrl_en) video_mem_g[write_addr] <= ctrl_wdat[8+INPUT_DEPTH-1:8];
+    if (ctrl_en) video_mem_b[write_addr] <= ctrl_wdat[0+INPUT_DEPTH-1:0];
 end
 
 reg [5+COLOR_DEPTH+SIZE_BITS:0] cnt_x = 0;
@@ -63,6 +94,7 @@ reg state = 0;
 reg [5+SIZE_BITS:0] addr_x;
 reg [5:0]           addr_y;
 reg [2:0]           addr_z;
+reg                 addr_buffer;
 reg [2:0]           data_rgb;
 reg [2:0]           data_rgb_q;
 reg [5+COLOR_DEPTH+SIZE_BITS:0] max_cnt_x;
@@ -89,6 +121,7 @@ always @(posedge display_clock) begin
             if (cnt_z == COLOR_DEPTH-1) begin
                 cnt_y <= cnt_y + 1;
                 cnt_z <= 0;
+                if (cnt_y == 31) front <= swap_req_sync[1];
             end
         end else begin
             cnt_x <= cnt_x + 1;
@@ -111,12 +144,15 @@ always @(posedge display_clock) begin
     addr_x <= cnt_x[5+SIZE_BITS:0];
     addr_y <= cnt_y + 32*(!state);
     addr_z <= cnt_z;
+    // Registered with the rest of the address, so the video memories still
+    // map to block RAM read ports with DOUBLE_BUFFER set
+    addr_buffer <= DOUBLE_BUFFER && front;
 end
 
 always @(posedge display_clock) begin
-    data_rgb[2] <= gamma_mem[video_mem_r[{addr_y, addr_x}]][addr_z];
-    data_rgb[1] <= gamma_mem[video_mem_g[{addr_y, addr_x}]][addr_z];
-    data_rgb[0] <= gamma_mem[video_mem_b[{addr_y, addr_x}]][addr_z];
+    data_rgb[2] <= gamma_mem[video_mem_r[{addr_buffer, addr_y, addr_x}]][addr_z];
+    data_rgb[1] <= gamma_mem[video_mem_g[{addr_buffer, addr_y, addr_x}]][addr_z];
+    data_rgb[0] <= gamma_mem[video_mem_b[{addr_buffer, addr_y, addr_x}]][addr_z];
 end
 
 always @(posedge display_clock) begin
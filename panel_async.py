@@ -0,0 +1,316 @@
+#!/bin/python3
+# asyncio sender for driving many boards and streams from one process
+#
+# Each board gets a connected datagram endpoint on one shared event loop, and
+# each stream (a video on one wall, a GIF on another board, ...) is a task
+# that waits for its own frame deadlines on that loop. Decoding runs in the
+# loop's thread pool so one slow source doesn't hold up the others' timing.
+# Encoding, delta tracking and pacing are the same pieces the blocking
+# senders use.
+#
+# Streams are listed in a JSON file:
+#
+#   {"streams": [
+#     {"source": "clip.mp4", "ip": "192.168.10.30", "width": 128, "height": 128},
+#     {"source": "loop.gif", "wall": "wall.json", "delta": true, "pps": 2000}
+#   ]}
+#
+# Each stream takes "ip"/"port"/"width"/"height" for a single board, or
+# "wall" for a panel_geometry file, plus optional "delta",
+# "keyframe_interval", "pps", "burst", "wire_format" (see --wire-format),
+# "compress", "present" (see --present), "gamma", "white_balance" (a list of
+# red, green, blue gains), "frame_time" (seconds, overriding the source's
+# own timing) and "loop" (start a video over when it ends; GIFs always
+# loop). A single board stream can also give "panel_mask", the header mask
+# to send every panel's packets with instead of 1 << i.
+#
+# Packets the kernel refuses (ICMP port unreachable, no buffer space) come
+# back through the endpoint's error_received and are counted as dropped.
+# When the socket buffer is full the transport queues the rest itself, and
+# a board waits for that queue to drain before sending more.
+#
+# Each stream's stage timings and counters (see panel_metrics.py) are
+# labelled with its source, and --metrics-jsonl/--metrics-prom write them
+# out for all streams together.
+#
+# Usage: ./panel_async.py streams.json
+import argparse
+import asyncio
+import json
+import os
+import time
+import numpy as np
+
+from panel_encoder import FrameEncoder, OPCODES, RGB_ORDER, BGR_ORDER, present_packet
+from panel_geometry import WallGeometry, UDP_IP, UDP_PORT
+from panel_metrics import Metrics, add_metrics_arguments, exporter_from_args
+from panel_pacing import BURST, TokenBucket
+from panel_sender import DeltaTracker, PRESENT_GAP, plan_size
+
+GIF_EXTENSIONS = (".gif", ".png", ".webp")
+# How often to look at a board's transport queue while it drains
+DRAIN_POLL = 0.001
+
+
+class BoardProtocol(asyncio.DatagramProtocol):
+    """One board's datagram endpoint. The board never answers, so the only
+    thing to hear about is errors such as ICMP port unreachable, each of
+    which means a packet that didn't make it."""
+
+    def __init__(self):
+        self.transport = None
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        self.dropped += 1
+
+
+class AsyncBoard:
+    def __init__(self, addr, row_start, row_stop, pacer, present=None):
+        self.addr = addr
+        self.row_start = row_start
+        self.row_stop = row_stop
+        self.pacer = pacer
+        self.present = present
+        self.protocol = None
+        # Seconds spent waiting on the pacer or a full socket buffer since
+        # the stream last looked
+        self.paced = 0.0
+
+    async def open(self, loop):
+        _, self.protocol = await loop.create_datagram_endpoint(BoardProtocol, remote_addr=self.addr)
+
+    async def send_rows(self, rows, start, stop, index=None, lengths=None):
+        """Send matrix rows start..stop-1 (or index[start:stop]), waiting on the
+        pacer and for the transport's queue to drain. lengths, if given, is
+        how many bytes of each row to send."""
+        transport = self.protocol.transport
+        while start < stop:
+            delay = self.pacer.wait_time(stop - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                self.paced += delay
+            n = self.pacer.take(stop - start)
+            for i in range(start, start + n):
+                row = i if index is None else index[i]
+                if lengths is None:
+                    transport.sendto(rows[row])
+                else:
+                    transport.sendto(rows[row][:lengths[row]])
+            start += n
+            while transport.get_write_buffer_size():
+                await asyncio.sleep(DRAIN_POLL)
+                self.paced += DRAIN_POLL
+
+    def close(self):
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+
+
+class AsyncStream:
+    """Plays frames from a source to one or more boards on the shared loop."""
+
+    def __init__(self, encoder, links, source, delta=False, keyframe_interval=30,
+                 pps=0, burst=BURST, frame_time=None, name=None, present=False):
+        self.encoder = encoder
+        self.source = source
+        self.frame_time = frame_time
+        self.name = name
+        self.present = present
+        self.boards = []
+        row = 0
+        masks = encoder.packets[:, 0, 0]
+        for addr, n in links:
+            rows = n * encoder.packets_per_segment
+            segment = row // encoder.packets_per_segment
+            mask = int(np.bitwise_or.reduce(masks[segment:segment + n]))
+            self.boards.append(AsyncBoard(addr, row, row + rows, TokenBucket(pps, burst),
+                                          present_packet(mask) if present else None))
+            row += rows
+        self.tracker = DeltaTracker(encoder.payload, [b.row_stop for b in self.boards],
+                                    delta, keyframe_interval, 2 if present else 1)
+        self.rows = [memoryview(row) for row in encoder.packet_matrix()]
+        self.frames = 0
+        self.late = 0
+        self.metrics = Metrics({"stream": name} if name is not None else None)
+        self._errors = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for board in self.boards:
+            await board.open(loop)
+        try:
+            metrics = self.metrics
+            deadline = ready = loop.time()
+            while True:
+                t = time.perf_counter()
+                item = await loop.run_in_executor(None, next, self.source, None)
+                if item is None:
+                    break
+                frame, duration = item
+                t = metrics.since("decode", t)
+
+                words = self.encoder.encode(frame)
+                t = metrics.since("encode", t)
+                plan = self.tracker.plan(words)
+                t = metrics.since("delta", t)
+                if ready > loop.time():
+                    await asyncio.sleep(ready - loop.time())
+                    t = metrics.since("present_wait", t)
+                await asyncio.gather(*(board.send_rows(self.rows, start, stop, index,
+                                                       self.encoder.lengths)
+                                       for board, (start, stop, index) in zip(self.boards, plan)))
+                if self.present:
+                    await asyncio.gather(*(board.send_rows([board.present], 0, 1)
+                                           for board in self.boards))
+                    ready = loop.time() + PRESENT_GAP
+                    metrics.add("presents", len(self.boards))
+                self.frames += 1
+                self.record_frame(plan, t)
+
+                deadline += duration if self.frame_time is None else self.frame_time
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.late += 1
+                    metrics.add("frames_late")
+                    deadline = loop.time()
+                metrics.observe("wait", max(delay, 0.0))
+        finally:
+            for board in self.boards:
+                board.close()
+
+    def record_frame(self, plan, start):
+        """Count a frame sent since start (a time.perf_counter() value). The
+        boards send side by side, so the slowest one's pacer waits count
+        as the frame's."""
+        metrics = self.metrics
+        elapsed = time.perf_counter() - start
+        paced = max(board.paced for board in self.boards)
+        for board in self.boards:
+            board.paced = 0.0
+        metrics.observe("pace", paced)
+        metrics.observe("send", max(elapsed - paced, 0.0))
+        packets, sent_bytes = plan_size(plan, self.encoder.lengths, self.encoder.packet_size)
+        errors = self.dropped()
+        metrics.add("frames")
+        metrics.add("packets", packets)
+        metrics.add("bytes", sent_bytes)
+        metrics.add("send_errors", errors - self._errors)
+        self._errors = errors
+        metrics.tick()
+
+    def dropped(self):
+        return sum(b.protocol.dropped for b in self.boards if b.protocol is not None)
+
+
+def video_frames(path, width, height, loop=False):
+    """Yield letterboxed (BGR frame, duration) pairs from anything OpenCV opens."""
+    import cv2
+    from panel_letterbox import Letterbox
+
+    while True:
+        vidcap = cv2.VideoCapture(path)
+        fps = vidcap.get(cv2.CAP_PROP_FPS)
+        frame_time = 1.0/float(fps) if fps > 0 else 1.0/30
+        success, im = vidcap.read()
+        if not success:
+            return
+        letterbox = Letterbox.for_frame(im, (width, height))
+        while success:
+            yield letterbox(im), frame_time
+            success, im = vidcap.read(im)
+        vidcap.release()
+        if not loop:
+            return
+
+
+def looped(frames_fn):
+    while True:
+        yield from frames_fn()
+
+
+def stream_from_config(config, base_dir="."):
+    def path(p):
+        return p if os.path.isabs(p) else os.path.join(base_dir, p)
+
+    source_path = path(config["source"])
+    is_gif = source_path.lower().endswith(GIF_EXTENSIONS)
+    channel_order = RGB_ORDER if is_gif else BGR_ORDER
+    opcode = OPCODES[config.get("wire_format", "v1")]
+    compress = config.get("compress", False)
+    color = {"gamma": config.get("gamma", 1.0), "white_balance": config.get("white_balance")}
+
+    if "wall" in config:
+        geometry = WallGeometry.load(path(config["wall"]))
+        encoder = geometry.encoder(channel_order, opcode, compress, **color)
+        encoder.set_masks(geometry.masks())
+        links = geometry.links()
+    else:
+        encoder = FrameEncoder(config.get("width", 128), config.get("height", 128),
+                               channel_order=channel_order, opcode=opcode, compress=compress,
+                               **color)
+        if "panel_mask" in config:
+            encoder.set_masks([config["panel_mask"]] * encoder.num_segments)
+        links = [((config.get("ip", UDP_IP), config.get("port", UDP_PORT)), encoder.num_segments)]
+
+    if is_gif:
+        from clip_cache import gif_frames
+        # Pad every frame once, each pass after that only replays them
+        frames = list(gif_frames(source_path, encoder.width, encoder.height))
+        source = looped(lambda: frames)
+    else:
+        source = video_frames(source_path, encoder.width, encoder.height,
+                              loop=config.get("loop", False))
+
+    return AsyncStream(encoder, links, source,
+                       delta=config.get("delta", False),
+                       keyframe_interval=config.get("keyframe_interval", 30),
+                       pps=config.get("pps", 0), burst=config.get("burst", BURST),
+                       frame_time=config.get("frame_time"),
+                       name=config["source"], present=config.get("present", False))
+
+
+async def run_streams(streams, report_every=5.0):
+    async def report():
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(report_every)
+            elapsed = time.monotonic() - start
+            for s in streams:
+                print("%s: %d frames (%.1f fps), %d late, %d packets sent, %d skipped, %d dropped"
+                      % (s.name, s.frames, s.frames / elapsed, s.late, s.tracker.packets_sent,
+                         s.tracker.packets_skipped, s.dropped()), flush=True)
+
+    reporter = asyncio.ensure_future(report())
+    try:
+        await asyncio.gather(*(s.run() for s in streams))
+    finally:
+        reporter.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive several boards and streams from one process.")
+    parser.add_argument("config", help="JSON file listing the streams.")
+    parser.add_argument("--report-every", default=5.0, type=float,
+                        help="Seconds between per-stream status lines.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(args.config))
+    streams = [stream_from_config(c, base_dir) for c in config["streams"]]
+    exporter_from_args(args, [s.metrics for s in streams])
+    try:
+        asyncio.run(run_streams(streams, args.report_every))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+# Vectorized frame encoder shared by the send_* scripts
+#
+# udp_cb in software/main.c expects packets laid out as:
+#   byte 0    - panel enable mask (bit i selects ledpanel instance i)
+#   byte 1    - 0 (see below)
+#   byte 2... - big-endian 32-bit words: (addr << 18) | (c0 << 12) | (c1 << 6) | c2
+# where addr = ((y & 0x3F) << 6) | (x & 0x3F) is local to a 64x64 panel and
+# c0/c1/c2 are the top 6 bits of each color channel. We send 4 lines per packet.
+#
+# Byte 1 is really an opcode, and 0 (OP_ADDRESSED) is the layout above. Since
+# the address only ever counts up through a packet, the other opcodes send it
+# once instead:
+#   byte 0    - panel enable mask
+#   byte 1    - opcode
+#   byte 2-3  - big-endian address of the first pixel
+#   byte 4... - the pixels' colors as one MSB-first bit stream
+# OP_PIXELS18 packs the same 18-bit (c0 << 12) | (c1 << 6) | c2 color, four
+# pixels to 9 bytes, 8 lines per packet. OP_PIXELS12 and OP_PIXELS9 keep only
+# the top 4 or 3 bits of each field (RGB444: two pixels to 3 bytes, 8 lines
+# per packet; RGB333: eight pixels to 9 bytes, 16 lines per packet), and
+# udp_cb widens them back to 6 bits by repeating the top bits.
+#
+# For flat content an OP_PIXELS18 packet can be sent in one of two shorter
+# forms covering the same pixels, whichever is smallest:
+#   OP_RUNS    - after the address, 32-bit big-endian words of
+#                ((run length - 1) << 18) | color
+#   OP_PALETTE - after the address, the index width in bits (1, 2, 4 or 8),
+#                the palette size - 1, the palette as 3-byte big-endian
+#                colors, then one index per pixel packed MSB first
+#
+# A board built with wyrm.py --double-buffer writes all of the above to a
+# back buffer, and only shows it once it gets
+#   OP_PRESENT - just the mask and opcode bytes
+# at which point every masked port switches buffers at the end of its next
+# full scan.
+#
+# Older firmware ignores byte 1, so only send any of these to boards built
+# with the matching udp_cb.
+import hashlib
+import numpy as np
+
+PANEL_SIZE = 64
+LINES_PER_PACKET = 4
+WORDS_PER_PACKET = PANEL_SIZE * LINES_PER_PACKET
+PACKETS_PER_PANEL = PANEL_SIZE // LINES_PER_PACKET
+HEADER_SIZE = 2
+# The header mask has a bit per panel connector, so a board takes at most 8
+MASK_BITS = 8
+PACKET_SIZE = HEADER_SIZE + 4 * WORDS_PER_PACKET
+
+OP_ADDRESSED = 0
+OP_PIXELS18 = 1
+OP_PIXELS12 = 2
+OP_PIXELS9 = 3
+OP_RUNS = 4
+OP_PALETTE = 5
+OP_PRESENT = 6
+OPCODES = {"v1": OP_ADDRESSED, "v2": OP_PIXELS18, "rgb444": OP_PIXELS12, "rgb333": OP_PIXELS9}
+PACKED_HEADER_SIZE = 4
+# opcode -> (bits per channel, lines per packet) for the packed opcodes
+PACKED_LAYOUTS = {
+    OP_PIXELS18: (6, 8),
+    OP_PIXELS12: (4, 8),
+    OP_PIXELS9: (3, 16),
+}
+PALETTE_HEADER_SIZE = PACKED_HEADER_SIZE + 2
+MAX_PALETTE = 256
+
+# Bump whenever encode() output changes for the same input, so anything
+# cached from an older encoder gets rebuilt
+ENCODER_VERSION = 2
+
+# The panels are wired so the three wire fields come out as blue, red, green.
+# These tuples index the frame's channels in wire field order - this is the
+# only place the channel order is decided.
+RGB_ORDER = (2, 0, 1)  # PIL images, cv2 frames after COLOR_BGR2RGB
+BGR_ORDER = (0, 2, 1)  # cv2 frames straight out of VideoCapture
+
+
+def color_depth(opcode):
+    """Bits per channel an opcode carries."""
+    return PACKED_LAYOUTS[opcode][0] if opcode in PACKED_LAYOUTS else 6
+
+
+def present_packet(mask):
+    """The OP_PRESENT packet for the ports in mask."""
+    return bytes((mask, OP_PRESENT))
+
+
+def _channel_shifts(depth):
+    """Where each channel's top depth bits land in the 3 * depth bit color
+    field - (10, 4, -2) for the full 18 bits."""
+    return tuple((2 - field) * depth - (8 - depth) for field in range(3))
+
+
+def color_tables(depth=6, gamma=1.0, white_balance=None):
+    """Lookup tables from 8-bit channel values straight to their bits of the
+    packed color, as a (3, 256) uint32 array indexed by wire field.
+
+    Each entry is the value with gamma (v ** gamma on a 0..1 scale) and
+    white_balance (gains for red, green and blue) applied, cut to its top
+    depth bits and shifted into its field, so encode() costs one gather per
+    channel however much correction goes into the tables. The defaults are
+    plain truncation. The board's gamma_mem still applies on top.
+    """
+    if white_balance is None:
+        white_balance = (1.0, 1.0, 1.0)
+    if len(white_balance) != 3:
+        raise ValueError("white balance needs 3 gains, got %d" % len(white_balance))
+    channel_mask = (0xFF << (8 - depth)) & 0xFF
+    levels = (np.arange(256) / 255.0) ** gamma
+    tables = np.empty((3, 256), dtype=np.uint32)
+    for field, shift in enumerate(_channel_shifts(depth)):
+        # RGB_ORDER says which of red, green, blue each wire field shows
+        gain = white_balance[RGB_ORDER[field]]
+        values = np.clip(np.round(levels * gain * 255), 0, 255).astype(np.uint32) & channel_mask
+        tables[field] = values << shift if shift > 0 else values >> -shift
+    return tables
+
+
+def _index_bits(n_colors):
+    """Palette index width for palettes of n_colors (an array) colors."""
+    return np.select([n_colors <= 2, n_colors <= 4, n_colors <= 16], [1, 2, 4], 8)
+
+
+def _bit_pack_plan(bits):
+    """How to lay bits-wide values out as an MSB-first byte stream.
+
+    Values go in groups of the fewest that fill a whole number of bytes.
+    Returns (values per group, bytes per group, steps), where steps[j] lists
+    (value, right shift, width, left shift) for every piece of a value that
+    lands in byte j of the group.
+    """
+    per_group = 8 // np.gcd(bits, 8)
+    group_bytes = per_group * bits // 8
+    steps = []
+    for j in range(group_bytes):
+        lo, hi = 8 * j, 8 * j + 8
+        pieces = []
+        for i in range(per_group):
+            start, end = max(lo, i * bits), min(hi, (i + 1) * bits)
+            if start < end:
+                pieces.append((i, (i + 1) * bits - end, end - start, hi - end))
+        steps.append(pieces)
+    return per_group, group_bytes, steps
+
+
+class FrameEncoder:
+    """Turns an HxWx3 uint8 frame into the packets of every 64x64 segment.
+
+    Segments are numbered row-major across the frame, which matches the
+    1 << i panel masks used by the 128x128 senders, so it covers at most
+    MASK_BITS panels; bigger canvases need a wall geometry. All buffers are allocated
+    once: every packet of a frame lives in one contiguous uint8 matrix of shape
+    (segments, packets_per_segment, packet_size), and encode() overwrites the
+    payloads in place through a big-endian word view of it, which it returns.
+
+    For layouts that aren't a plain grid (see panel_geometry.py) pass
+    pixel_index, a (segments, 64, 64) array giving for every panel pixel the
+    flat index y * width + x of the frame pixel it shows. The whole frame is
+    then pulled into panel order with one gather per channel.
+
+    opcode picks the packet layout (see the top of this file). With a packed
+    opcode, encode() returns a uint8 view of the payloads instead of words.
+
+    compress (OP_PIXELS18 only) sends each packet as runs or palette indices
+    instead when that's shorter. Packets then vary in length: lengths gives
+    the number of bytes of each row of packet_matrix() to send.
+
+    gamma and white_balance are folded into the color_tables() every channel
+    goes through on its way into the packed color.
+    """
+
+    def __init__(self, width=PANEL_SIZE, height=PANEL_SIZE, channel_order=RGB_ORDER,
+                 pixel_index=None, opcode=OP_ADDRESSED, compress=False,
+                 gamma=1.0, white_balance=None):
+        self.width = width
+        self.height = height
+        self.channel_order = channel_order
+        self.pixel_index = pixel_index
+        if opcode != OP_ADDRESSED and opcode not in PACKED_LAYOUTS:
+            raise ValueError("unknown opcode %d" % opcode)
+        if compress and opcode != OP_PIXELS18:
+            raise ValueError("compression needs OP_PIXELS18 packets")
+        self.opcode = opcode
+        self.compress = compress
+        self.depth = color_depth(opcode)
+        self.gamma = gamma
+        self.white_balance = white_balance
+        self.color_tables = color_tables(self.depth, gamma, white_balance)
+        if pixel_index is None:
+            if width % PANEL_SIZE or height % PANEL_SIZE:
+                raise ValueError("frame size must be a multiple of %d, got %dx%d"
+                                 % (PANEL_SIZE, width, height))
+            self.segments_x = width // PANEL_SIZE
+            self.segments_y = height // PANEL_SIZE
+            self.num_segments = self.segments_x * self.segments_y
+            if self.num_segments > MASK_BITS:
+                raise ValueError("%dx%d is %d panels, but there are at most %d panels per board; "
+                                 "use a wall geometry" % (width, height, self.num_segments, MASK_BITS))
+            self.segment_offsets = [(sy * PANEL_SIZE, sx * PANEL_SIZE)
+                                    for sy in range(self.segments_y)
+                                    for sx in range(self.segments_x)]
+            tile_shape = (self.segments_y, self.segments_x, PANEL_SIZE, PANEL_SIZE)
+        else:
+            pixel_index = np.asarray(pixel_index, dtype=np.intp)
+            if pixel_index.ndim != 3 or pixel_index.shape[1:] != (PANEL_SIZE, PANEL_SIZE):
+                raise ValueError("pixel_index must have shape (segments, %d, %d), got %s"
+                                 % (PANEL_SIZE, PANEL_SIZE, pixel_index.shape))
+            if pixel_index.min() < 0 or pixel_index.max() >= width * height:
+                raise ValueError("pixel_index points outside the %dx%d frame" % (width, height))
+            self.pixel_index = pixel_index
+            self.num_segments = len(pixel_index)
+            self.segment_offsets = None
+            tile_shape = pixel_index.shape
+            self._gathered = np.empty(tile_shape, dtype=np.uint8)
+
+        # Addresses are local to each segment, so one table serves all of them
+        y, x = np.meshgrid(np.arange(PANEL_SIZE), np.arange(PANEL_SIZE), indexing='ij')
+        self._addr = ((((y & 0x3F) << 6) | (x & 0x3F)) << 18).astype(np.uint32)
+
+        self._packed = np.empty(tile_shape, dtype=np.uint32)
+        self._chan = np.empty(tile_shape, dtype=np.uint32)
+        if opcode == OP_ADDRESSED:
+            self.header_size = HEADER_SIZE
+            self.lines_per_packet = LINES_PER_PACKET
+            payload_size = 4 * WORDS_PER_PACKET
+        else:
+            depth, self.lines_per_packet = PACKED_LAYOUTS[opcode]
+            self.bits = 3 * depth
+            self.header_size = PACKED_HEADER_SIZE
+            payload_size = PANEL_SIZE * self.lines_per_packet * self.bits // 8
+        self.packets_per_segment = PANEL_SIZE // self.lines_per_packet
+        self.packet_size = self.header_size + payload_size
+        self.packets = np.zeros((self.num_segments, self.packets_per_segment, self.packet_size),
+                                dtype=np.uint8)
+        self.payload = self.packets[:, :, self.header_size:]
+        if opcode == OP_ADDRESSED:
+            self.words = self.payload.view('>u4')
+            self.payload = self.words
+        else:
+            per_group, group_bytes, self._pack_steps = _bit_pack_plan(self.bits)
+            pixels_per_packet = PANEL_SIZE * self.lines_per_packet
+            self._groups = self._packed.reshape(self.num_segments, self.packets_per_segment,
+                                                pixels_per_packet // per_group, per_group)
+            self._group_bytes = self.payload.reshape(self._groups.shape[:3] + (group_bytes,))
+            self._piece = np.empty(self._groups.shape[:3], dtype=np.uint32)
+            self._byte = np.empty(self._groups.shape[:3], dtype=np.uint32)
+            # Each packet starts where the previous one left off
+            start = np.arange(self.packets_per_segment) * pixels_per_packet
+            self.packets[:, :, 2] = (start >> 8)[None, :]
+            self.packets[:, :, 3] = (start & 0xFF)[None, :]
+
+        self.lengths = None
+        if compress:
+            self.lengths = np.full(self.num_segments * self.packets_per_segment,
+                                   self.packet_size, dtype=np.intp)
+            self._colors = self._packed.reshape(len(self.lengths), -1)
+            # Whatever follows a short packet is left over from the OP_PIXELS18
+            # version of the same pixels, so the whole row past the mask still
+            # only changes when the pixels do
+            self.payload = self.packets[:, :, 1:]
+            self.packets[:, :, 1] = opcode
+        # An index map comes with its own masks (see WallGeometry.masks)
+        if pixel_index is None:
+            self.set_masks(self.default_masks())
+
+    def _tiles(self, plane):
+        # (H, W) -> (segments_y, segments_x, 64, 64) without copying
+        return plane.reshape(self.segments_y, PANEL_SIZE,
+                             self.segments_x, PANEL_SIZE).swapaxes(1, 2)
+
+    def _segment_pixels(self, frame, channel):
+        if self.pixel_index is None:
+            return self._tiles(frame[:, :, channel])
+        pixels = frame.reshape(-1, frame.shape[2])
+        np.take(pixels[:, channel], self.pixel_index, out=self._gathered)
+        return self._gathered
+
+    def layout_key(self):
+        """A string that changes whenever the same frame would encode differently."""
+        h = hashlib.sha1()
+        h.update(("%dx%d;%s;op%d%s;v%d" % (self.width, self.height, self.channel_order,
+                                           self.opcode, "c" if self.compress else "",
+                                           ENCODER_VERSION)).encode())
+        if self.pixel_index is not None:
+            h.update(self.pixel_index.tobytes())
+        h.update(self.color_tables.tobytes())
+        # Only the masks: byte 1 is the opcode, already in the string above,
+        # except with compress, where it's whatever the last frame picked
+        h.update(self.packets[:, 0, 0].tobytes())
+        return h.hexdigest()
+
+    def encode(self, frame):
+        frame = np.asarray(frame)
+        if frame.shape[:2] != (self.height, self.width) or frame.ndim != 3:
+            raise ValueError("expected a %dx%dx3 frame, got %s"
+                             % (self.height, self.width, frame.shape))
+
+        if self.opcode == OP_ADDRESSED:
+            self._packed[...] = self._addr
+        else:
+            self._packed[...] = 0
+        for table, channel in zip(self.color_tables, self.channel_order):
+            # uint8 values can't leave the table, and without the default
+            # bounds check take() doesn't buffer out
+            np.take(table, self._segment_pixels(frame, channel), out=self._chan, mode='clip')
+            self._packed |= self._chan
+
+        if self.opcode != OP_ADDRESSED:
+            self._pack_bits()
+            if self.compress:
+                self._compress()
+            return self.payload
+
+        # The big-endian destination does the htonl for us on copy
+        np.copyto(self.words, self._packed.reshape(self.words.shape))
+        return self.words
+
+    def _pack_bits(self):
+        # Build each byte of every group at once from the pieces of the
+        # values that land in it
+        for j, pieces in enumerate(self._pack_steps):
+            self._byte[...] = 0
+            for i, rshift, width, lshift in pieces:
+                np.right_shift(self._groups[..., i], rshift, out=self._piece)
+                self._piece &= (1 << width) - 1
+                self._piece <<= lshift
+                self._byte |= self._piece
+            self._group_bytes[..., j] = self._byte
+
+    def _compress(self):
+        colors = self._colors
+        rows = self.packet_matrix()
+        n_pixels = colors.shape[1]
+
+        # Count runs and distinct colors in every packet at once
+        change = colors[:, 1:] != colors[:, :-1]
+        n_runs = change.sum(axis=1) + 1
+        order = np.argsort(colors, axis=1, kind='stable')
+        ranked = np.take_along_axis(colors, order, axis=1)
+        new_color = ranked[:, 1:] != ranked[:, :-1]
+        n_colors = new_color.sum(axis=1) + 1
+        index_bits = _index_bits(n_colors)
+
+        run_size = PACKED_HEADER_SIZE + 4 * n_runs
+        palette_size = PALETTE_HEADER_SIZE + 3 * n_colors + n_pixels * index_bits // 8
+        palette_size[n_colors > MAX_PALETTE] = self.packet_size
+        use_runs = run_size < np.minimum(palette_size, self.packet_size)
+        use_palette = ~use_runs & (palette_size < self.packet_size)
+
+        rows[:, 1] = OP_PIXELS18
+        self.lengths[:] = self.packet_size
+        for p in np.flatnonzero(use_runs):
+            starts = np.flatnonzero(np.concatenate(([True], change[p])))
+            run_words = ((np.diff(np.append(starts, n_pixels)) - 1) << 18) | colors[p, starts]
+            end = PACKED_HEADER_SIZE + 4 * len(starts)
+            rows[p, PACKED_HEADER_SIZE:end] = run_words.astype('>u4').view(np.uint8)
+            rows[p, 1] = OP_RUNS
+            self.lengths[p] = end
+        for p in np.flatnonzero(use_palette):
+            first = np.concatenate(([True], new_color[p]))
+            palette = ranked[p, first]
+            index = np.empty(n_pixels, dtype=np.uint32)
+            index[order[p]] = np.cumsum(first) - 1
+            bits = int(index_bits[p])
+            per_byte = 8 // bits
+            shifts = np.arange(8 - bits, -1, -bits, dtype=np.uint32)
+            packed = (index.reshape(-1, per_byte) << shifts).sum(axis=1)
+
+            end = PALETTE_HEADER_SIZE + 3 * len(palette)
+            rows[p, PACKED_HEADER_SIZE] = bits
+            rows[p, PACKED_HEADER_SIZE + 1] = len(palette) - 1
+            rows[p, PALETTE_HEADER_SIZE:end] = \
+                palette.astype('>u4').view(np.uint8).reshape(-1, 4)[:, 1:].ravel()
+            rows[p, end:end + len(packed)] = packed
+            rows[p, 1] = OP_PALETTE
+            self.lengths[p] = end + len(packed)
+
+    def default_masks(self):
+        return [1 << i for i in range(self.num_segments)]
+
+    def set_masks(self, masks):
+        """Set the header byte (panel enable mask) for each segment's packets."""
+        if len(masks) != self.num_segments:
+            raise ValueError("need one mask per segment, got %d for %d segments"
+                             % (len(masks), self.num_segments))
+        self.packets[:, :, 0] = np.asarray(masks, dtype=np.uint8)[:, None]
+        # Compressed packets pick their own opcode each frame
+        if not self.compress:
+            self.packets[:, :, 1] = self.opcode
+
+    def packet_matrix(self):
+        """All packets of the frame as one (n_packets, packet_size) view."""
+        return self.packets.reshape(-1, self.packet_size)
+
+    def packets_iter(self, masks=None):
+        """Yield (segment, packet memoryview) for the most recently encoded frame.
+
+        The views point into the packet matrix, so they are only valid until
+        the next encode(). masks, if given, replaces the per-segment header
+        bytes first.
+        """
+        if masks is not None:
+            self.set_masks(masks)
+        for seg in range(self.num_segments):
+            for pkt in range(self.packets_per_segment):
+                view = memoryview(self.packets[seg, pkt])
+                if self.lengths is not None:
+                    view = view[:self.lengths[seg * self.packets_per_segment + pkt]]
+                yield seg, view
@@ -0,0 +1,128 @@
+# Panel-wall geometry
+#
+# Describes which Colorlight boards make up a display, which connector (ledpanel
+# instance, i.e. header mask bit) each 64x64 panel hangs off, and where on the
+# canvas that panel sits. From that we precompute one pixel index map so a
+# FrameEncoder can pull the whole canvas apart into every board's packets in a
+# single gather per channel.
+#
+# A wall is described in JSON:
+#
+#   {
+#     "width": 256, "height": 128,
+#     "boards": [
+#       {"ip": "192.168.10.30", "port": 1234,
+#        "panels": [{"connector": 0, "x": 0,  "y": 0},
+#                   {"connector": 1, "x": 64, "y": 0, "rotation": 180}]},
+#       {"ip": "192.168.10.31",
+#        "panels": [{"connector": 0, "x": 128, "y": 0}]}
+#     ]
+#   }
+#
+# rotation is how far, in degrees clockwise, the panel's 64x64 region of the
+# canvas is turned before it is sent - use it for panels mounted on their side
+# or upside down.
+import json
+import numpy as np
+
+from panel_encoder import FrameEncoder, PANEL_SIZE, RGB_ORDER, OP_ADDRESSED
+
+UDP_IP = '192.168.10.30'
+UDP_PORT = 1234
+
+# The header mask has a bit for each of the 5A-75B's eight connectors, though
+# BaseSoC in wyrm.py only fits four ledpanel instances (two double-buffered)
+CONNECTORS_PER_BOARD = 8
+
+
+class Panel:
+    def __init__(self, connector, x, y, rotation=0):
+        if not 0 <= connector < CONNECTORS_PER_BOARD:
+            raise ValueError("connector must be 0-%d, got %d" % (CONNECTORS_PER_BOARD - 1, connector))
+        if rotation % 90:
+            raise ValueError("rotation must be a multiple of 90 degrees, got %d" % rotation)
+        self.connector = connector
+        self.x = x
+        self.y = y
+        self.rotation = rotation % 360
+
+    @property
+    def mask(self):
+        return 1 << self.connector
+
+
+class Board:
+    def __init__(self, ip=UDP_IP, port=UDP_PORT, panels=()):
+        self.ip = ip
+        self.port = port
+        self.panels = list(panels)
+        connectors = [p.connector for p in self.panels]
+        if len(set(connectors)) != len(connectors):
+            raise ValueError("board %s:%d uses a connector twice" % (ip, port))
+
+    @property
+    def addr(self):
+        return (self.ip, self.port)
+
+
+class WallGeometry:
+    def __init__(self, width, height, boards):
+        self.width = width
+        self.height = height
+        self.boards = list(boards)
+        for board in self.boards:
+            for panel in board.panels:
+                if (panel.x < 0 or panel.y < 0 or panel.x + PANEL_SIZE > width
+                        or panel.y + PANEL_SIZE > height):
+                    raise ValueError("panel at (%d, %d) doesn't fit on the %dx%d canvas"
+                                     % (panel.x, panel.y, width, height))
+
+    @classmethod
+    def grid(cls, width, height, ip=UDP_IP, port=UDP_PORT):
+        """The layout the 128x128 scripts have always used: one board, panels
+        row-major across the canvas on connectors 0, 1, 2..."""
+        panels = [Panel(i, x, y)
+                  for i, (y, x) in enumerate((y, x)
+                                             for y in range(0, height, PANEL_SIZE)
+                                             for x in range(0, width, PANEL_SIZE))]
+        return cls(width, height, [Board(ip, port, panels)])
+
+    @classmethod
+    def from_dict(cls, config):
+        boards = [Board(b.get("ip", UDP_IP), b.get("port", UDP_PORT),
+                        [Panel(p["connector"], p["x"], p["y"], p.get("rotation", 0))
+                         for p in b["panels"]])
+                  for b in config["boards"]]
+        return cls(config["width"], config["height"], boards)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def panels(self):
+        for board in self.boards:
+            for panel in board.panels:
+                yield board, panel
+
+    def pixel_index(self):
+        """(panels, 64, 64) flat canvas indices, in board order then panel order."""
+        canvas = np.arange(self.width * self.height, dtype=np.intp).reshape(self.height, self.width)
+        index = np.empty((sum(len(b.panels) for b in self.boards), PANEL_SIZE, PANEL_SIZE),
+                         dtype=np.intp)
+        for i, (_, panel) in enumerate(self.panels()):
+            region = canvas[panel.y:panel.y + PANEL_SIZE, panel.x:panel.x + PANEL_SIZE]
+            index[i] = np.rot90(region, -(panel.rotation // 90))
+        return index
+
+    def masks(self):
+        return [panel.mask for _, panel in self.panels()]
+
+    def links(self):
+        """(address, number of segments) for each board, in encoder segment order."""
+        return [(board.addr, len(board.panels)) for board in self.boards]
+
+    def encoder(self, channel_order=RGB_ORDER, opcode=OP_ADDRESSED, compress=False, **kwargs):
+        return FrameEncoder(self.width, self.height, channel_order=channel_order,
+                            pixel_index=self.pixel_index(), opcode=opcode, compress=compress,
+                            **kwargs)
@@ -0,0 +1,173 @@
+# Raw frame ingest for live sources
+#
+# OpenCV wants a file or URL it can demux and decode, but a live source
+# (ffmpeg -f rawvideo, a renderer, a camera process) can just as well hand
+# over finished frames: width * height * 3 bytes of RGB (or BGR) each, rows
+# top to bottom. The readers here fill one preallocated frame array in
+# place, so the only per-frame work left for the sender is packing and
+# sending.
+#
+# RawFrameReader reads frames back to back from stdin, a FIFO or a file,
+# readinto() straight into the frame's memory.
+#
+# SharedFrameReader takes the newest frame from a named shared memory
+# segment written by a SharedFrameWriter. Segment layout (native byte order):
+#   uint64 sequence - odd while a frame is being written, bumped by 2 per frame
+#   uint32 width, height, flags (FLAG_CLOSED once the writer is done)
+#   frame bytes at HEADER_SIZE
+# The reader copies the frame out and checks the sequence didn't move
+# meanwhile, so it never sends a half-written frame. Frames written while
+# the sender was busy are skipped rather than queued.
+import os
+import stat
+import sys
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+HEADER_SIZE = 64
+FLAG_CLOSED = 1
+# Seconds between looks at the sequence while waiting for a new frame
+SHM_POLL = 0.0005
+SHM_PREFIX = "shm:"
+
+
+class RawFrameReader:
+    """Reads width x height x 3 frames from a binary stream. read() returns
+    the same frame array every time, refilled, or None at the end of the
+    stream (a trailing partial frame is discarded)."""
+
+    def __init__(self, stream, width, height):
+        self.width = width
+        self.height = height
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+        self._view = memoryview(self.frame).cast("B")
+        self._stream = stream
+        self.skipped = 0
+        _grow_pipe(stream, len(self._view))
+
+    def read(self):
+        size = len(self._view)
+        got = 0
+        while got < size:
+            n = self._stream.readinto(self._view[got:])
+            if not n:
+                return None
+            got += n
+        return self.frame
+
+    def close(self):
+        self._stream.close()
+
+
+def _grow_pipe(stream, size):
+    """Make a pipe hold at least a whole frame, so a frame takes one read
+    instead of one per 64 KiB."""
+    try:
+        import fcntl
+        fd = stream.fileno()
+        if hasattr(fcntl, "F_SETPIPE_SZ") and stat.S_ISFIFO(os.fstat(fd).st_mode):
+            if fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ) < size:
+                fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except (ImportError, OSError, ValueError):
+        # Not a pipe, not Linux, or over /proc/sys/fs/pipe-max-size
+        pass
+
+
+def _header(buf):
+    """Views of a segment's sequence and (width, height, flags)."""
+    return (np.ndarray((1,), dtype=np.uint64, buffer=buf),
+            np.ndarray((3,), dtype=np.uint32, buffer=buf, offset=8))
+
+
+class SharedFrameReader:
+    """Reads the newest frame from a SharedFrameWriter's segment. read()
+    waits for a frame newer than the last one, returns the same frame array
+    every time, or None once the writer has closed. skipped counts frames
+    that were overwritten before they could be read."""
+
+    def __init__(self, name, width, height):
+        self.shm = _attach(name)
+        self._sequence, self._info = _header(self.shm.buf)
+        if tuple(int(v) for v in self._info[:2]) != (width, height):
+            raise ValueError("shared memory %s holds %dx%d frames, expected %dx%d"
+                             % (name, self._info[0], self._info[1], width, height))
+        self.width = width
+        self.height = height
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+        self._source = np.ndarray(self.frame.shape, dtype=np.uint8, buffer=self.shm.buf,
+                                  offset=HEADER_SIZE)
+        self.last = None
+        self.skipped = 0
+
+    def read(self):
+        while True:
+            sequence = int(self._sequence[0])
+            if sequence == self.last or sequence == 0 or sequence & 1:
+                # Nothing new (yet), or a frame being written
+                if self._info[2] & FLAG_CLOSED:
+                    return None
+                time.sleep(SHM_POLL)
+                continue
+            np.copyto(self.frame, self._source)
+            if int(self._sequence[0]) == sequence:
+                break
+        if self.last is not None:
+            self.skipped += (sequence - self.last) // 2 - 1
+        self.last = sequence
+        return self.frame
+
+    def close(self):
+        del self._sequence, self._info, self._source
+        self.shm.close()
+
+
+def _attach(name):
+    """Open an existing segment without this process unlinking it at exit."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 every attach registers with the resource tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedFrameWriter:
+    """Publishes frames to a new named shared memory segment for a
+    SharedFrameReader. close() tells the reader there are no more frames and
+    unlinks the segment."""
+
+    def __init__(self, name, width, height):
+        self.width = width
+        self.height = height
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=HEADER_SIZE + width * height * 3)
+        self._sequence, self._info = _header(self.shm.buf)
+        self._sequence[0] = 0
+        self._info[:] = (width, height, 0)
+        self._target = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self.shm.buf,
+                                  offset=HEADER_SIZE)
+
+    def write(self, frame):
+        self._sequence[0] += 1
+        np.copyto(self._target, frame)
+        self._sequence[0] += 1
+
+    def close(self):
+        self._info[2] |= FLAG_CLOSED
+        del self._sequence, self._info, self._target
+        self.shm.close()
+        self.shm.unlink()
+
+
+def open_frames(source, width, height):
+    """A reader for source: "-" for stdin, "shm:NAME" for a shared memory
+    segment, or the path of a FIFO or raw video file."""
+    if source == "-":
+        return RawFrameReader(os.fdopen(sys.stdin.fileno(), "rb", buffering=0, closefd=False),
+                              width, height)
+    if source.startswith(SHM_PREFIX):
+        return SharedFrameReader(source[len(SHM_PREFIX):], width, height)
+    return RawFrameReader(open(source, "rb", buffering=0), width, height)
+
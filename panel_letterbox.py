@@ -0,0 +1,64 @@
+# Resize and letterbox stage for the senders
+#
+# Every source frame has to be scaled onto the canvas keeping its aspect
+# ratio, with black bars filling the rest. Doing that with cv2.resize and
+# cv2.copyMakeBorder (or PIL.ImageOps.pad) allocates a new image or two for
+# every frame. A Letterbox works out the scaled size and the bars once, for
+# the first frame's size, and from then on resizes straight into the
+# scaled region of a persistent canvas with cv2.resize(dst=...). The bars
+# are never written, so they stay black from when the canvas was allocated.
+#
+# Downscaling by 2 or more uses area interpolation, which averages every
+# source pixel instead of sampling a few and aliasing; anything closer to
+# the canvas size uses bilinear.
+import numpy as np
+import cv2
+
+# Scale factor at or below which area interpolation is used
+AREA_BELOW = 0.5
+
+
+class Letterbox:
+    """Scales width x height frames onto a fixed canvas_size = (width, height)
+    canvas. Calling it with a frame returns the canvas, or the frame itself
+    if it is already the canvas size.
+
+    interpolation overrides the cv2.INTER_* flag picked from the scale.
+    """
+
+    def __init__(self, size, canvas_size, interpolation=None, channels=3):
+        width, height = size
+        canvas_width, canvas_height = canvas_size
+        self.size = size
+        self.canvas_size = canvas_size
+        ratio = min(float(canvas_width)/width, float(canvas_height)/height)
+        self.scaled = (int(width*ratio), int(height*ratio))
+        self.top = (canvas_height - self.scaled[1])//2
+        self.left = (canvas_width - self.scaled[0])//2
+        if interpolation is None:
+            interpolation = cv2.INTER_AREA if ratio <= AREA_BELOW else cv2.INTER_LINEAR
+        self.interpolation = interpolation
+        self.passthrough = tuple(size) == tuple(canvas_size)
+
+        self.canvas = np.zeros((canvas_height, canvas_width, channels), dtype=np.uint8)
+        self._region = self.region(self.canvas)
+
+    @classmethod
+    def for_frame(cls, frame, canvas_size, **kwargs):
+        """A Letterbox sized for frames shaped like frame."""
+        return cls((frame.shape[1], frame.shape[0]), canvas_size, channels=frame.shape[2], **kwargs)
+
+    def region(self, canvas):
+        """The view of canvas the scaled frame goes into."""
+        return canvas[self.top:self.top+self.scaled[1], self.left:self.left+self.scaled[0]]
+
+    def __call__(self, frame, out=None):
+        """Scale frame onto the canvas, or onto out (another canvas-sized
+        array whose bars are already black) if given, and return it."""
+        if out is None:
+            if self.passthrough:
+                return frame
+            cv2.resize(frame, self.scaled, dst=self._region, interpolation=self.interpolation)
+            return self.canvas
+        cv2.resize(frame, self.scaled, dst=self.region(out), interpolation=self.interpolation)
+        return out
@@ -0,0 +1,208 @@
+# Per-stage timing and counters for the senders
+#
+# When a display stutters, the time could be going anywhere: decoding,
+# resizing, packing, the send calls, or sleeping on the pacer or the frame
+# clock. Metrics times each stage of a send loop into a histogram with
+# fixed log-spaced buckets (four per decade, 10 us to 10 s), and counts
+# frames, packets, bytes and send errors. Recording a stage costs a
+# perf_counter(), a bisect and a few additions, so it is always on.
+#
+# A MetricsExporter writes everything out every interval seconds, as either
+# or both of:
+#   - JSON lines: per stage, the count, mean, p50/p95/p99 and max over the
+#     last interval, plus every counter with its rate over the interval
+#   - a Prometheus text file with the cumulative histograms and counters.
+#     It is replaced atomically each time, for node_exporter's textfile
+#     collector.
+import atexit
+import bisect
+import json
+import os
+import time
+
+# Upper bounds in seconds of every histogram bucket but the last, which
+# takes everything slower
+BUCKETS = tuple(1e-5 * 10 ** (i / 4.0) for i in range(25))
+PREFIX = "wyrm"
+QUANTILES = (50, 95, 99)
+
+
+class Histogram:
+    """Counts of durations per bucket. counts[i] counts values up to
+    bounds[i], the last entry everything above the last bound. max is the
+    largest value since the exporter last reset it."""
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return list(self.counts), self.count, self.sum
+
+
+def quantile(bounds, counts, q):
+    """Estimate the q quantile (0..1) from per-bucket counts, interpolating
+    within the bucket it falls in."""
+    total = sum(counts)
+    target = q * total
+    seen = 0
+    for i, n in enumerate(counts):
+        if n and seen + n >= target:
+            low = bounds[i - 1] if i > 0 else 0.0
+            high = bounds[i] if i < len(bounds) else low
+            return low + (high - low) * (target - seen) / n
+        seen += n
+    return 0.0
+
+
+class Metrics:
+    """Stage histograms and counters for one sender or stream. labels (e.g.
+    {"stream": name}) tell several apart in the exported metrics."""
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.stages = {}
+        self.counters = {}
+        self.exporter = None
+
+    def observe(self, stage, seconds):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = Histogram()
+        hist.observe(seconds)
+
+    def since(self, stage, start):
+        """Record the time from start (a time.perf_counter() value) as
+        stage, and return now for the next stage to start from."""
+        now = time.perf_counter()
+        self.observe(stage, now - start)
+        return now
+
+    def add(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def tick(self):
+        """Export if the exporter is due, once per frame."""
+        if self.exporter is not None:
+            self.exporter.maybe_export()
+
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                             for k, v in items)
+
+
+class MetricsExporter:
+    """Writes out a list of Metrics every interval seconds, as JSON lines
+    appended to jsonl and/or a Prometheus text file at prometheus."""
+
+    def __init__(self, metrics, jsonl=None, prometheus=None, interval=10.0, clock=time.monotonic):
+        self.metrics = list(metrics)
+        self.jsonl = jsonl
+        self.prometheus = prometheus
+        self.interval = interval
+        self._clock = clock
+        self._last = clock()
+        # What each Metrics held at the last export, for the interval stats
+        self._previous = {}
+        for m in self.metrics:
+            m.exporter = self
+
+    def maybe_export(self):
+        if self._clock() - self._last >= self.interval:
+            self.export()
+
+    def export(self):
+        now = self._clock()
+        elapsed, self._last = now - self._last, now
+        if self.jsonl is not None:
+            lines = "".join(json.dumps(self.interval_stats(m, elapsed)) + "\n" for m in self.metrics)
+            with open(self.jsonl, 'a') as f:
+                f.write(lines)
+        if self.prometheus is not None:
+            tmp_path = self.prometheus + ".tmp%d" % os.getpid()
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.prometheus)
+        for m in self.metrics:
+            self._previous[id(m)] = ({name: hist.snapshot() for name, hist in m.stages.items()},
+                                     dict(m.counters))
+            for hist in m.stages.values():
+                hist.max = 0.0
+
+    def interval_stats(self, m, elapsed):
+        """One JSON line's worth: counters, their rates and stage timings in
+        milliseconds over the elapsed seconds since the last export."""
+        stages, counters = self._previous.get(id(m), ({}, {}))
+        stats = {"time": time.time(), "interval": elapsed}
+        stats.update(m.labels)
+        for name, value in sorted(m.counters.items()):
+            stats[name] = value
+            stats[name + "_per_s"] = (value - counters.get(name, 0)) / elapsed if elapsed > 0 else 0.0
+        stats["stages"] = {}
+        for name, hist in sorted(m.stages.items()):
+            counts, count, total = stages.get(name, (None, 0, 0.0))
+            n = hist.count - count
+            if not n:
+                continue
+            window = hist.counts if counts is None else [a - b for a, b in zip(hist.counts, counts)]
+            stage = {"count": n, "mean_ms": 1e3 * (hist.sum - total) / n}
+            for q in QUANTILES:
+                stage["p%d_ms" % q] = 1e3 * min(quantile(hist.bounds, window, q / 100.0), hist.max)
+            stage["max_ms"] = 1e3 * hist.max
+            stats["stages"][name] = stage
+        return stats
+
+    def prometheus_text(self):
+        lines = ["# HELP %s_stage_seconds Time spent in each stage of the send loop." % PREFIX,
+                 "# TYPE %s_stage_seconds histogram" % PREFIX]
+        for m in self.metrics:
+            for name, hist in sorted(m.stages.items()):
+                cumulative = 0
+                for bound, n in zip(hist.bounds + (float("inf"),), hist.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else "%.6g" % bound
+                    lines.append("%s_stage_seconds_bucket%s %d"
+                                 % (PREFIX, _labels(m.labels, stage=name, le=le), cumulative))
+                lines.append("%s_stage_seconds_sum%s %.9g" % (PREFIX, _labels(m.labels, stage=name), hist.sum))
+                lines.append("%s_stage_seconds_count%s %d" % (PREFIX, _labels(m.labels, stage=name), hist.count))
+        for counter in sorted(set(c for m in self.metrics for c in m.counters)):
+            lines.append("# TYPE %s_%s_total counter" % (PREFIX, counter))
+            for m in self.metrics:
+                if counter in m.counters:
+                    lines.append("%s_%s_total%s %d" % (PREFIX, counter, _labels(m.labels),
+                                                       m.counters[counter]))
+        return "\n".join(lines) + "\n"
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics-jsonl", default=None,
+                        help="Append per-stage timings and counters to this file as JSON lines.")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="Keep the same in this Prometheus text file "
+                             "(e.g. for node_exporter's textfile collector).")
+    parser.add_argument("--metrics-interval", default=10.0, type=float,
+                        help="Seconds between metrics exports.")
+
+
+def exporter_from_args(args, metrics):
+    """The exporter the command line asks for (or None), which also exports
+    once more when the process exits."""
+    if args.metrics_jsonl is None and args.metrics_prom is None:
+        return None
+    exporter = MetricsExporter(metrics, args.metrics_jsonl, args.metrics_prom, args.metrics_interval)
+    atexit.register(exporter.export)
+    return exporter
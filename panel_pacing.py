@@ -0,0 +1,193 @@
+# Packet pacing for the senders
+#
+# udp_cb on the board does four CSR writes per pixel and drops packets when
+# they arrive faster than it can drain them. Rather than sleeping a fixed
+# amount after every packet, the senders draw from a token bucket refilled at
+# a packets-per-second budget, and can optionally let a RateTuner move that
+# budget up until a loss signal says we went too far. When even the best
+# budget can't carry the frame rate we want, a DepthGovernor picks a cheaper
+# packet format (fewer bits per pixel) instead.
+import time
+
+# Packets per second that the old fixed 0.5 ms sleep after every packet
+# worked out to, the fastest rate known to keep up with udp_cb. The board
+# doesn't report the packets it drops, so a RateTuner fed only the host's
+# own send errors won't see loss before the link fails outright, and
+# stops here unless told otherwise.
+SAFE_RATE = 2000
+# Packets a TokenBucket lets out back to back, as in --burst
+BURST = 4
+
+
+class TokenBucket:
+    """Classic token bucket: rate tokens per second, at most burst banked.
+
+    A rate of 0 (or less) disables pacing entirely.
+    """
+
+    def __init__(self, rate, burst=BURST, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(self.burst)
+        self._last = clock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = float(rate)
+
+    def _refill(self):
+        now = self._clock()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self, n=1):
+        """Seconds until n tokens (capped at burst) will be available."""
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        n = min(n, self.burst)
+        return max(0.0, (n - self._tokens) / self.rate)
+
+    def take(self, n=1):
+        """Take up to burst tokens without waiting, returns how many were taken."""
+        if not self.enabled:
+            return n
+        n = min(n, self.burst)
+        self._refill()
+        self._tokens -= n
+        return n
+
+    def acquire(self, n=1):
+        """Block until n tokens are available and take them.
+
+        Returns how many were taken, which is capped at burst so callers can
+        loop over big batches in burst-sized chunks.
+        """
+        delay = self.wait_time(n)
+        if delay > 0:
+            self._sleep(delay)
+        return self.take(n)
+
+
+class RateTuner:
+    """Probes for the highest packet rate that doesn't lose packets.
+
+    loss_fn returns a running count of lost packets. Every interval seconds
+    the tuner looks at how much it grew: no loss raises the rate (by a factor
+    until the first loss is seen, then in small additive steps), any loss
+    backs off multiplicatively. The rate never goes above max_rate, which
+    should only be raised for a loss_fn that sees what the board drops.
+    """
+
+    def __init__(self, bucket, loss_fn, min_rate=500, max_rate=SAFE_RATE,
+                 increase=1.25, step=100, backoff=0.7, interval=1.0,
+                 clock=time.monotonic):
+        self.bucket = bucket
+        self.loss_fn = loss_fn
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.step = step
+        self.backoff = backoff
+        self.interval = interval
+        self._clock = clock
+
+        # The last rate that ran a whole interval clean, and the last one that lost packets
+        self.good_rate = None
+        self.loss_rate = None
+        self._last_check = clock()
+        self._last_loss = loss_fn()
+        if not bucket.enabled:
+            bucket.set_rate(min_rate)
+
+    def update(self):
+        """Call once per frame; adjusts the bucket's rate when an interval has passed."""
+        now = self._clock()
+        if now - self._last_check < self.interval:
+            return self.bucket.rate
+        self._last_check = now
+
+        loss = self.loss_fn()
+        lost = loss - self._last_loss
+        self._last_loss = loss
+
+        rate = self.bucket.rate
+        if lost > 0:
+            self.loss_rate = rate
+            rate *= self.backoff
+        else:
+            self.good_rate = rate
+            if self.loss_rate is None:
+                rate *= self.increase
+            else:
+                rate += self.step
+        self.bucket.set_rate(min(self.max_rate, max(self.min_rate, rate)))
+        return self.bucket.rate
+
+
+class DepthGovernor:
+    """Picks the richest of several packet formats that still keeps up with target_fps.
+
+    levels are ordered richest first. Each frame, update() is told how long
+    sending took, what it cost (packets, or bytes - any unit the send time is
+    proportional to) and what a whole frame costs at every level. From that
+    it keeps a running seconds-per-unit figure and predicts how long each
+    level would take. It drops straight to a level that fits as soon as the
+    current one doesn't, but only steps back up one level at a time, once
+    the richer level has fitted for patience frames in a row.
+    """
+
+    def __init__(self, target_fps, levels, headroom=0.85, patience=30, smoothing=0.2):
+        self.budget = 1.0 / target_fps
+        self.levels = list(levels)
+        self.headroom = headroom
+        self.patience = patience
+        self.smoothing = smoothing
+        self.level = 0
+        self.switches = 0
+
+        self._unit_time = None
+        # Fraction of a whole frame actually sent, below 1 in delta mode
+        self._fill = 1.0
+        self._fits_above = 0
+
+    def _smooth(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def predict(self, level, costs):
+        """Seconds a frame at level is expected to take."""
+        if self._unit_time is None:
+            return 0.0
+        return self._unit_time * costs[level] * self._fill
+
+    def update(self, seconds, cost, costs):
+        """Record a frame sent at the current level; returns the level for the next one."""
+        if cost > 0:
+            self._unit_time = self._smooth(self._unit_time, seconds / cost)
+            self._fill = self._smooth(self._fill, cost / costs[self.level])
+
+        level = self.level
+        limit = self.budget * self.headroom
+        if self.predict(level, costs) > self.budget:
+            while level < len(self.levels) - 1 and self.predict(level, costs) > limit:
+                level += 1
+            self._fits_above = 0
+        elif level > 0 and self.predict(level - 1, costs) <= limit:
+            self._fits_above += 1
+            if self._fits_above >= self.patience:
+                level -= 1
+                self._fits_above = 0
+        else:
+            self._fits_above = 0
+
+        if level != self.level:
+            self.level = level
+            self.switches += 1
+        return self.levels[level]
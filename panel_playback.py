@@ -0,0 +1,149 @@
+# Real-time playback pacing for the video senders
+#
+# Sleeping off whatever is left of a frame time after each frame keeps the
+# right pace only while every frame is on time: each late frame pushes every
+# frame after it back, and the video drifts further and further behind its
+# source. PlaybackClock instead ties each frame to its presentation
+# timestamp. The first frame fixes where pts 0 falls on the wall clock, and
+# every later frame is due at its own pts no matter how late the ones before
+# it were. A frame that would go out more than max_late behind, going by how
+# long frames have been taking to get from decode to sent, isn't worth
+# decoding, let alone sending, so the caller skips it and the video stays in
+# sync at whatever frame rate the link can carry.
+import time
+import numpy as np
+
+# Default for how far behind its pts a frame may be and still be shown
+MAX_LATE = 0.05
+# Weight of the newest frame in the running average of frame cost
+COST_WEIGHT = 0.25
+
+
+class PlaybackClock:
+    """Paces frames off their presentation timestamps (in seconds).
+
+    For each frame: drop(pts) says whether to skip it, wait(pts) sleeps
+    until it's due, and shown(pts) records it once it has gone out. frames,
+    dropped and late count frames shown, skipped, and shown more than
+    max_late after their time; latency_percentiles() summarises how long
+    after its time each shown frame went out. Given metrics (a
+    panel_metrics.Metrics), the sleeps and latencies also go there as the
+    "wait" and "latency" stages.
+    """
+
+    def __init__(self, max_late=MAX_LATE, clock=time.monotonic, sleep=time.sleep, metrics=None):
+        self.max_late = max_late
+        self.metrics = metrics
+        self._clock = clock
+        self._sleep = sleep
+        self._origin = None
+        self._started = None
+        self._latencies = []
+        # Seconds from drop() letting a frame through to shown()
+        self.cost = 0.0
+        self.frames = 0
+        self.dropped = 0
+        self.late = 0
+
+    def lateness(self, pts):
+        """Seconds the frame at pts is behind (negative: ahead of) its time."""
+        now = self._clock()
+        if self._origin is None:
+            self._origin = now - pts
+        return now - (self._origin + pts)
+
+    def drop(self, pts):
+        """Whether the frame at pts would go out too late to show, counting
+        it as dropped if so. Frames that are still on time are never
+        dropped, so playback keeps moving however slow frames get."""
+        self._started = self._clock()
+        lateness = self.lateness(pts)
+        if lateness > 0 and lateness + self.cost > self.max_late:
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.add("frames_dropped")
+            return True
+        return False
+
+    def wait(self, pts):
+        """Sleep until the frame at pts is due."""
+        delay = -self.lateness(pts)
+        if delay > 0:
+            self._sleep(delay)
+        if self.metrics is not None:
+            self.metrics.observe("wait", max(delay, 0.0))
+
+    def shown(self, pts):
+        """Record that the frame at pts has just gone out."""
+        latency = self.lateness(pts)
+        if self._started is not None:
+            self.cost += COST_WEIGHT * (self._clock() - self._started - self.cost)
+        self._latencies.append(latency)
+        self.frames += 1
+        if latency > self.max_late:
+            self.late += 1
+        if self.metrics is not None:
+            self.metrics.observe("latency", max(latency, 0.0))
+            if latency > self.max_late:
+                self.metrics.add("frames_late")
+
+    def latency_percentiles(self, percentiles=(50, 95, 99)):
+        """{percentile: seconds} over the frames shown so far."""
+        if not self._latencies:
+            return {p: 0.0 for p in percentiles}
+        values = np.percentile(self._latencies, percentiles)
+        return dict(zip(percentiles, (float(v) for v in values)))
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "late": self.late,
+            "cost": self.cost,
+            "latency": self.latency_percentiles(),
+        }
+
+    def summary(self):
+        latency = self.latency_percentiles()
+        return ("%d frames shown, %d dropped, %d late, latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms"
+                % (self.frames, self.dropped, self.late,
+                   1e3 * latency[50], 1e3 * latency[95], 1e3 * latency[99]))
+
+
+def video_frames(vidcap, clock, frame_time, metrics=None):
+    """Yield (pts, frame) for the frames of an OpenCV capture that clock
+    doesn't drop. Dropped frames are only grabbed, never decoded, and every
+    frame is decoded into the same array.
+
+    Timestamps come from CAP_PROP_POS_MSEC. Sources that don't report one
+    (some streams and cameras) count frame_time per frame instead. Given
+    metrics, reading each frame is timed as the "decode" stage, or "grab"
+    for dropped frames.
+    """
+    import cv2
+
+    index = 0
+    im = None
+    t = time.perf_counter()
+    while vidcap.grab():
+        pts = vidcap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if pts <= 0 and index > 0:
+            pts = index * frame_time
+        index += 1
+        if clock.drop(pts):
+            if metrics is not None:
+                metrics.since("grab", t)
+            t = time.perf_counter()
+            continue
+        success, im = vidcap.retrieve(im)
+        if not success:
+            break
+        if metrics is not None:
+            metrics.since("decode", t)
+        yield pts, im
+        t = time.perf_counter()
+
+
+def add_playback_arguments(parser):
+    parser.add_argument("--max-late", default=MAX_LATE, type=float,
+                        help="Seconds a frame may run behind the source before it is skipped.")
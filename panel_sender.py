@@ -0,0 +1,442 @@
+# Shared UDP sender for the send_* scripts
+#
+# Wraps a FrameEncoder and a socket, and optionally only sends the
+# packets whose contents changed since the last frame (delta mode). Every
+# keyframe_interval frames all packets go out again so a panel that missed a
+# UDP packet recovers. Packets go out straight from the encoder's packet
+# matrix through a PacketTransmitter, a whole frame per sendmmsg() call,
+# paced by a token bucket when a packets-per-second budget is set.
+#
+# Boards built with wyrm.py --double-buffer draw into a back buffer and only
+# show it on a present packet, so the sender follows every frame with one
+# (present=True) and the delta compares against the frame before last, which
+# is what the back buffer holds.
+#
+# Every frame's encode, delta, send, pacing and present times go into the
+# sender's Metrics (see panel_metrics.py), along with packet, byte and
+# send error counts.
+import argparse
+import socket
+import time
+import numpy as np
+
+from panel_encoder import (FrameEncoder, OPCODES, OP_PIXELS18, OP_PIXELS12, OP_PIXELS9, RGB_ORDER,
+                           color_depth, present_packet)
+from panel_geometry import WallGeometry, UDP_IP, UDP_PORT
+from panel_metrics import Metrics, add_metrics_arguments, exporter_from_args
+from panel_pacing import BURST, SAFE_RATE, TokenBucket, RateTuner, DepthGovernor
+from panel_tx import PacketTransmitter
+
+# A board holds off drawing until a present has taken effect at the end of
+# the panel scan it lands in (a scan takes about 5.2 ms at 50 MHz), and
+# packets arriving meanwhile pile up in its few receive buffers. Leave it
+# this long before starting on the next frame.
+PRESENT_GAP = 0.006
+
+
+class Link:
+    """One board's share of the packet matrix: a socket, rows row_start up to
+    row_stop, and the pacer (and optional tuner) for that board."""
+
+    def __init__(self, addr, row_start, row_stop, pacer, sock=None):
+        self.addr = addr
+        self.row_start = row_start
+        self.row_stop = row_stop
+        self.pacer = pacer
+        self.tuner = None
+        self.sock = sock if sock is not None else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(addr)
+        self.transmitters = []
+        self.present_tx = None
+
+    def add_transmitter(self, matrix):
+        tx = PacketTransmitter(self.sock, matrix)
+        self.transmitters.append(tx)
+        return tx
+
+    def dropped(self):
+        return sum(tx.dropped for tx in self.transmitters)
+
+    def set_present_mask(self, mask):
+        """Get ready to send present packets for the ports in mask."""
+        self.present_tx = self.add_transmitter(np.array([list(present_packet(mask))], dtype=np.uint8))
+
+
+class DeltaTracker:
+    """Decides which rows of the packet matrix each frame has to send.
+
+    Outside delta mode, or on every keyframe_interval'th frame, that's all of
+    them. Otherwise it's the packets whose words differ from what was last
+    sent. bounds are the end rows of each board's share of the matrix, and
+    plan() splits the rows to send between the boards accordingly.
+
+    buffers is how many frame buffers the boards draw into in turn: with 2
+    (double-buffered boards) a frame is compared against the one before
+    last, and a keyframe spans two frames so that both buffers get filled.
+    """
+
+    def __init__(self, words, bounds, delta=False, keyframe_interval=30, buffers=1):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.buffers = buffers
+        self.bounds = np.asarray(bounds)
+        self.frame_count = 0
+        self.packets_sent = 0
+        self.packets_skipped = 0
+
+        # The last words we put on the wire to each buffer, and scratch for
+        # comparing against them
+        self._last = np.zeros((buffers,) + words.shape, dtype=words.dtype)
+        self._diff = np.empty(words.shape, dtype=bool)
+        self.dirty = np.ones(words.shape[:2], dtype=bool)
+
+    def is_keyframe(self):
+        return (not self.delta or self.keyframe_interval <= 0
+                or self.frame_count % self.keyframe_interval < self.buffers)
+
+    def mark_dirty(self, words, keyframe):
+        """Work out which packets differ from what the buffer this frame goes
+        to was last sent, and remember them."""
+        last = self._last[self.frame_count % self.buffers]
+        if keyframe:
+            self.dirty[...] = True
+        else:
+            np.not_equal(words, last, out=self._diff)
+            np.any(self._diff, axis=2, out=self.dirty)
+        np.copyto(last, words)
+        return self.dirty
+
+    def plan(self, words):
+        """For a freshly encoded frame, return (start, stop, rows) per board:
+        send rows start..stop-1 when rows is None, else rows[start:stop]."""
+        keyframe = self.is_keyframe()
+        dirty = self.mark_dirty(words, keyframe)
+        self.frame_count += 1
+
+        starts = np.concatenate(([0], self.bounds[:-1]))
+        if keyframe:
+            plan = [(int(a), int(b), None) for a, b in zip(starts, self.bounds)]
+            sent = dirty.size
+        else:
+            rows = np.flatnonzero(dirty)
+            sent = len(rows)
+            # rows is sorted, so each board's dirty rows are one slice of it
+            ends = np.searchsorted(rows, self.bounds)
+            plan = [(int(a), int(b), rows) for a, b in zip(np.concatenate(([0], ends[:-1])), ends)]
+
+        self.packets_sent += sent
+        self.packets_skipped += dirty.size - sent
+        return plan
+
+
+def plan_size(plan, lengths, packet_size):
+    """(packets, bytes) a DeltaTracker plan sends, given the encoder's
+    lengths (None when every packet is packet_size bytes)."""
+    packets = sum(stop - start for start, stop, _ in plan)
+    if lengths is None:
+        return packets, packets * packet_size
+    return packets, sum(int(lengths[start:stop].sum() if rows is None else lengths[rows[start:stop]].sum())
+                        for start, stop, rows in plan)
+
+
+class PanelSender:
+    """Sends encoded frames to one or more boards.
+
+    links lists (address, number of segments) per board, splitting the
+    encoder's segments between them in order; by default everything goes to
+    ip:port. Each board gets its own socket and its own copy of the pacer.
+    With present set, every frame is followed by a present packet to each
+    board, for boards built with double buffering. Stage timings and
+    counters go to metrics.
+    """
+
+    def __init__(self, encoder, ip=UDP_IP, port=UDP_PORT, masks=None,
+                 delta=False, keyframe_interval=30, pacer=None, sock=None, links=None,
+                 present=False, metrics=None):
+        if masks is not None:
+            encoder.set_masks(masks)
+        self.masks = [int(m) for m in encoder.packets[:, 0, 0]]
+
+        if links is None:
+            links = [((ip, port), encoder.num_segments)]
+        if sum(n for _, n in links) != encoder.num_segments:
+            raise ValueError("links cover %d segments but the encoder has %d"
+                             % (sum(n for _, n in links), encoder.num_segments))
+        pacer = pacer if pacer is not None else TokenBucket(0)
+        self.links = []
+        for addr, n in links:
+            link_pacer = pacer if not self.links else TokenBucket(pacer.rate, pacer.burst)
+            self.links.append(Link(addr, 0, 0, link_pacer, sock if len(links) == 1 else None))
+        self._link_segments = [n for _, n in links]
+
+        self.present = present
+        self._present_done = 0.0
+        if present:
+            seg = 0
+            for link, n in zip(self.links, self._link_segments):
+                mask = 0
+                for m in self.masks[seg:seg + n]:
+                    mask |= m
+                link.set_present_mask(mask)
+                seg += n
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Seconds spent waiting on pacers since the last frame, and send
+        # errors counted so far
+        self._paced = 0.0
+        self._errors = 0
+
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        # Transmitters and delta state per encoder, for switching between them
+        self._encoders = {}
+        self.governor = None
+        self._depth_encoders = None
+        self.use_encoder(encoder)
+
+        # The first board, for the common single-board case
+        self.addr = self.links[0].addr
+        self.sock = self.links[0].sock
+        self.pacer = self.links[0].pacer
+
+    def use_encoder(self, encoder):
+        """Send the following frames through encoder, which must cover the same
+        segments as the current one (e.g. the same layout in another packet
+        format). The first frame after a switch is always a keyframe."""
+        if encoder.num_segments != sum(self._link_segments):
+            raise ValueError("encoder has %d segments, the links cover %d"
+                             % (encoder.num_segments, sum(self._link_segments)))
+        row = 0
+        for link, n in zip(self.links, self._link_segments):
+            link.row_start, link.row_stop = row, row + n * encoder.packets_per_segment
+            row = link.row_stop
+
+        if id(encoder) not in self._encoders:
+            encoder.set_masks(self.masks)
+            tracker = DeltaTracker(encoder.payload, [link.row_stop for link in self.links],
+                                   self.delta, self.keyframe_interval, 2 if self.present else 1)
+            self._encoders[id(encoder)] = (encoder, self.add_transmitters(encoder.packet_matrix()),
+                                           tracker)
+        self.encoder, self.link_txs, self.tracker = self._encoders[id(encoder)]
+        self.tracker.frame_count = 0
+        self.tx = self.link_txs[0]
+
+    def send_frame(self, frame):
+        """Encode and send one frame, returns the number of packets sent."""
+        metrics = self.metrics
+        t = time.perf_counter()
+        if self.present:
+            self.wait_for_present()
+            t = metrics.since("present_wait", t)
+        start = time.monotonic()
+        words = self.encoder.encode(frame)
+        t = metrics.since("encode", t)
+        plan = self.tracker.plan(words)
+        t = metrics.since("delta", t)
+
+        lengths = self.encoder.lengths
+        for link, tx, (start_row, stop_row, rows) in zip(self.links, self.link_txs, plan):
+            if lengths is not None:
+                tx.set_lengths(lengths[link.row_start:link.row_stop], link.row_start)
+            self.transmit(link, tx, start_row, stop_row, rows)
+        if self.present:
+            self.present_frame()
+        sent, sent_bytes = plan_size(plan, lengths, self.encoder.packet_size)
+        self.record_frame(sent, sent_bytes, t)
+        if self.governor is not None:
+            self.update_depth(time.monotonic() - start, sent)
+        return sent
+
+    def record_frame(self, packets, sent_bytes, start):
+        """Count a frame of packets that went out since start (a
+        time.perf_counter() value), splitting the time between sending and
+        waiting on the pacers."""
+        metrics = self.metrics
+        elapsed = time.perf_counter() - start
+        metrics.observe("pace", self._paced)
+        metrics.observe("send", elapsed - self._paced)
+        self._paced = 0.0
+        errors = self.dropped()
+        metrics.add("frames")
+        metrics.add("packets", packets)
+        metrics.add("bytes", sent_bytes)
+        metrics.add("send_errors", errors - self._errors)
+        self._errors = errors
+        metrics.tick()
+
+    def present_frame(self):
+        """Have every board show what has been sent to it since the last present."""
+        for link in self.links:
+            self.transmit(link, link.present_tx, 0, 1)
+        self.metrics.add("presents", len(self.links))
+        self._present_done = time.monotonic() + PRESENT_GAP
+
+    def wait_for_present(self):
+        """Sleep until the boards can take pixels again after a present."""
+        delay = self._present_done - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def add_transmitters(self, matrix):
+        """Make a PacketTransmitter per board for another packet matrix laid out
+        like the encoder's (e.g. a compiled clip)."""
+        return [link.add_transmitter(matrix) for link in self.links]
+
+    def dropped(self):
+        return sum(link.dropped() for link in self.links)
+
+    def transmit(self, link, tx, start, stop, rows=None):
+        """Send rows start..stop-1 of tx's matrix, or rows[start:stop] if given,
+        under the link's pacer."""
+        pacer = link.pacer
+        if not pacer.enabled:
+            if stop > start:
+                if rows is None:
+                    tx.send_range(start, stop)
+                else:
+                    tx.send(rows[start:stop])
+        else:
+            while start < stop:
+                t = time.perf_counter()
+                n = pacer.acquire(stop - start)
+                self._paced += time.perf_counter() - t
+                if rows is None:
+                    start += tx.send_range(start, start + n)
+                else:
+                    start += tx.send(rows[start:start + n])
+        if link.tuner is not None:
+            link.tuner.update()
+
+    def update_depth(self, seconds, sent):
+        # The pacer meters packets; unpaced, the time goes on bytes
+        if self.pacer.enabled:
+            unit = [1] * len(self._depth_encoders)
+        else:
+            unit = [e.packet_size for e in self._depth_encoders]
+        costs = [e.packet_matrix().shape[0] * u for e, u in zip(self._depth_encoders, unit)]
+        cost = sent * unit[self.governor.level]
+        encoder = self.governor.update(seconds, cost, costs)
+        if encoder is not self.encoder:
+            self.use_encoder(encoder)
+
+    def auto_depth(self, target_fps, opcodes=None, **kwargs):
+        """Fall back to lower color depths whenever frames can't go out at
+        target_fps, and return to the current format once they can.
+
+        opcodes lists the packet formats to use, richest first; by default
+        the current one followed by every packed format of lower depth.
+        """
+        if opcodes is None:
+            opcodes = [op for op in (OP_PIXELS12, OP_PIXELS9)
+                       if color_depth(op) < self.encoder.depth]
+            opcodes.insert(0, self.encoder.opcode)
+        current = self.encoder
+        self._depth_encoders = [current if op == current.opcode else
+                                FrameEncoder(current.width, current.height, current.channel_order,
+                                             current.pixel_index, opcode=op,
+                                             compress=current.compress and op == OP_PIXELS18,
+                                             gamma=current.gamma,
+                                             white_balance=current.white_balance)
+                                for op in opcodes]
+        # Build the transmitters up front rather than mid-stream
+        for encoder in self._depth_encoders:
+            self.use_encoder(encoder)
+        self.use_encoder(self._depth_encoders[0])
+        self.governor = DepthGovernor(target_fps, self._depth_encoders, **kwargs)
+        return self.governor
+
+    def auto_rate(self, **kwargs):
+        """Let a RateTuner drive each board's pacer off that board's drop count."""
+        for link in self.links:
+            link.tuner = RateTuner(link.pacer, link.dropped, **kwargs)
+        return [link.tuner for link in self.links]
+
+
+def parse_size(text):
+    """Parse WIDTHxHEIGHT into (width, height)."""
+    try:
+        width, height = (int(v) for v in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got %r" % text)
+    return width, height
+
+
+def parse_white_balance(text):
+    gains = tuple(float(v) for v in text.split(","))
+    if len(gains) != 3:
+        raise argparse.ArgumentTypeError("expected red,green,blue gains, got %r" % text)
+    return gains
+
+
+def add_sender_arguments(parser):
+    parser.add_argument("--ip", default=UDP_IP, help="Address of the Wyrm board.")
+    parser.add_argument("--port", default=UDP_PORT, type=int, help="UDP port of the Wyrm board.")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only send the packets that changed since the last frame.")
+    parser.add_argument("--keyframe-interval", default=30, type=int,
+                        help="In delta mode, resend every packet once every this many frames.")
+    parser.add_argument("--pps", default=0, type=float,
+                        help="Packets per second budget, 0 sends as fast as possible.")
+    parser.add_argument("--burst", default=BURST, type=int,
+                        help="Packets that may go out back to back under the --pps budget.")
+    parser.add_argument("--auto-rate", action="store_true",
+                        help="Probe for the highest packet rate that doesn't drop packets, from "
+                             "--pps up to --max-pps. Only send errors on this host count as "
+                             "drops, since the board doesn't report its own.")
+    parser.add_argument("--max-pps", default=SAFE_RATE, type=float,
+                        help="Highest rate --auto-rate tries. The default is what the board is "
+                             "known to keep up with; raise it only once a board has been "
+                             "measured to take more.")
+    parser.add_argument("--wall", default=None,
+                        help="JSON panel-wall geometry (boards, connectors, panel positions); "
+                             "overrides --ip/--port and the canvas size.")
+    parser.add_argument("--wire-format", default="v1", choices=sorted(OPCODES),
+                        help="Packet layout: v1 addresses every pixel, v2 packs 18-bit pixels "
+                             "after one start address, rgb444/rgb333 pack fewer bits per "
+                             "pixel (all but v1 need matching firmware).")
+    parser.add_argument("--compress", action="store_true",
+                        help="With --wire-format v2, send flat areas as color runs or palette "
+                             "indices when that's shorter.")
+    parser.add_argument("--target-fps", default=None, type=float,
+                        help="Drop to rgb444/rgb333 whenever frames can't be sent this fast.")
+    parser.add_argument("--present", action="store_true",
+                        help="Follow every frame with a present packet, for boards built with "
+                             "wyrm.py --double-buffer (which show nothing without one).")
+    parser.add_argument("--gamma", default=1.0, type=float,
+                        help="Gamma to apply on the host before quantizing, on top of the "
+                             "board's own gamma table.")
+    parser.add_argument("--white-balance", default=None, type=parse_white_balance,
+                        help="Red,green,blue gains applied on the host, e.g. 1,0.85,0.7.")
+    add_metrics_arguments(parser)
+
+
+def sender_from_args(args, width, height, channel_order=RGB_ORDER, masks=None):
+    """Build the encoder and sender the command line asks for.
+
+    The canvas is width x height split into 64x64 panels on one board, unless
+    --wall gives a geometry file, in which case its canvas size wins - check
+    sender.encoder.width/height.
+    """
+    opcode = OPCODES[args.wire_format]
+    if args.compress and opcode != OP_PIXELS18:
+        raise ValueError("--compress needs --wire-format v2")
+    if args.wall is not None:
+        geometry = WallGeometry.load(args.wall)
+        encoder = geometry.encoder(channel_order, opcode, args.compress, gamma=args.gamma,
+                                   white_balance=args.white_balance)
+        masks = geometry.masks()
+        links = geometry.links()
+    else:
+        encoder = FrameEncoder(width, height, channel_order=channel_order, opcode=opcode,
+                               compress=args.compress, gamma=args.gamma,
+                               white_balance=args.white_balance)
+        links = None
+    sender = PanelSender(encoder, ip=args.ip, port=args.port, masks=masks, links=links,
+                         delta=args.delta, keyframe_interval=args.keyframe_interval,
+                         pacer=TokenBucket(args.pps, args.burst), present=args.present)
+    if args.auto_rate:
+        sender.auto_rate(max_rate=args.max_pps)
+    if args.target_fps:
+        sender.auto_depth(args.target_fps)
+    exporter_from_args(args, [sender.metrics])
+    return sender
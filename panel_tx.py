@@ -0,0 +1,161 @@
+# Batched packet transmit for a preallocated packet matrix
+#
+# The encoder keeps every packet of a frame in one contiguous
+# (n_packets, PACKET_SIZE) uint8 matrix. PacketTransmitter points one iovec
+# at each row once, up front, and then pushes a whole frame (or just the
+# dirty rows of it) to the kernel with a single sendmmsg() call. Where
+# sendmmsg isn't available we fall back to one send() per row, still
+# straight out of the matrix without copying. Rows may hold packets shorter
+# than the row (see FrameEncoder.lengths); set_lengths() says how much of
+# each row to send.
+#
+# Packets the kernel refuses because its buffers are full (or because the
+# board answered with ICMP port unreachable) are counted in dropped instead
+# of raising, the same as if they had been lost on the wire.
+import ctypes
+import ctypes.util
+import errno
+import os
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+_DROP_ERRNOS = (errno.ENOBUFS, errno.EAGAIN, errno.ECONNREFUSED)
+
+
+def _load_sendmmsg():
+    if os.name != "posix":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fn = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+class PacketTransmitter:
+    """Sends rows of a packet matrix over a connected UDP socket.
+
+    matrix must stay allocated (and at the same address) for the lifetime of
+    the transmitter - the iovecs point straight into it.
+    """
+
+    def __init__(self, sock, matrix, use_sendmmsg=True):
+        if matrix.ndim != 2 or not matrix.flags.c_contiguous:
+            raise ValueError("packet matrix must be a C-contiguous 2D array")
+        self.sock = sock
+        self.matrix = matrix
+        self.rows = [memoryview(row) for row in matrix]
+        self.lengths = [matrix.shape[1]] * matrix.shape[0]
+        self.syscalls = 0
+        self.dropped = 0
+
+        self._sendmmsg = _sendmmsg if use_sendmmsg else None
+        if self._sendmmsg is None:
+            return
+
+        n_packets, packet_size = matrix.shape
+        base = matrix.ctypes.data
+        self._iovs = (_IOVec * n_packets)()
+        self._msgs = (_MMsgHdr * n_packets)()
+        for i in range(n_packets):
+            self._iovs[i].iov_base = base + i * packet_size
+            self._iovs[i].iov_len = packet_size
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+        # Scratch array for sending a subset of the rows
+        self._batch = (_MMsgHdr * n_packets)()
+        self._msg_size = ctypes.sizeof(_MMsgHdr)
+
+    @property
+    def batched(self):
+        return self._sendmmsg is not None
+
+    def set_lengths(self, lengths, start=0):
+        """Send only the first lengths[i] bytes of row start + i from now on."""
+        for i, n in enumerate(lengths, start):
+            n = int(n)
+            if n == self.lengths[i]:
+                continue
+            self.lengths[i] = n
+            self.rows[i] = memoryview(self.matrix[i])[:n]
+            if self._sendmmsg is not None:
+                self._iovs[i].iov_len = n
+
+    def send(self, rows=None):
+        """Send the given row indices of the matrix (all of them by default)."""
+        if rows is None:
+            return self.send_range(0, len(self.rows))
+
+        if self._sendmmsg is None:
+            for i in rows:
+                self._send_one(i)
+            return len(rows)
+
+        for j, i in enumerate(rows):
+            ctypes.memmove(ctypes.addressof(self._batch[j]), ctypes.addressof(self._msgs[i]),
+                           self._msg_size)
+        self._send_msgs(self._batch, 0, len(rows))
+        return len(rows)
+
+    def send_range(self, start, stop):
+        """Send rows start..stop-1 of the matrix."""
+        if self._sendmmsg is None:
+            for i in range(start, stop):
+                self._send_one(i)
+        else:
+            self._send_msgs(self._msgs, start, stop - start)
+        return stop - start
+
+    def _send_one(self, i):
+        self.syscalls += 1
+        try:
+            self.sock.send(self.rows[i])
+        except OSError as e:
+            if e.errno not in _DROP_ERRNOS:
+                raise
+            self.dropped += 1
+
+    def _send_msgs(self, msgs, start, count):
+        # sendmmsg may stop early (e.g. a full socket buffer), so keep going
+        # until everything is out
+        fd = self.sock.fileno()
+        base = ctypes.addressof(msgs) + start * self._msg_size
+        done = 0
+        while done < count:
+            ret = self._sendmmsg(fd, base + done * self._msg_size, count - done, 0)
+            self.syscalls += 1
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err not in _DROP_ERRNOS:
+                    raise OSError(err, os.strerror(err))
+                # Skip the packet the kernel wouldn't take
+                self.dropped += 1
+                ret = 1
+            done += ret
@@ -1,49 +1,34 @@
 #!/bin/python3
-import socket
-import sys
+import argparse
 import time
-import numpy as np
-import PIL
-from PIL import Image
-from PIL import ImageSequence
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_sender import add_sender_arguments, sender_from_args
+from clip_cache import add_cache_arguments, gif_frames, load_or_compile_gif, ClipPlayer
 
-num_rows = 64
-num_cols = num_rows
-fbuf = np.zeros((num_rows*4), dtype='u4')
+parser = argparse.ArgumentParser(description="Loop a GIF on a single 64x64 panel.")
+parser.add_argument("gif", help="Animated image to display.")
+parser.add_argument("panel_mask", type=int, help="Panel enable mask for the packet header.")
+parser.add_argument("frame_time", type=float, help="Seconds to pause between frames.")
+add_sender_arguments(parser)
+add_cache_arguments(parser)
+args = parser.parse_args()
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sender = sender_from_args(args, 64, 64, masks=[args.panel_mask])
 
-im = Image.open(sys.argv[1])
-size = 64, 64
+size = sender.encoder.width, sender.encoder.height
 
-frame_time = float(sys.argv[3])
+frame_time = args.frame_time
 
+if args.cache:
+    # Encode every frame once, then loop straight out of the compiled clip
+    clip = load_or_compile_gif(args.gif, sender.encoder, args.cache_dir)
+    ClipPlayer(sender, clip).play(frame_time)
+
+# Pad every frame once, the loop then only packs and sends them
+frames = [thumb for thumb, _ in gif_frames(args.gif, *size)]
 while(1):
-    for frame in ImageSequence.Iterator(im):
-        thumb = PIL.ImageOps.pad(frame, size, Image.Resampling.LANCZOS)
-        thumb = thumb.convert("RGB")
-        cast = np.array(thumb)
-        for y in range(num_rows):
-            for x in range(num_cols):
-                addr = ((y & 0x3F) << 6) | (x & 0x3F);
-        
-                r = cast[y][x][2].item()
-                g = cast[y][x][0].item()
-                b = cast[y][x][1].item()
-        
-                fbuf[x+(num_cols*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                                     | (((int(g))&0xFC) << 4)
-                                                                     | (((int(b))&0xFC) >> 2))
-        
-            if (y % 4) == 3:
-                tosend = bytearray()
-                tosend.append(int(sys.argv[2]))
-                tosend.append(0)
-                tosend.extend(fbuf.tobytes())
-                s.sendto(tosend, (UDP_IP, UDP_PORT))
+    for thumb in frames:
+        sender.send_frame(thumb)
         time.sleep(frame_time)
 
 exit()
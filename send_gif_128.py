@@ -1,59 +1,34 @@
 #!/bin/python3
-import socket
-import sys
+import argparse
 import time
-import numpy as np
-import PIL
-from PIL import Image
-from PIL import ImageSequence
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_sender import add_sender_arguments, sender_from_args
+from clip_cache import add_cache_arguments, gif_frames, load_or_compile_gif, ClipPlayer
 
-num_rows = 128
-num_cols = num_rows
-fbuf = np.zeros((64*4), dtype='u4')
+parser = argparse.ArgumentParser(description="Loop a GIF across four 64x64 panels.")
+parser.add_argument("gif", help="Animated image to display.")
+parser.add_argument("frame_time", type=float, help="Seconds to pause between frames.")
+add_sender_arguments(parser)
+add_cache_arguments(parser)
+args = parser.parse_args()
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# Four 64x64 segments, segment i goes to panel 1 << i, unless --wall says otherwise
+sender = sender_from_args(args, 128, 128)
 
-im = Image.open(sys.argv[1])
-size = 128, 128
+size = sender.encoder.width, sender.encoder.height
 
-frame_time = float(sys.argv[2])
+frame_time = args.frame_time
 
+if args.cache:
+    # Encode every frame once, then loop straight out of the compiled clip
+    clip = load_or_compile_gif(args.gif, sender.encoder, args.cache_dir)
+    ClipPlayer(sender, clip).play(frame_time)
+
+# Pad every frame once, the loop then only packs and sends them
+frames = [thumb for thumb, _ in gif_frames(args.gif, *size)]
 while(1):
-    for frame in ImageSequence.Iterator(im):
-        thumb = PIL.ImageOps.pad(frame, size, Image.Resampling.LANCZOS)
-        thumb = thumb.convert("RGB")
-        cast = np.array(thumb)
-        for i in range(4):
-            for y in range(64):
-                for x in range(64):
-                    addr = ((y & 0x3F) << 6) | (x & 0x3F);
-        
-                    adj_y = y
-                    adj_x = x
-                    if i == 1:
-                        adj_x = adj_x + 64
-                    if i == 2:
-                        adj_y = adj_y + 64
-                    if i == 3:
-                        adj_x = adj_x + 64
-                        adj_y = adj_y + 64
-                    r = cast[adj_y][adj_x][2].item()
-                    g = cast[adj_y][adj_x][0].item()
-                    b = cast[adj_y][adj_x][1].item()
-        
-                    fbuf[x+(64*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                                       | (((int(g))&0xFC) << 4)
-                                                                       | (((int(b))&0xFC) >> 2))
-                if (y % 4) == 3:
-                    tosend = bytearray()
-                    tosend.append(1 << i)
-                    tosend.append(0)
-                    tosend.extend(fbuf.tobytes())
-                    s.sendto(tosend, (UDP_IP, UDP_PORT))
- 
+    for thumb in frames:
+        sender.send_frame(thumb)
         time.sleep(frame_time)
 
 exit()
@@ -1,42 +1,24 @@
 #!/bin/python3
-import socket
-import sys
+import argparse
 import numpy as np
-import PIL
 from PIL import Image
+from PIL import ImageOps
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_sender import add_sender_arguments, sender_from_args
 
-num_rows = 64
-num_cols = num_rows
-fbuf = np.zeros((num_rows*4), dtype='u4')
+parser = argparse.ArgumentParser(description="Send an image to a single 64x64 panel.")
+parser.add_argument("image", help="Image file to display.")
+parser.add_argument("panel_mask", type=int, help="Panel enable mask for the packet header.")
+add_sender_arguments(parser)
+args = parser.parse_args()
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sender = sender_from_args(args, 64, 64, masks=[args.panel_mask])
 
-im = Image.open(sys.argv[1])
-size = 64, 64
-im = PIL.ImageOps.pad(im, size, Image.Resampling.LANCZOS)
+im = Image.open(args.image)
+size = sender.encoder.width, sender.encoder.height
+im = ImageOps.pad(im, size, Image.Resampling.LANCZOS)
+im = im.convert("RGB")
 
-cast = np.array(im)
-
-for y in range(num_rows):
-    for x in range(num_cols):
-        addr = ((y & 0x3F) << 6) | (x & 0x3F);
-
-        r = cast[y][x][2].item()
-        g = cast[y][x][0].item()
-        b = cast[y][x][1].item()
-
-        fbuf[x+(num_cols*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                             | (((int(g))&0xFC) << 4)
-                                                             | (((int(b))&0xFC) >> 2))
-
-    if (y % 4) == 3:
-        tosend = bytearray()
-        tosend.append(int(sys.argv[2]))
-        tosend.append(0)
-        tosend.extend(fbuf.tobytes())
-        s.sendto(tosend, (UDP_IP, UDP_PORT))
+sender.send_frame(np.array(im))
 
 exit()
@@ -0,0 +1,88 @@
+#!/bin/python3
+# Send raw frames from a live source
+#
+# Reads fixed-size raw frames from stdin, a FIFO, a raw video file or a
+# shared memory segment (see panel_ingest.py) and sends each one as it
+# arrives. Frames already the size of the canvas go to the encoder as they
+# are read; anything else is letterboxed onto it first. e.g.
+#
+#   ffmpeg -re -i video.mp4 -vf scale=128:128 -f rawvideo -pix_fmt rgb24 - | ./send_raw.py -
+#
+# Usage: ./send_raw.py <-|fifo|file|shm:NAME> [--size WxH] [--pix-fmt rgb24|bgr24] [--fps N]
+#                      [sender options]
+import argparse
+import time
+
+from panel_encoder import BGR_ORDER, RGB_ORDER
+from panel_ingest import open_frames
+from panel_letterbox import Letterbox
+from panel_playback import PlaybackClock, add_playback_arguments
+from panel_sender import add_sender_arguments, parse_size, sender_from_args
+
+PIXEL_FORMATS = {"rgb24": RGB_ORDER, "bgr24": BGR_ORDER}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send raw RGB frames from a pipe, file or "
+                                                 "shared memory across four 64x64 panels.")
+    parser.add_argument("source", help="'-' for stdin, shm:NAME for shared memory, or a FIFO or raw file.")
+    parser.add_argument("--size", default=None, type=parse_size,
+                        help="WIDTHxHEIGHT of the incoming frames, the canvas size by default.")
+    parser.add_argument("--pix-fmt", default="rgb24", choices=sorted(PIXEL_FORMATS),
+                        help="Byte order of each incoming pixel.")
+    parser.add_argument("--fps", default=0, type=float,
+                        help="Show frames at this rate, skipping late ones, for sources that "
+                             "aren't live. 0 sends every frame as soon as it arrives.")
+    add_sender_arguments(parser)
+    add_playback_arguments(parser)
+    args = parser.parse_args()
+
+    sender = sender_from_args(args, 128, 128, channel_order=PIXEL_FORMATS[args.pix_fmt])
+    canvas = sender.encoder.width, sender.encoder.height
+    width, height = args.size or canvas
+    reader = open_frames(args.source, width, height)
+
+    # Passes frames that already fit the canvas straight through
+    letterbox = Letterbox((width, height), canvas)
+
+    # Without --fps a frame is due the moment it arrives, so the latencies
+    # are from reading a frame to having sent it
+    metrics = sender.metrics
+    clock = PlaybackClock(args.max_late, metrics=metrics)
+    frame_time = 1.0/args.fps if args.fps > 0 else None
+    index = 0
+    start = None
+    try:
+        while True:
+            t = time.perf_counter()
+            im = reader.read()
+            if im is None:
+                break
+            metrics.since("read", t)
+            if frame_time is None:
+                now = time.monotonic()
+                start = now if start is None else start
+                pts = now - start
+            else:
+                pts = index * frame_time
+                index += 1
+                if clock.drop(pts):
+                    continue
+            t = time.perf_counter()
+            im = letterbox(im)
+            metrics.since("resize", t)
+            clock.wait(pts)
+            sender.send_frame(im)
+            clock.shown(pts)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+    print(clock.summary())
+    if reader.skipped:
+        print("%d frames were overwritten in shared memory before they were read" % reader.skipped)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,72 @@
 #!/bin/python3
-import socket
-import sys
+# Play a video across four 64x64 panels
+#
+# Usage: ./send_vid_128.py <video> [sender options] [--max-late S]
+#
+# send_vid_vectorized.py is the same player with pacing on by default.
+import argparse
+import itertools
 import time
-import numpy as np
 import cv2
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_encoder import BGR_ORDER
+from panel_letterbox import Letterbox
+from panel_playback import PlaybackClock, add_playback_arguments, video_frames
+from panel_sender import add_sender_arguments, sender_from_args
 
-# We send 4 lines at a time, and we only access one 64x64 segment at a time
-fbuf = np.zeros((64*4), dtype='u4')
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def main(**defaults):
+    """Play the video on the command line. defaults override the sender and
+    playback options' own defaults."""
+    parser = argparse.ArgumentParser(description="Play a video across four 64x64 panels.")
+    parser.add_argument("video", help="Video file or stream for OpenCV to open.")
+    add_sender_arguments(parser)
+    add_playback_arguments(parser)
+    parser.set_defaults(**defaults)
+    args = parser.parse_args()
 
-# Open the stream using OpenCV
-vidcap = cv2.VideoCapture(sys.argv[1])
+    # Each 128x128 frame is four 64x64 segments, segment i goes to panel 1 << i,
+    # unless --wall describes a different layout.
+    # Frames come out of OpenCV as BGR, so let the encoder pick the channels.
+    sender = sender_from_args(args, 128, 128, channel_order=BGR_ORDER)
 
-fps = vidcap.get(cv2.CAP_PROP_FPS)
-frame_time = 1.0/float(fps)
+    # Open the stream using OpenCV
+    vidcap = cv2.VideoCapture(args.video)
 
-# Read in the first frame of the video to calculate all our parameters
-success, im = vidcap.read()
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    frame_time = 1.0/float(fps) if fps > 0 else 1.0/30
 
-# First we need to calculate how to resize while maintaining the original aspect ratio
-o_shape = (im.shape[1], im.shape[0])
-n_shape = (128, 128)
-ratio = float(max(n_shape))/float(max(o_shape))
-n_size = tuple([int(x*ratio) for x in o_shape])
+    # Frames are shown at their timestamps, skipping any that are already too late
+    clock = PlaybackClock(args.max_late, metrics=sender.metrics)
+    frames = video_frames(vidcap, clock, frame_time, sender.metrics)
 
-# Now we need to calculate the border we add after resizing to hit a square 128x128 size
-delta_w = n_shape[0] - n_size[0]
-delta_h = n_shape[1] - n_size[1]
-top, bottom = delta_h//2, delta_h-(delta_h//2)
-left, right = delta_w//2, delta_w-(delta_w//2)
+    # Read in the first frame of the video to calculate all our parameters
+    first = next(frames, None)
+    if first is None:
+        return
+    im = first[1]
 
-# While we have frame data - send new frames to the display!
-while success:
-    start_time = time.monotonic()
-    im = cv2.resize(im, n_size)
-    im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=((0, 0, 0)))
-    im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-    cast = np.array(im)
+    # Work out once how to resize while maintaining the original aspect ratio,
+    # every frame is then scaled straight into the same black-bordered canvas
+    letterbox = Letterbox.for_frame(im, (sender.encoder.width, sender.encoder.height))
 
-    # The loop is broken into 64x64 segments - 4 for a 128x128 frame
-    for i in range(4):
-        for y in range(64):
-            for x in range(64):
-                # Addresses are local to each segment
-                addr = ((y & 0x3F) << 6) | (x & 0x3F);
+    # While we have frame data - send new frames to the display!
+    try:
+        for pts, im in itertools.chain([first], frames):
+            t = time.perf_counter()
+            im = letterbox(im)
+            sender.metrics.since("resize", t)
 
-                # Calculate our pointer into the larger 128x128 frame
-                adj_y = y
-                adj_x = x
-                if i == 1:
-                    adj_x = adj_x + 64
-                if i == 2:
-                    adj_y = adj_y + 64
-                if i == 3:
-                    adj_x = adj_x + 64
-                    adj_y = adj_y + 64
-                r = cast[adj_y][adj_x][2].item()
-                g = cast[adj_y][adj_x][0].item()
-                b = cast[adj_y][adj_x][1].item()
+            # Pack the whole frame at once, then send it 4 lines at a time
+            # once it's due
+            clock.wait(pts)
+            sender.send_frame(im)
+            clock.shown(pts)
+    except KeyboardInterrupt:
+        pass
 
-                # We buffer up 4 lines per packet
-                fbuf[x+(64*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                               | (((int(g))&0xFC) << 4)
-                                                               | (((int(b))&0xFC) >> 2))
-            # If we have 4 lines in the buffer, send!
-            if (y % 4) == 3:
-                tosend = bytearray()
-                tosend.append(1 << i) # The panel we're sending to is encoded here
-                tosend.append(0)
-                tosend.extend(fbuf.tobytes())
-                s.sendto(tosend, (UDP_IP, UDP_PORT))
+    print(clock.summary())
 
-    # Calculate how long we took to send a complete frame
-    end_time = time.monotonic()
-    proc_time = end_time - start_time
-    # If we were faster than the FPS, pause until we're at the frame limit
-    if frame_time > proc_time:
-        time.sleep(frame_time - proc_time)
 
-    # Pull in the next frame!
-    success, im = vidcap.read()
-
-exit()
+if __name__ == "__main__":
+    main()
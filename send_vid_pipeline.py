@@ -0,0 +1,171 @@
+#!/bin/python3
+# Pipelined version of send_vid_vectorized.py
+#
+# A decoder process reads, resizes and letterboxes frames into a ring of
+# preallocated canvas-sized frames in shared memory, paced at the source frame
+# rate. This process encodes and sends whatever is newest. Slots move between
+# the two through a pair of queues: if the decoder finds no free slot it drops
+# the frame it just decoded, and if the sender finds several frames ready it
+# sends the newest and hands the stale ones straight back. Either way latency
+# stays bounded and the frame rate is set by the slower of the two stages.
+#
+# Like send_vid_vectorized.py, it paces one packet at a time at SAFE_RATE
+# unless --pps/--burst say otherwise.
+import argparse
+import queue
+import signal
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+
+from panel_encoder import BGR_ORDER
+from panel_letterbox import Letterbox
+from panel_pacing import SAFE_RATE
+from panel_sender import add_sender_arguments, sender_from_args
+
+END_OF_STREAM = -1
+# Seconds to wait for the decoder to stop before terminating it
+DECODER_TIMEOUT = 2.0
+
+
+def decode_worker(video, shm_name, frame_shape, ring_size, free_slots, ready_slots, dropped, stop):
+    # Ctrl-C reaches the whole process group; the main process sets stop instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = np.ndarray((ring_size,) + frame_shape, dtype=np.uint8, buffer=shm.buf)
+
+    vidcap = cv2.VideoCapture(video)
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    frame_time = 1.0/float(fps) if fps > 0 else 0.0
+
+    # Read in the first frame of the video to calculate all our parameters
+    success, im = vidcap.read()
+    if success:
+        # Calculate resize parameters while maintaining aspect ratio. The
+        # border around the resized image is never written, so it stays
+        # black from when the ring was allocated
+        letterbox = Letterbox.for_frame(im, (frame_shape[1], frame_shape[0]))
+
+    deadline = time.monotonic()
+    while success and not stop.is_set():
+        try:
+            slot = free_slots.get_nowait()
+        except queue.Empty:
+            # The sender is behind - drop this frame rather than queue it up
+            slot = None
+            with dropped.get_lock():
+                dropped.value += 1
+
+        if slot is not None:
+            letterbox(im, out=ring[slot])
+            ready_slots.put(slot)
+
+        # Decode at the source rate
+        deadline += frame_time
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        success, im = vidcap.read(im)
+
+    ready_slots.put(END_OF_STREAM)
+    del ring
+    shm.close()
+
+
+def stop_decoder(decoder, stop, ready_slots, timeout=DECODER_TIMEOUT):
+    """Tell the decoder to stop and wait for it. Whatever it still queues is
+    drained meanwhile, since a process doesn't exit until its queued items
+    have been read off the pipe."""
+    stop.set()
+    deadline = time.monotonic() + timeout
+    while decoder.is_alive() and time.monotonic() < deadline:
+        try:
+            ready_slots.get(timeout=0.05)
+        except queue.Empty:
+            pass
+    if decoder.is_alive():
+        decoder.terminate()
+    decoder.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a video across four 64x64 panels, "
+                                                 "decoding and sending in separate processes.")
+    parser.add_argument("video", help="Video file or stream for OpenCV to open.")
+    parser.add_argument("--ring", default=3, type=int, help="Number of frames in the shared ring.")
+    add_sender_arguments(parser)
+    parser.set_defaults(pps=SAFE_RATE, burst=1)
+    args = parser.parse_args()
+
+    sender = sender_from_args(args, 128, 128, channel_order=BGR_ORDER)
+    frame_shape = (sender.encoder.height, sender.encoder.width, 3)
+
+    ring_bytes = args.ring * int(np.prod(frame_shape))
+    shm = shared_memory.SharedMemory(create=True, size=ring_bytes)
+    ring = np.ndarray((args.ring,) + frame_shape, dtype=np.uint8, buffer=shm.buf)
+    ring[...] = 0
+
+    free_slots = mp.Queue()
+    ready_slots = mp.Queue()
+    for slot in range(args.ring):
+        free_slots.put(slot)
+    decoder_dropped = mp.Value('L', 0)
+    stop = mp.Event()
+
+    decoder = mp.Process(target=decode_worker,
+                         args=(args.video, shm.name, frame_shape, args.ring, free_slots, ready_slots,
+                               decoder_dropped, stop))
+    decoder.start()
+
+    frames = 0
+    stale = 0
+    metrics = sender.metrics
+    start_time = time.monotonic()
+    try:
+        t = time.perf_counter()
+        slot = ready_slots.get()
+        while slot != END_OF_STREAM:
+            metrics.since("wait", t)
+            # Skip ahead to the newest ready frame, recycling the rest. The
+            # end of the stream only stops the skipping, so the last frame
+            # still goes out
+            newer = None
+            while True:
+                try:
+                    newer = ready_slots.get_nowait()
+                except queue.Empty:
+                    newer = None
+                    break
+                if newer == END_OF_STREAM:
+                    break
+                free_slots.put(slot)
+                stale += 1
+                metrics.add("frames_stale")
+                slot = newer
+
+            sender.send_frame(ring[slot])
+            frames += 1
+            free_slots.put(slot)
+            if newer == END_OF_STREAM:
+                break
+            t = time.perf_counter()
+            slot = ready_slots.get()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_decoder(decoder, stop, ready_slots)
+        del ring
+        shm.close()
+        shm.unlink()
+
+    elapsed = time.monotonic() - start_time
+    print("sent %d frames in %.1fs (%.1f fps), dropped %d in the decoder and %d stale"
+          % (frames, elapsed, frames / elapsed if elapsed else 0.0,
+             decoder_dropped.value, stale))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,22 +12,253 @@
 #include <libliteeth/udp.h>
 #include <generated/csr.h>
 
+/* Packet layouts, selected by byte 1 (see panel_encoder.py) */
+#define OP_ADDRESSED 0
+#define OP_PIXELS18  1
+#define OP_PIXELS12  2
+#define OP_PIXELS9   3
+#define OP_RUNS      4
+#define OP_PALETTE   5
+#define OP_PRESENT   6
+
+/* 18-bit wire color to the panel_wdat layout */
+static inline uint32_t panel_wdat(uint32_t color)
+{
+    const uint32_t b = (color << 4) & (0x3f << 16);
+    const uint32_t r = (color << 2) & (0x3f << 8);
+    const uint32_t g = color & 0x3f;
+    return r | g | b;
+}
+
+#ifdef PANEL_BASE
+/* The framebuffer window (see PanelFramebuffer in wyrm.py): a store of the
+ * 18-bit color to word (mask << 16) | addr writes every masked port at once.
+ * The window has one 64K word block per mask, so its size gives the port count. */
+static inline volatile uint32_t *panel_window(uint8_t mask)
+{
+    return (volatile uint32_t *)PANEL_BASE + ((uint32_t)(mask & ((PANEL_SIZE >> 18) - 1)) << 16);
+}
+#else
+/* Port i's own addr<i>/wdat<i> CSR pair (see LedPanelController in wyrm.py).
+ * The pairs are laid out in port order, so each is a fixed stride from addr0. */
+#define PANEL_CSR_STEP (CSR_PANEL_WDAT0_ADDR - CSR_PANEL_ADDR0_ADDR)
+
+static inline void panel_port_addr_write(unsigned int port, uint32_t addr)
+{
+    csr_write_simple(addr, CSR_PANEL_ADDR0_ADDR + 2 * port * PANEL_CSR_STEP);
+}
+
+static inline void panel_port_wdat_write(unsigned int port, uint32_t wdat)
+{
+    csr_write_simple(wdat, CSR_PANEL_WDAT0_ADDR + 2 * port * PANEL_CSR_STEP);
+}
+#endif
+
+static inline void panel_write(uint8_t mask, uint32_t addr, uint32_t color)
+{
+#ifdef PANEL_BASE
+    panel_window(mask)[addr & 0xffff] = color & 0x3ffff;
+#else
+    /* Load every masked port's pair, then one en write stores them all */
+    const uint32_t wdat = panel_wdat(color);
+    panel_en_write(0);
+    for (unsigned int i = 0; i < PANEL_PORTS; i++) {
+        if (mask & (1 << i)) {
+            panel_port_wdat_write(i, wdat);
+            panel_port_addr_write(i, addr);
+        }
+    }
+    panel_en_write(mask);
+#endif
+}
+
+/* count pixels of one color from addr on */
+static inline void panel_fill(uint8_t mask, uint32_t addr, uint32_t count, uint32_t color)
+{
+#ifdef PANEL_BASE
+    volatile uint32_t *window = panel_window(mask);
+    color &= 0x3ffff;
+    while (count--)
+        window[addr++ & 0xffff] = color;
+#else
+    /* The color stays put for the whole run, only the addresses move */
+    const uint32_t wdat = panel_wdat(color);
+    panel_en_write(0);
+    for (unsigned int i = 0; i < PANEL_PORTS; i++)
+        if (mask & (1 << i))
+            panel_port_wdat_write(i, wdat);
+    while (count--) {
+        panel_en_write(0);
+        for (unsigned int i = 0; i < PANEL_PORTS; i++)
+            if (mask & (1 << i))
+                panel_port_addr_write(i, addr);
+        addr++;
+        panel_en_write(mask);
+    }
+#endif
+}
+
+/* On a double-buffered build the back buffer is still on display until a
+ * requested swap happens at the end of a scan, so hold off writing to it */
+static inline void panel_wait_swap(uint8_t mask)
+{
+#ifdef CSR_PANEL_SWAP_PENDING_ADDR
+    while (panel_swap_pending_read() & mask);
+#endif
+}
+
+/* Show what has been written since the last present, on every masked port at once */
+static void udp_present(uint8_t mask)
+{
+#ifdef CSR_PANEL_SWAP_ADDR
+    panel_swap_write(mask);
+#endif
+}
+
+/* 32-bit words of (addr << 18) | color */
+static void udp_addressed(uint8_t mask, const uint8_t *buf, unsigned int length)
+{
+    for (uint32_t i = 0; i + 4 <= length; i += 4) {
+        const uint32_t stuff = ntohl(*((uint32_t *)(&(buf[i]))));
+        panel_write(mask, stuff >> 18, stuff);
+    }
+}
+
+/* A 16-bit start address, then 18-bit colors packed four to 9 bytes */
+static void udp_pixels18(uint8_t mask, const uint8_t *buf, unsigned int length)
+{
+    if (length < 2)
+        return;
+    uint32_t addr = (buf[0] << 8) | buf[1];
+    for (uint32_t i = 2; i + 9 <= length; i += 9) {
+        const uint8_t *p = &buf[i];
+        panel_write(mask, addr++, (p[0] << 10) | (p[1] << 2) | (p[2] >> 6));
+        panel_write(mask, addr++, ((p[2] & 0x3f) << 12) | (p[3] << 4) | (p[4] >> 4));
+        panel_write(mask, addr++, ((p[4] & 0x0f) << 14) | (p[5] << 6) | (p[6] >> 2));
+        panel_write(mask, addr++, ((p[6] & 0x03) << 16) | (p[7] << 8) | p[8]);
+    }
+}
+
+/* Widen 4- and 3-bit fields to the panel's 6 bits by repeating the top bits */
+static inline uint32_t widen444(uint32_t p)
+{
+    const uint32_t c0 = (p >> 8) & 0xf;
+    const uint32_t c1 = (p >> 4) & 0xf;
+    const uint32_t c2 = p & 0xf;
+    return (((c0 << 2) | (c0 >> 2)) << 12) | (((c1 << 2) | (c1 >> 2)) << 6) | ((c2 << 2) | (c2 >> 2));
+}
+
+static inline uint32_t widen333(uint32_t p)
+{
+    const uint32_t c0 = (p >> 6) & 0x7;
+    const uint32_t c1 = (p >> 3) & 0x7;
+    const uint32_t c2 = p & 0x7;
+    return (((c0 << 3) | c0) << 12) | (((c1 << 3) | c1) << 6) | ((c2 << 3) | c2);
+}
+
+/* A 16-bit start address, then RGB444 colors packed two to 3 bytes */
+static void udp_pixels12(uint8_t mask, const uint8_t *buf, unsigned int length)
+{
+    if (length < 2)
+        return;
+    uint32_t addr = (buf[0] << 8) | buf[1];
+    for (uint32_t i = 2; i + 3 <= length; i += 3) {
+        const uint8_t *p = &buf[i];
+        panel_write(mask, addr++, widen444((p[0] << 4) | (p[1] >> 4)));
+        panel_write(mask, addr++, widen444(((p[1] & 0x0f) << 8) | p[2]));
+    }
+}
+
+/* A 16-bit start address, then RGB333 colors packed eight to 9 bytes */
+static void udp_pixels9(uint8_t mask, const uint8_t *buf, unsigned int length)
+{
+    if (length < 2)
+        return;
+    uint32_t addr = (buf[0] << 8) | buf[1];
+    for (uint32_t i = 2; i + 9 <= length; i += 9) {
+        const uint8_t *p = &buf[i];
+        panel_write(mask, addr++, widen333((p[0] << 1) | (p[1] >> 7)));
+        panel_write(mask, addr++, widen333(((p[1] & 0x7f) << 2) | (p[2] >> 6)));
+        panel_write(mask, addr++, widen333(((p[2] & 0x3f) << 3) | (p[3] >> 5)));
+        panel_write(mask, addr++, widen333(((p[3] & 0x1f) << 4) | (p[4] >> 4)));
+        panel_write(mask, addr++, widen333(((p[4] & 0x0f) << 5) | (p[5] >> 3)));
+        panel_write(mask, addr++, widen333(((p[5] & 0x07) << 6) | (p[6] >> 2)));
+        panel_write(mask, addr++, widen333(((p[6] & 0x03) << 7) | (p[7] >> 1)));
+        panel_write(mask, addr++, widen333(((p[7] & 0x01) << 8) | p[8]));
+    }
+}
+
+/* A 16-bit start address, then 32-bit words of ((run length - 1) << 18) | color */
+static void udp_runs(uint8_t mask, const uint8_t *buf, unsigned int length)
+{
+    if (length < 2)
+        return;
+    uint32_t addr = (buf[0] << 8) | buf[1];
+    for (uint32_t i = 2; i + 4 <= length; i += 4) {
+        const uint32_t stuff = ntohl(*((uint32_t *)(&(buf[i]))));
+        const uint32_t count = (stuff >> 18) + 1;
+        panel_fill(mask, addr, count, stuff);
+        addr += count;
+    }
+}
+
+/* A 16-bit start address, the index width (1, 2, 4 or 8 bits), the palette
+ * size - 1, the palette as 3-byte colors, then the indices packed MSB first */
+static void udp_palette(uint8_t mask, const uint8_t *buf, unsigned int length)
+{
+    static uint32_t palette[256];
+    if (length < 4)
+        return;
+    uint32_t addr = (buf[0] << 8) | buf[1];
+    const uint32_t bits = buf[2];
+    const uint32_t colors = buf[3] + 1;
+    if ((bits != 1 && bits != 2 && bits != 4 && bits != 8) || 4 + 3 * colors > length)
+        return;
+    for (uint32_t c = 0; c < colors; c++) {
+        const uint8_t *p = &buf[4 + 3 * c];
+        palette[c] = (p[0] << 16) | (p[1] << 8) | p[2];
+    }
+    const uint32_t index_mask = (1 << bits) - 1;
+    for (uint32_t i = 4 + 3 * colors; i < length; i++) {
+        for (int shift = 8 - bits; shift >= 0; shift -= bits)
+            panel_write(mask, addr++, palette[(buf[i] >> shift) & index_mask]);
+    }
+}
+
 void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_port, void *data, unsigned int length);
 void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_port, void *data, unsigned int length)
 {
     uint8_t *buf = (uint8_t *)data;
-    for (uint32_t i = 2; i < length; i += 4) {
-        main_panel_en_write(0);
-        const uint32_t stuff = ntohl(*((uint32_t *)(&(buf[i]))));
-        const uint32_t addr = stuff >> 18;
-        const uint32_t b = (stuff << 4) & (0x3f << 16);
-        const uint32_t r = (stuff << 2) & (0x3f << 8);
-        const uint32_t g = stuff & 0x3f;
-        main_panel_wdat_write(r | g | b);
-        main_panel_addr_write(addr);
-        main_panel_en_write(buf[0]);
+    if (length < 2)
+        return;
+    if (buf[1] == OP_PRESENT) {
+        udp_present(buf[0]);
+        return;
+    }
+    panel_wait_swap(buf[0]);
+    switch (buf[1]) {
+    case OP_ADDRESSED:
+        udp_addressed(buf[0], &buf[2], length - 2);
+        break;
+    case OP_PIXELS18:
+        udp_pixels18(buf[0], &buf[2], length - 2);
+        break;
+    case OP_PIXELS12:
+        udp_pixels12(buf[0], &buf[2], length - 2);
+        break;
+    case OP_PIXELS9:
+        udp_pixels9(buf[0], &buf[2], length - 2);
+        break;
+    case OP_RUNS:
+        udp_runs(buf[0], &buf[2], length - 2);
+        break;
+    case OP_PALETTE:
+        udp_palette(buf[0], &buf[2], length - 2);
+        break;
+    default:
+        break;
     }
-    main_panel_en_write(0);
+    panel_en_write(0);
 }
 
 __attribute__((__used__)) int main(int argc, char **argv)
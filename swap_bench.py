@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Simulated back buffer swaps in ledpanel.v
+#
+# Builds ledpanel with DOUBLE_BUFFER=1 into a C++ model with Yosys' CXXRTL
+# backend and drives it from both clock domains, the way LedPanelController
+# does: the ctrl side fills the whole back buffer with one color (black or
+# white, alternating), waits a random number of ctrl cycles and pulses
+# ctrl_swap, then waits for ctrl_swap_pending to drop before starting on the
+# next frame. The panel side is watched at its pins: every bit shifted out
+# on panel_clk, and the row on panel_[ABCDE] at each panel_stb.
+#
+# Each round checks that
+#   - every row shifted out is entirely one color, so nothing tears
+#   - the frame that was on display when ctrl_swap came keeps the old color
+#     to its last row, and the new one starts on row 0 of the next frame
+#     (or the one after, if the request was still crossing clock domains
+#     when the scan got there)
+#   - ctrl_swap_pending stays high until that frame has started, and drops
+#     a few ctrl cycles later
+# once with the display clock unrelated to the ctrl clock and once with
+# both on the same clock, as BaseSoC builds it.
+#
+# Needs yosys (or the yowasp-yosys package) and a C++ compiler.
+#
+# Usage: ./swap_bench.py [--rounds 6] [--seed 1]
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MEM_FILES = ["6bit_to_6bit_gamma.mem", "red.mem", "green.mem", "blue.mem"]
+ROWS = 32
+PLANES = 6
+# Bits shifted out per row: 64 pixels on each of six color lines
+ROW_BITS = 64 * 6
+# Display cycles from the end of the frame's first row back to the swap,
+# plus the synchronizer; a request arriving within that may miss it
+CROSSING = 200
+
+# (name, ctrl period, display period) in picoseconds
+CLOCKS = [
+    ("async", 20000, 37000),
+    ("same",  20000, 20000),
+]
+
+DRIVER = r"""
+#include <cstdio>
+#include <cstdlib>
+#include <vector>
+#include "ledpanel.cc"
+
+using namespace cxxrtl_design;
+
+int main(int argc, char **argv)
+{
+    const long ctrl_period = atol(argv[1]), display_period = atol(argv[2]);
+    std::vector<long> waits;
+    for (int i = 3; i < argc; i++)
+        waits.push_back(atol(argv[i]));
+
+    p_ledpanel top;
+    long now = 0, next_ctrl = 0, next_display = 0;
+    bool ctrl_clk = false, display_clk = false;
+    bool last_clk = false, last_stb = false, last_pending = false;
+    int ones = 0, bits = 0;
+
+    // Ctrl side: 0 write the back buffer, 1 wait, 2 swap, 3 wait for pending
+    // to rise and 4 for it to drop, 5 done
+    size_t round = 0;
+    int phase = 0;
+    long addr = 0, wait = 0;
+    // Rows to watch after the last swap, so its new frame gets shifted out
+    int tail = 2 * 32 * 6;
+    top.step();
+    while (tail > 0) {
+        const long t = next_ctrl < next_display ? next_ctrl : next_display;
+        now = t;
+        bool ctrl_rise = false, display_rise = false;
+        if (next_ctrl == t) {
+            ctrl_clk = !ctrl_clk;
+            ctrl_rise = ctrl_clk;
+            next_ctrl += ctrl_period / 2;
+            if (!ctrl_clk) {
+                // Change the ctrl inputs away from the rising edge
+                const bool pending = top.p_ctrl__swap__pending.get<bool>();
+                top.p_ctrl__en.set<bool>(false);
+                top.p_ctrl__swap.set<bool>(false);
+                if (pending != last_pending)
+                    printf("pending %ld %d\n", now, pending);
+                last_pending = pending;
+                if (phase == 0) {
+                    top.p_ctrl__en.set<bool>(true);
+                    top.p_ctrl__addr.set<uint32_t>(addr);
+                    top.p_ctrl__wdat.set<uint32_t>(round & 1 ? 0 : 0x3f3f3f);
+                    if (++addr == 4096) {
+                        phase = 1;
+                        wait = waits[round];
+                    }
+                } else if (phase == 1) {
+                    if (wait-- == 0)
+                        phase = 2;
+                } else if (phase == 2) {
+                    top.p_ctrl__swap.set<bool>(true);
+                    printf("swap %ld %zu\n", now, round);
+                    phase = 3;
+                } else if (phase == 3 && pending) {
+                    phase = 4;
+                } else if (phase == 4 && !pending) {
+                    round++;
+                    phase = round < waits.size() ? 0 : 5;
+                    addr = 0;
+                }
+            }
+        }
+        if (next_display == t) {
+            display_clk = !display_clk;
+            display_rise = display_clk;
+            next_display += display_period / 2;
+        }
+        top.p_ctrl__clk.set<bool>(ctrl_clk);
+        top.p_display__clock.set<bool>(display_clk);
+        top.step();
+        if (!display_rise)
+            continue;
+        const bool clk = top.p_panel__clk.get<bool>(), stb = top.p_panel__stb.get<bool>();
+        if (clk && !last_clk) {
+            ones += top.p_panel__r0.get<int>() + top.p_panel__g0.get<int>() + top.p_panel__b0.get<int>() +
+                    top.p_panel__r1.get<int>() + top.p_panel__g1.get<int>() + top.p_panel__b1.get<int>();
+            bits += 6;
+        }
+        if (stb && !last_stb) {
+            const int row = top.p_panel__a.get<int>() | top.p_panel__b.get<int>() << 1 |
+                            top.p_panel__c.get<int>() << 2 | top.p_panel__d.get<int>() << 3 |
+                            top.p_panel__e.get<int>() << 4;
+            printf("stb %ld %d %d %d\n", now, row, ones, bits);
+            ones = bits = 0;
+            if (phase == 5)
+                tail--;
+        }
+        last_clk = clk;
+        last_stb = stb;
+    }
+    return 0;
+}
+"""
+
+
+def yosys_command():
+    """The yosys to run and the CXXRTL runtime headers that go with it."""
+    yosys = shutil.which("yosys")
+    if yosys is not None:
+        datdir = subprocess.check_output(["yosys-config", "--datdir"], text=True).strip()
+        return [yosys], os.path.join(datdir, "include", "backends", "cxxrtl", "runtime")
+    import yowasp_yosys
+    share = os.path.join(os.path.dirname(yowasp_yosys.__file__), "share")
+    return ["yowasp-yosys"], os.path.join(share, "include", "backends", "cxxrtl", "runtime")
+
+
+def build(workdir):
+    """Compile ledpanel.v with DOUBLE_BUFFER=1 and the driver, return the binary."""
+    for name in ["ledpanel.v"] + MEM_FILES:
+        shutil.copy(os.path.join(HERE, name), workdir)
+    yosys, runtime = yosys_command()
+    # $readmemh is resolved now, relative to the working directory
+    subprocess.check_call(yosys + ["-q", "-p", "read_verilog ledpanel.v; chparam -set DOUBLE_BUFFER 1 ledpanel; "
+                                               "write_cxxrtl ledpanel.cc"], cwd=workdir)
+    with open(os.path.join(workdir, "driver.cc"), "w") as f:
+        f.write(DRIVER)
+    binary = os.path.join(workdir, "swap_sim")
+    subprocess.check_call([os.environ.get("CXX", "c++"), "-std=c++14", "-O2", "-I", runtime,
+                           "-o", binary, "driver.cc"], cwd=workdir)
+    return binary
+
+
+def run(binary, ctrl_period, display_period, waits):
+    """Events from one simulation: ("stb", t, row, ones, bits),
+    ("swap", t, round) and ("pending", t, level)."""
+    out = subprocess.check_output([binary, str(ctrl_period), str(display_period)] + [str(w) for w in waits],
+                                  text=True)
+    return [(line.split()[0],) + tuple(int(v) for v in line.split()[1:]) for line in out.splitlines()]
+
+
+def check(events, display_period):
+    """One result per swap. Rows are told apart by the stb that latches
+    them, which comes a little after the start of the row, and a frame's
+    swap happens between the stb of row 31 and that of row 0."""
+    rows = [e[1:] for e in events if e[0] == "stb"]
+    swaps = [e[1:] for e in events if e[0] == "swap"]
+    falls = [e[1] for e in events if e[0] == "pending" and e[2] == 0]
+    # Index in rows of each frame's first row
+    starts = [i for i in range(1, len(rows)) if rows[i][1] == 0 and rows[i - 1][1] == ROWS - 1]
+
+    results = []
+    for t_swap, index in swaps:
+        new = index % 2 == 0
+        later = [i for i in starts if rows[i][0] > t_swap]
+        if not later:
+            break
+        # A request that reaches the scan just as it wraps can go either way
+        first = later[0]
+        if rows[first][0] - t_swap < CROSSING * display_period and rows[first][2] != new * rows[first][3]:
+            first = later[1]
+        after = rows[first:]
+        since = [r for r in rows[:first] if r[0] > t_swap]
+        fall = next((t for t in falls if t > t_swap), None)
+        results.append({
+            "round": index,
+            "color": "white" if new else "black",
+            "swap_us": t_swap / 1e6,
+            "shown_us": rows[first][0] / 1e6,
+            "old_rows": len(since),
+            "pending_us": None if fall is None else (fall - t_swap) / 1e6,
+            # The old frame keeps its color (the very first is the .mem image),
+            # the new one has it from row 0 on, and every row is one color
+            "ok": ((index == 0 or all(r[2] == (not new) * r[3] for r in since))
+                   and all(r[2] == new * r[3] and r[3] == ROW_BITS for r in after[:ROWS * PLANES])
+                   and fall is not None and rows[first - 1][0] < fall <= rows[first][0]),
+        })
+    return results
+
+
+def bench(rounds, seed):
+    rng = random.Random(seed)
+    results = []
+    workdir = tempfile.mkdtemp(prefix="swap_bench")
+    try:
+        binary = build(workdir)
+        for name, ctrl_period, display_period in CLOCKS:
+            waits = [rng.randrange(0, 400000) for _ in range(rounds)]
+            for r in check(run(binary, ctrl_period, display_period, waits), display_period):
+                r["clocks"] = name
+                results.append(r)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate ledpanel back buffer swaps across clock domains.")
+    parser.add_argument("--rounds", default=6, type=int, help="Swaps to make per clock setup.")
+    parser.add_argument("--seed", default=1, type=int, help="Seed for when each swap is requested.")
+    args = parser.parse_args()
+
+    print("%-6s %5s %6s %10s %10s %9s %11s %4s" % ("clocks", "round", "color", "swap us", "shown us",
+                                                   "old rows", "pending us", "ok"))
+    for r in bench(args.rounds, args.seed):
+        print("%-6s %5d %6s %10.1f %10.1f %9d %11s %4s"
+              % (r["clocks"], r["round"], r["color"], r["swap_us"], r["shown_us"], r["old_rows"],
+                 "-" if r["pending_us"] is None else "%.1f" % r["pending_us"],
+                 "yes" if r["ok"] else "NO"))
+
+if __name__ == "__main__":
+    main()
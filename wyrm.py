@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import os
+import random
+import shlex
+import subprocess
+
 from migen import *
 from migen.genlib.resetsync import AsyncResetSynchronizer
 
@@ -10,9 +15,11 @@ from litex.build.io import DDROutput
 from litex_boards.platforms import colorlight_5a_75b
 
 from litex.soc.cores.clock import *
+from litex.soc.integration.soc import SoCRegion
 from litex.soc.integration.soc_core import *
 from litex.soc.integration.builder import *
 from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import wishbone
 from litex.soc.cores.gpio import GPIOOut
 
 from litedram.modules import M12L16161A, M12L64322A
@@ -21,6 +28,8 @@ from litedram.phy import GENSDRPHY, HalfRateGENSDRPHY
 from liteeth.phy.ecp5rgmii import LiteEthPHYRGMII
 from litex.build.generic_platform import *
 
+import bit_to_flash
+
 _gpios = [
     ("panel_r0",  1, Pins("j1:0"), IOStandard("LVCMOS33")),
     ("panel_g0",  1, Pins("j1:1"), IOStandard("LVCMOS33")),
@@ -83,6 +92,15 @@ _gpios = [
     ("panel_oe",  4, Pins("j4:14"), IOStandard("LVCMOS33")),
 ]
 
+# j5-j8 have the same layout. The row select, clock, latch and output enable
+# pins are common to all eight connectors, so only one port drives those.
+_panel_pins = {"r0": 0, "g0": 1, "b0": 2, "r1": 4, "g1": 5, "b1": 6,
+               "e": 7, "a": 8, "b": 9, "c": 10, "d": 11, "clk": 12, "stb": 13, "oe": 14}
+_panel_data_pins = ["r0", "g0", "b0", "r1", "g1", "b1"]
+
+_gpios += [("panel_" + name, j, Pins("j{}:{}".format(j, pin)), IOStandard("LVCMOS33"))
+    for j in range(5, 9) for name, pin in _panel_pins.items()]
+
 # CRG ----------------------------------------------------------------------------------------------
 
 class _CRG(LiteXModule):
@@ -140,8 +158,137 @@ class _CRG(LiteXModule):
         sdram_clk = ClockSignal("sys2x_ps" if sdram_rate == "1:2" else "sys_ps")
         self.specials += DDROutput(1, 0, platform.request("sdram_clock"), sdram_clk)
 
+# Panel Framebuffer --------------------------------------------------------------------------------
+
+class PanelFramebuffer(LiteXModule):
+    """Write-only Wishbone window onto the ledpanel video memories.
+
+    Storing an 18-bit wire color (c0 << 12) | (c1 << 6) | c2 to word
+    (mask << 16) | addr of the window writes it at addr of every port set in
+    mask, in the same cycle - one store per pixel instead of the four CSR
+    writes through the CSRs. Reads return 0.
+    """
+    def __init__(self, n_ports=4):
+        self.size = 4 << (16 + n_ports) # Every mask x 64K addresses x 4 bytes.
+        self.bus  = bus = wishbone.Interface(data_width=32)
+        self.en   = Signal(n_ports)
+        self.addr = Signal(16)
+        self.wdat = Signal(24)
+
+        # # #
+
+        self.comb += [
+            self.addr.eq(bus.adr[:16]),
+            # Same shuffle as panel_wdat() in the firmware.
+            self.wdat.eq(Cat(bus.dat_w[0:6], C(0, 2), bus.dat_w[6:12], C(0, 2), bus.dat_w[12:18])),
+            If(bus.cyc & bus.stb & bus.we & ~bus.ack,
+                self.en.eq(bus.adr[16:16 + n_ports])
+            ),
+        ]
+        self.sync += bus.ack.eq(bus.cyc & bus.stb & ~bus.ack)
+
+# LED Panels ---------------------------------------------------------------------------------------
+
+def panel_pads(platform, connector, with_control=True):
+    """Request one connector's panel pins (see _gpios) as {pin name: pad}."""
+    names = _panel_pins if with_control else _panel_data_pins
+    return {name: platform.request("panel_" + name, connector) for name in names}
+
+class LedPanelController(LiteXModule):
+    """Write side of n_ports ledpanel instances, each with its own write channel.
+
+    channels[i] (en, addr, wdat) is what port i writes into its video memory
+    every cycle en is set. Each port has its own addr<i>/wdat<i> CSRs, and
+    every port whose bit is set in en writes what its own pair holds, so
+    loading several pairs and then setting en writes a different pixel to
+    each of those ports in the same cycle. The framebuffer window (fb) feeds
+    the ports in the mask of each store with the same pixel, and takes
+    priority over the CSRs for those ports.
+
+    With double_buffer, writing a mask to swap makes those ports show their
+    back buffers from the next full scan on, and swap_pending says which
+    haven't yet.
+    """
+    def __init__(self, n_ports=4, double_buffer=False):
+        self.n_ports       = n_ports
+        self.double_buffer = double_buffer
+        self.channels      = [Record([("en", 1), ("addr", 16), ("wdat", 24)]) for _ in range(n_ports)]
+        self.swaps         = Signal(n_ports)
+        self.swaps_pending = Signal(n_ports)
+
+        self.en = CSRStorage(size=n_ports)
+        # Created in port order, so each pair sits at a fixed stride from
+        # addr0 (PANEL_CSR_STEP in panel_port_addr_write()/panel_port_wdat_write()
+        # in the firmware).
+        self.addrs = []
+        self.wdats = []
+        for i in range(n_ports):
+            addr = CSRStorage(size=16, name="addr{}".format(i))
+            wdat = CSRStorage(size=24, name="wdat{}".format(i))
+            setattr(self, addr.name, addr)
+            setattr(self, wdat.name, wdat)
+            self.addrs.append(addr)
+            self.wdats.append(wdat)
+        if double_buffer:
+            self.swap         = CSRStorage(size=n_ports)
+            self.swap_pending = CSRStatus(size=n_ports)
+        self.fb = PanelFramebuffer(n_ports=n_ports)
+
+        # # #
+
+        for i, channel in enumerate(self.channels):
+            self.comb += If(self.fb.en[i],
+                channel.en.eq(1),
+                channel.addr.eq(self.fb.addr),
+                channel.wdat.eq(self.fb.wdat),
+            ).Else(
+                channel.en.eq(self.en.storage[i]),
+                channel.addr.eq(self.addrs[i].storage),
+                channel.wdat.eq(self.wdats[i].storage),
+            )
+        if double_buffer:
+            self.comb += [
+                self.swaps.eq(Replicate(self.swap.re, n_ports) & self.swap.storage),
+                self.swap_pending.status.eq(self.swaps_pending),
+            ]
+
+    def add_panels(self, platform, pads, chained=1, display_clock="sys"):
+        """Instantiate ledpanel for each port, driving the pads given for it.
+
+        pads has one {pin name: pad} dict per port (see panel_pads); pins a
+        port leaves out are not driven. chained is the number of panels
+        daisy-chained on each connector.
+        """
+        assert len(pads) == self.n_ports
+        for i, port_pads in enumerate(pads):
+            channel = self.channels[i]
+            outputs = {name: Signal(name="panel{}_{}".format(i, name)) for name in _panel_pins}
+            self.specials += Instance("ledpanel",
+                p_CHAINED           = chained,
+                p_DOUBLE_BUFFER     = int(self.double_buffer),
+                i_ctrl_clk          = ClockSignal(),
+                i_ctrl_en           = channel.en,
+                i_ctrl_addr         = channel.addr,
+                i_ctrl_wdat         = channel.wdat,
+                i_ctrl_swap         = self.swaps[i],
+                o_ctrl_swap_pending = self.swaps_pending[i],
+                i_display_clock     = ClockSignal(display_clock),
+                **{"o_panel_" + name: sig for name, sig in outputs.items()}
+            )
+            for name, pad in port_pads.items():
+                self.comb += pad.eq(outputs[name])
+        platform.add_source("ledpanel.v")
+
 # BaseSoC ------------------------------------------------------------------------------------------
 
+ROM_SIZE = 12288
+# Each panel port takes 6 of the LFE5U-25F's 56 EBR blocks, or 9 with a back
+# buffer; next to the rest of the SoC that leaves room for four ports, or two
+# double-buffered ones
+MAX_PANEL_PORTS           = 4
+MAX_DOUBLE_BUFFERED_PORTS = 2
+
+
 class BaseSoC(SoCCore):
     def __init__(self, revision, sys_clk_freq=50e6, toolchain="trellis",
         with_ethernet    = False,
@@ -153,309 +300,19 @@ class BaseSoC(SoCCore):
         sdram_rate       = "1:1",
         with_spi_flash   = False,
         rom              = None,
+        double_buffer    = False,
+        panel_connectors = (4, 3, 2, 1),
+        panel_chained    = 1,
         **kwargs):
         platform = colorlight_5a_75b.Platform(revision=revision, toolchain=toolchain)
 
-        # LED Panel --------------------------------------------------------------------------------
-        s_shared_en = Signal(4)
-        s_j4_ctrl_en = Signal()
-        s_j4_ctrl_addr = Signal(16)
-        s_j4_ctrl_wdat = Signal(24)
-        s_j4r0 = Signal()
-        s_j4g0 = Signal()
-        s_j4b0 = Signal()
-        s_j4r1 = Signal()
-        s_j4g1 = Signal()
-        s_j4b1 = Signal()
-        s_j4a = Signal()
-        s_j4b = Signal()
-        s_j4c = Signal()
-        s_j4d = Signal()
-        s_j4e = Signal()
-        s_j4clk = Signal()
-        s_j4stb = Signal()
-        s_j4oe = Signal()
-        self.specials += Instance("ledpanel",
-            i_ctrl_clk = ClockSignal(),
-            i_ctrl_en = s_j4_ctrl_en,
-            i_ctrl_addr = s_j4_ctrl_addr,
-            i_ctrl_wdat = s_j4_ctrl_wdat,
-            i_display_clock = ClockSignal("sys"),
-            o_panel_r0 = s_j4r0,
-            o_panel_g0 = s_j4g0,
-            o_panel_b0 = s_j4b0,
-            o_panel_r1 = s_j4r1,
-            o_panel_g1 = s_j4g1,
-            o_panel_b1 = s_j4b1,
-            o_panel_a = s_j4a,
-            o_panel_b = s_j4b,
-            o_panel_c = s_j4c,
-            o_panel_d = s_j4d,
-            o_panel_e = s_j4e,
-            o_panel_clk = s_j4clk,
-            o_panel_stb = s_j4stb,
-            o_panel_oe = s_j4oe
-        )
-        platform.add_source("ledpanel.v")
-
+        # LED Panels -------------------------------------------------------------------------------
+        # Port i answers to bit i of the panel mask; the first connector
+        # listed drives the row select and clock lines shared by all of them.
         platform.add_extension(_gpios)
-        j4r0 = platform.request("panel_r0", 4);
-        j4g0 = platform.request("panel_g0", 4);
-        j4b0 = platform.request("panel_b0", 4);
-        j4r1 = platform.request("panel_r1", 4);
-        j4g1 = platform.request("panel_g1", 4);
-        j4b1 = platform.request("panel_b1", 4);
-        j4E = platform.request("panel_e", 4);
-        j4A = platform.request("panel_a", 4);
-        j4B = platform.request("panel_b", 4);
-        j4C = platform.request("panel_c", 4);
-        j4D = platform.request("panel_d", 4);
-        j4clk = platform.request("panel_clk", 4);
-        j4stb = platform.request("panel_stb", 4);
-        j4oe = platform.request("panel_oe", 4);
-
-        self.panel_en = CSRStorage(size=4)
-        self.panel_addr = CSRStorage(size=16)
-        self.panel_wdat = CSRStorage(size=24)
-
-        self.comb += s_shared_en.eq(self.panel_en.storage)
-
-        self.comb += j4r0.eq(s_j4r0)
-        self.comb += j4g0.eq(s_j4g0)
-        self.comb += j4b0.eq(s_j4b0)
-        self.comb += j4r1.eq(s_j4r1)
-        self.comb += j4g1.eq(s_j4g1)
-        self.comb += j4b1.eq(s_j4b1)
-        self.comb += j4A.eq(s_j4a)
-        self.comb += j4B.eq(s_j4b)
-        self.comb += j4C.eq(s_j4c)
-        self.comb += j4D.eq(s_j4d)
-        self.comb += j4E.eq(s_j4e)
-        self.comb += j4clk.eq(s_j4clk)
-        self.comb += j4stb.eq(s_j4stb)
-        self.comb += j4oe.eq(s_j4oe)
-        self.comb += s_j4_ctrl_en.eq(s_shared_en[0])
-        self.comb += s_j4_ctrl_addr.eq(self.panel_addr.storage)
-        self.comb += s_j4_ctrl_wdat.eq(self.panel_wdat.storage)
-
-        s_j3_ctrl_en = Signal()
-        s_j3_ctrl_addr = Signal(16)
-        s_j3_ctrl_wdat = Signal(24)
-        s_j3r0 = Signal()
-        s_j3g0 = Signal()
-        s_j3b0 = Signal()
-        s_j3r1 = Signal()
-        s_j3g1 = Signal()
-        s_j3b1 = Signal()
-        s_j3a = Signal()
-        s_j3b = Signal()
-        s_j3c = Signal()
-        s_j3d = Signal()
-        s_j3e = Signal()
-        s_j3clk = Signal()
-        s_j3stb = Signal()
-        s_j3oe = Signal()
-        self.specials += Instance("ledpanel",
-            i_ctrl_clk = ClockSignal(),
-            i_ctrl_en = s_j3_ctrl_en,
-            i_ctrl_addr = s_j3_ctrl_addr,
-            i_ctrl_wdat = s_j3_ctrl_wdat,
-            i_display_clock = ClockSignal("sys"),
-            o_panel_r0 = s_j3r0,
-            o_panel_g0 = s_j3g0,
-            o_panel_b0 = s_j3b0,
-            o_panel_r1 = s_j3r1,
-            o_panel_g1 = s_j3g1,
-            o_panel_b1 = s_j3b1,
-            o_panel_a = s_j3a,
-            o_panel_b = s_j3b,
-            o_panel_c = s_j3c,
-            o_panel_d = s_j3d,
-            o_panel_e = s_j3e,
-            o_panel_clk = s_j3clk,
-            o_panel_stb = s_j3stb,
-            o_panel_oe = s_j3oe
-        )
-
-        platform.add_extension(_gpios)
-        j3r0 = platform.request("panel_r0", 3);
-        j3g0 = platform.request("panel_g0", 3);
-        j3b0 = platform.request("panel_b0", 3);
-        j3r1 = platform.request("panel_r1", 3);
-        j3g1 = platform.request("panel_g1", 3);
-        j3b1 = platform.request("panel_b1", 3);
-        #j3E = platform.request("panel_e", 3);
-        #j3A = platform.request("panel_a", 3);
-        #j3B = platform.request("panel_b", 3);
-        #j3C = platform.request("panel_c", 3);
-        #j3D = platform.request("panel_d", 3);
-        #j3clk = platform.request("panel_clk", 3);
-        #j3stb = platform.request("panel_stb", 3);
-        #j3oe = platform.request("panel_oe", 3);
-
-        self.comb += j3r0.eq(s_j3r0)
-        self.comb += j3g0.eq(s_j3g0)
-        self.comb += j3b0.eq(s_j3b0)
-        self.comb += j3r1.eq(s_j3r1)
-        self.comb += j3g1.eq(s_j3g1)
-        self.comb += j3b1.eq(s_j3b1)
-        #self.comb += j3A.eq(s_j3a)
-        #self.comb += j3B.eq(s_j3b)
-        #self.comb += j3C.eq(s_j3c)
-        #self.comb += j3D.eq(s_j3d)
-        #self.comb += j3E.eq(s_j3e)
-        #self.comb += j3clk.eq(s_j3clk)
-        #self.comb += j3stb.eq(s_j3stb)
-        #self.comb += j3oe.eq(s_j3oe)
-        self.comb += s_j3_ctrl_en.eq(s_shared_en[1])
-        self.comb += s_j3_ctrl_addr.eq(self.panel_addr.storage)
-        self.comb += s_j3_ctrl_wdat.eq(self.panel_wdat.storage)
-
-        s_j2_ctrl_en = Signal()
-        s_j2_ctrl_addr = Signal(16)
-        s_j2_ctrl_wdat = Signal(24)
-        s_j2r0 = Signal()
-        s_j2g0 = Signal()
-        s_j2b0 = Signal()
-        s_j2r1 = Signal()
-        s_j2g1 = Signal()
-        s_j2b1 = Signal()
-        s_j2a = Signal()
-        s_j2b = Signal()
-        s_j2c = Signal()
-        s_j2d = Signal()
-        s_j2e = Signal()
-        s_j2clk = Signal()
-        s_j2stb = Signal()
-        s_j2oe = Signal()
-        self.specials += Instance("ledpanel",
-            i_ctrl_clk = ClockSignal(),
-            i_ctrl_en = s_j2_ctrl_en,
-            i_ctrl_addr = s_j2_ctrl_addr,
-            i_ctrl_wdat = s_j2_ctrl_wdat,
-            i_display_clock = ClockSignal("sys"),
-            o_panel_r0 = s_j2r0,
-            o_panel_g0 = s_j2g0,
-            o_panel_b0 = s_j2b0,
-            o_panel_r1 = s_j2r1,
-            o_panel_g1 = s_j2g1,
-            o_panel_b1 = s_j2b1,
-            o_panel_a = s_j2a,
-            o_panel_b = s_j2b,
-            o_panel_c = s_j2c,
-            o_panel_d = s_j2d,
-            o_panel_e = s_j2e,
-            o_panel_clk = s_j2clk,
-            o_panel_stb = s_j2stb,
-            o_panel_oe = s_j2oe
-        )
-
-        platform.add_extension(_gpios)
-        j2r0 = platform.request("panel_r0", 2);
-        j2g0 = platform.request("panel_g0", 2);
-        j2b0 = platform.request("panel_b0", 2);
-        j2r1 = platform.request("panel_r1", 2);
-        j2g1 = platform.request("panel_g1", 2);
-        j2b1 = platform.request("panel_b1", 2);
-        #j2E = platform.request("panel_e", 2);
-        #j2A = platform.request("panel_a", 2);
-        #j2B = platform.request("panel_b", 2);
-        #j2C = platform.request("panel_c", 2);
-        #j2D = platform.request("panel_d", 2);
-        #j2clk = platform.request("panel_clk", 2);
-        #j2stb = platform.request("panel_stb", 2);
-        #j2oe = platform.request("panel_oe", 2);
-
-        self.comb += j2r0.eq(s_j2r0)
-        self.comb += j2g0.eq(s_j2g0)
-        self.comb += j2b0.eq(s_j2b0)
-        self.comb += j2r1.eq(s_j2r1)
-        self.comb += j2g1.eq(s_j2g1)
-        self.comb += j2b1.eq(s_j2b1)
-        #self.comb += j2A.eq(s_j2a)
-        #self.comb += j2B.eq(s_j2b)
-        #self.comb += j2C.eq(s_j2c)
-        #self.comb += j2D.eq(s_j2d)
-        #self.comb += j2E.eq(s_j2e)
-        #self.comb += j2clk.eq(s_j2clk)
-        #self.comb += j2stb.eq(s_j2stb)
-        #self.comb += j2oe.eq(s_j2oe)
-        self.comb += s_j2_ctrl_en.eq(s_shared_en[2])
-        self.comb += s_j2_ctrl_addr.eq(self.panel_addr.storage)
-        self.comb += s_j2_ctrl_wdat.eq(self.panel_wdat.storage)
-
-        s_j1_ctrl_en = Signal()
-        s_j1_ctrl_addr = Signal(16)
-        s_j1_ctrl_wdat = Signal(24)
-        s_j1r0 = Signal()
-        s_j1g0 = Signal()
-        s_j1b0 = Signal()
-        s_j1r1 = Signal()
-        s_j1g1 = Signal()
-        s_j1b1 = Signal()
-        s_j1a = Signal()
-        s_j1b = Signal()
-        s_j1c = Signal()
-        s_j1d = Signal()
-        s_j1e = Signal()
-        s_j1clk = Signal()
-        s_j1stb = Signal()
-        s_j1oe = Signal()
-        self.specials += Instance("ledpanel",
-            i_ctrl_clk = ClockSignal(),
-            i_ctrl_en = s_j1_ctrl_en,
-            i_ctrl_addr = s_j1_ctrl_addr,
-            i_ctrl_wdat = s_j1_ctrl_wdat,
-            i_display_clock = ClockSignal("sys"),
-            o_panel_r0 = s_j1r0,
-            o_panel_g0 = s_j1g0,
-            o_panel_b0 = s_j1b0,
-            o_panel_r1 = s_j1r1,
-            o_panel_g1 = s_j1g1,
-            o_panel_b1 = s_j1b1,
-            o_panel_a = s_j1a,
-            o_panel_b = s_j1b,
-            o_panel_c = s_j1c,
-            o_panel_d = s_j1d,
-            o_panel_e = s_j1e,
-            o_panel_clk = s_j1clk,
-            o_panel_stb = s_j1stb,
-            o_panel_oe = s_j1oe
-        )
-
-        platform.add_extension(_gpios)
-        j1r0 = platform.request("panel_r0", 1);
-        j1g0 = platform.request("panel_g0", 1);
-        j1b0 = platform.request("panel_b0", 1);
-        j1r1 = platform.request("panel_r1", 1);
-        j1g1 = platform.request("panel_g1", 1);
-        j1b1 = platform.request("panel_b1", 1);
-        #j1E = platform.request("panel_e", 1);
-        #j1A = platform.request("panel_a", 1);
-        #j1B = platform.request("panel_b", 1);
-        #j1C = platform.request("panel_c", 1);
-        #j1D = platform.request("panel_d", 1);
-        #j1clk = platform.request("panel_clk", 1);
-        #j1stb = platform.request("panel_stb", 1);
-        #j1oe = platform.request("panel_oe", 1);
-
-        self.comb += j1r0.eq(s_j1r0)
-        self.comb += j1g0.eq(s_j1g0)
-        self.comb += j1b0.eq(s_j1b0)
-        self.comb += j1r1.eq(s_j1r1)
-        self.comb += j1g1.eq(s_j1g1)
-        self.comb += j1b1.eq(s_j1b1)
-        #self.comb += j1A.eq(s_j1a)
-        #self.comb += j1B.eq(s_j1b)
-        #self.comb += j1C.eq(s_j1c)
-        #self.comb += j1D.eq(s_j1d)
-        #self.comb += j1E.eq(s_j1e)
-        #self.comb += j1clk.eq(s_j1clk)
-        #self.comb += j1stb.eq(s_j1stb)
-        #self.comb += j1oe.eq(s_j1oe)
-        self.comb += s_j1_ctrl_en.eq(s_shared_en[3])
-        self.comb += s_j1_ctrl_addr.eq(self.panel_addr.storage)
-        self.comb += s_j1_ctrl_wdat.eq(self.panel_wdat.storage)
+        pads = [panel_pads(platform, j, with_control=(i == 0)) for i, j in enumerate(panel_connectors)]
+        self.panel = LedPanelController(n_ports=len(pads), double_buffer=double_buffer)
+        self.panel.add_panels(platform, pads, chained=panel_chained)
 
         # CRG --------------------------------------------------------------------------------------
         with_rst     = kwargs["uart_name"] not in ["serial", "crossover"] # serial_rx shared with user_btn_n.
@@ -468,8 +325,11 @@ class BaseSoC(SoCCore):
         )
 
         # ROM --------------------------------------------------------------------------------------
-        kwargs["integrated_rom_size"] = 12288
-        if rom is not None:
+        # rom is a firmware image, or the words themselves (see rom_seed).
+        kwargs["integrated_rom_size"] = ROM_SIZE
+        if isinstance(rom, list):
+            kwargs["integrated_rom_init"] = rom
+        elif rom is not None:
             kwargs["integrated_rom_init"] = get_mem_data(rom, endianness="little")
 
         kwargs["integrated_sram_size"] = 8192
@@ -482,6 +342,15 @@ class BaseSoC(SoCCore):
             **kwargs
         )
 
+        # Panel Framebuffer ------------------------------------------------------------------------
+        self.bus.add_slave("panel", self.panel.fb.bus, SoCRegion(
+            origin = 0x90000000,
+            size   = self.panel.fb.size,
+            cached = False,
+        ))
+        # For the firmware's CSR path, which has no window size to go by.
+        self.add_constant("PANEL_PORTS", self.panel.n_ports)
+
         # GPIOs ------------------------------------------------------------------------------------
 
         # SDR SDRAM --------------------------------------------------------------------------------
@@ -517,6 +386,55 @@ class BaseSoC(SoCCore):
             self.add_spi_flash(mode="1x", module=SpiFlashModule(SpiNorFlashOpCodes.READ_1_1_1), with_master=False)
 
 
+# ROM Patching -------------------------------------------------------------------------------------
+
+# A --patchable-rom build fills the ROM with random words instead of the firmware. ecpbram finds the
+# ROM's block RAMs in the placed design by those words and swaps the firmware in, so a firmware change
+# only needs that and ecppack instead of synthesis and place and route.
+
+def rom_seed(size=ROM_SIZE):
+    return [random.getrandbits(32) for _ in range(size // 4)]
+
+def write_rom_init(path, words):
+    with open(path, "w") as f:
+        f.write("".join("{:08x}\n".format(w) for w in words))
+
+def patch_rom(gateware_dir, rom, build_name="colorlight_5a_75b", rom_size=ROM_SIZE):
+    seed = os.path.join(gateware_dir, build_name + "_rom_seed.init")
+    if not os.path.exists(seed):
+        raise OSError("{} not found, build with --patchable-rom first.".format(seed))
+    words = get_mem_data(rom, endianness="little")
+    if len(words) > rom_size // 4:
+        raise ValueError("{} is {} bytes, the ROM only holds {}.".format(rom, 4 * len(words), rom_size))
+    write_rom_init(os.path.join(gateware_dir, build_name + "_rom_patch.init"),
+        words + [0] * (rom_size // 4 - len(words)))
+
+    subprocess.check_call(["ecpbram",
+        "-i", build_name + ".config",
+        "-o", build_name + "_rom.config",
+        "-f", build_name + "_rom_seed.init",
+        "-t", build_name + "_rom_patch.init"], cwd=gateware_dir)
+
+    # Pack the patched design with the build's own ecppack options.
+    with open(os.path.join(gateware_dir, "build_" + build_name + ".sh")) as f:
+        ecppack = next(shlex.split(line) for line in f if line.startswith("ecppack"))
+    ecppack = [build_name + "_rom.config" if arg == build_name + ".config" else arg for arg in ecppack]
+    subprocess.check_call(ecppack, cwd=gateware_dir)
+
+# Flash --------------------------------------------------------------------------------------------
+
+# A named board remembers the image last flashed to it, so the next --flash only rewrites the sectors
+# that changed (see bit_to_flash.flash_svf). Unnamed boards always get a full flash.
+
+def flash_bitstream(prog, gateware_dir, board=None, full=False, cache_dir=bit_to_flash.FLASH_CACHE_DIR):
+    bit_to_flash.flash_svf(
+        bitstream = os.path.join(gateware_dir, "colorlight_5a_75b.bit"),
+        svf       = os.path.join(gateware_dir, "wyrm_flash.svf"),
+        load      = prog.load_bitstream,
+        board     = board,
+        full      = full,
+        cache_dir = cache_dir)
+
 # Build --------------------------------------------------------------------------------------------
 
 def main():
@@ -533,9 +451,24 @@ def main():
     parser.add_target_argument("--sdram-rate",        default="1:1",            help="SDRAM Rate (1:1 Full Rate or 1:2 Half Rate).")
     parser.add_target_argument("--with-spi-flash",    action="store_true",      help="Add SPI flash support to the SoC")
     parser.add_target_argument("--flash",             action="store_true",      help="Flash the code to the target FPGA")
+    parser.add_target_argument("--flash-board",       default=None,             help="Name of the board being flashed. Named boards remember their last image, and the next --flash only rewrites the sectors that changed; unnamed boards always get every sector.")
+    parser.add_target_argument("--flash-full",        action="store_true",      help="Flash every sector, not just the ones that changed since the last flash.")
     parser.add_target_argument("--rom",               default=None,             help="ROM default contents.")
+    parser.add_target_argument("--patchable-rom",     action="store_true",      help="Build with random ROM contents that --patch-rom can swap firmware into later.")
+    parser.add_target_argument("--patch-rom",         action="store_true",      help="Patch the --rom firmware into the last --patchable-rom bitstream without rebuilding the gateware.")
+    parser.add_target_argument("--double-buffer",     action="store_true",      help="Give each panel port a back buffer, shown by the present command (9 EBR per port instead of 6, so at most two ports).")
+    parser.add_target_argument("--panel-connectors",  default="4,3,2,1",        help="Connectors with panels, in panel mask bit order (at most four).")
+    parser.add_target_argument("--panel-chained",     default=1, type=int,      help="Panels daisy-chained on each connector.")
     args = parser.parse_args()
-
+    if args.patch_rom and args.rom is None:
+        parser.error("--patch-rom needs the firmware to patch in as --rom.")
+    panel_connectors = [int(j) for j in args.panel_connectors.split(",")]
+    if len(panel_connectors) > MAX_PANEL_PORTS:
+        parser.error("--panel-connectors takes at most {} connectors, more don't fit in EBR.".format(MAX_PANEL_PORTS))
+    if args.double_buffer and len(panel_connectors) > MAX_DOUBLE_BUFFERED_PORTS:
+        parser.error("--double-buffer fits at most {} panel ports, e.g. --panel-connectors 4,3.".format(MAX_DOUBLE_BUFFERED_PORTS))
+
+    seed = rom_seed() if args.patchable_rom else None
     soc = BaseSoC(revision=args.revision,
         sys_clk_freq     = args.sys_clk_freq,
         toolchain        = args.toolchain,
@@ -546,13 +479,25 @@ def main():
         use_internal_osc = args.use_internal_osc,
         sdram_rate       = args.sdram_rate,
         with_spi_flash   = args.with_spi_flash,
-        rom              = args.rom,
+        rom              = seed if args.patchable_rom else args.rom,
+        double_buffer    = args.double_buffer,
+        panel_connectors = panel_connectors,
+        panel_chained    = args.panel_chained,
         **parser.soc_argdict
     )
     builder = Builder(soc, **parser.builder_argdict)
 
+    gateware_dir = "build/colorlight_5a_75b/gateware"
     if args.build:
         builder.build(**parser.toolchain_argdict)
+        seed_init = os.path.join(gateware_dir, "colorlight_5a_75b_rom_seed.init")
+        if args.patchable_rom:
+            write_rom_init(seed_init, seed)
+        elif os.path.exists(seed_init):
+            os.remove(seed_init)  # The new build can't be patched
+
+    if (args.build and args.patchable_rom and args.rom is not None) or args.patch_rom:
+        patch_rom(gateware_dir, args.rom)
 
     if args.load:
         prog = soc.platform.create_programmer()
@@ -560,9 +505,7 @@ def main():
 
     if args.flash:
         prog = soc.platform.create_programmer()
-        os.system("cp bit_to_flash.py build/colorlight_5a_75b/gateware/")
-        os.system("cd build/colorlight_5a_75b/gateware/ && ./bit_to_flash.py colorlight_5a_75b.bit wyrm_flash.svf")
-        prog.load_bitstream("build/colorlight_5a_75b/gateware/wyrm_flash.svf")
+        flash_bitstream(prog, gateware_dir, args.flash_board, args.flash_full)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,339 @@
+#!/bin/python3
+# Software stand-in for the Wyrm board's receive path
+#
+# Listens on a local UDP port and decodes packets exactly the way udp_cb in
+# software/main.c does: byte 0 is the panel enable mask, byte 1 the opcode,
+# then either 32-bit big-endian words of (addr << 18) | 18 bits of color, or
+# a start address and a packed run of colors (see panel_encoder.py). Each set
+# mask bit writes the color into that ledpanel instance's video memories,
+# which we keep here as 4096-entry arrays per channel like ledpanel.v does,
+# one set per panel port (four, like wyrm.py's default, unless --panels says
+# otherwise). With --double-buffer, writes go to a second set of arrays instead
+# and an OP_PRESENT packet swaps the two for the masked panels, the way a
+# board built with wyrm.py --double-buffer does (minus waiting for the scan).
+#
+# Point a sender at it with --ip 127.0.0.1 --port <port> to benchmark it or
+# check what it draws without any hardware.
+#
+# Usage: ./wyrm_emu.py [--port 1234] [--panels 4] [--dump-dir out/] [--dump-every 5] [--double-buffer]
+import argparse
+import json
+import os
+import socket
+import time
+import numpy as np
+
+from panel_encoder import (PANEL_SIZE, HEADER_SIZE, MASK_BITS, PACKED_HEADER_SIZE, PACKED_LAYOUTS,
+                           PALETTE_HEADER_SIZE, RGB_ORDER, OP_ADDRESSED, OP_RUNS, OP_PALETTE,
+                           OP_PRESENT)
+
+# Panel ports BaseSoC builds by default
+NUM_PANELS = 4
+VIDEO_MEM_SIZE = PANEL_SIZE * PANEL_SIZE
+# A frame is considered over once nothing has arrived for this long
+FRAME_GAP = 0.005
+
+
+def decode_words(data):
+    """Split a packet into (mask, addresses, (c0, c1, c2)) like udp_cb does.
+
+    c0/c1/c2 are the three 6-bit wire fields, high to low; udp_cb writes
+    them to video_mem_r, video_mem_g and video_mem_b respectively. Returns
+    None for packets too short to carry a header.
+    """
+    if len(data) < HEADER_SIZE:
+        return None
+    n_words = (len(data) - HEADER_SIZE) // 4
+    words = np.frombuffer(data, dtype='>u4', count=n_words, offset=HEADER_SIZE)
+    return (data[0], words >> 18,
+            ((words >> 12) & 0x3F, (words >> 6) & 0x3F, words & 0x3F))
+
+
+def unpack_bits(payload, bits):
+    """Read an MSB-first stream of bits-wide values, ignoring any trailing
+    partial value. Deliberately the slow obvious way, to check the encoder's
+    packing against."""
+    stream = np.unpackbits(np.frombuffer(payload, dtype=np.uint8))
+    n = len(stream) // bits
+    weights = (1 << np.arange(bits - 1, -1, -1)).astype(np.uint32)
+    return stream[:n * bits].reshape(n, bits).astype(np.uint32) @ weights
+
+
+def group_bytes(depth):
+    """Bytes in the smallest whole group of packed pixels, which is all udp_cb decodes."""
+    return 3 * depth // int(np.gcd(3 * depth, 8))
+
+
+def widen(values, depth):
+    """Widen depth-bit fields to the panel's 6 bits by repeating the top bits."""
+    return (values << (6 - depth)) | (values >> (2 * depth - 6))
+
+
+def split_colors(colors):
+    return ((colors >> 12) & 0x3F, (colors >> 6) & 0x3F, colors & 0x3F)
+
+
+def decode_runs(data):
+    n_words = (len(data) - PACKED_HEADER_SIZE) // 4
+    words = np.frombuffer(data, dtype='>u4', count=n_words, offset=PACKED_HEADER_SIZE)
+    return np.repeat(words & 0x3FFFF, (words >> 18) + 1).astype(np.uint32)
+
+
+def decode_palette(data):
+    """The colors of a palette packet, or None if udp_cb would drop it."""
+    if len(data) < PALETTE_HEADER_SIZE:
+        return None
+    bits, n_colors = data[PACKED_HEADER_SIZE], data[PACKED_HEADER_SIZE + 1] + 1
+    end = PALETTE_HEADER_SIZE + 3 * n_colors
+    if bits not in (1, 2, 4, 8) or end > len(data):
+        return None
+    entries = np.frombuffer(data, dtype=np.uint8, count=3 * n_colors,
+                            offset=PALETTE_HEADER_SIZE).reshape(-1, 3).astype(np.uint32)
+    palette = (entries[:, 0] << 16) | (entries[:, 1] << 8) | entries[:, 2]
+    index = unpack_bits(data[end:], bits)
+    # udp_cb would pick up stale palette entries for these
+    if len(index) and index.max() >= n_colors:
+        return None
+    return palette[index]
+
+
+def decode_packet(data):
+    """Like decode_words, for any opcode. Returns None for packets udp_cb
+    would ignore (too short or an opcode it doesn't know)."""
+    if len(data) < HEADER_SIZE:
+        return None
+    if data[1] == OP_ADDRESSED:
+        return decode_words(data)
+    if data[1] in (OP_RUNS, OP_PALETTE):
+        if len(data) < PACKED_HEADER_SIZE:
+            return None
+        colors = decode_runs(data) if data[1] == OP_RUNS else decode_palette(data)
+        if colors is None:
+            return None
+        start = (data[2] << 8) | data[3]
+        return (data[0], start + np.arange(len(colors), dtype=np.uint32), split_colors(colors))
+    if data[1] in PACKED_LAYOUTS:
+        if len(data) < PACKED_HEADER_SIZE:
+            return None
+        depth = PACKED_LAYOUTS[data[1]][0]
+        payload = data[PACKED_HEADER_SIZE:]
+        colors = unpack_bits(payload[:len(payload) - len(payload) % group_bytes(depth)], 3 * depth)
+        start = (data[2] << 8) | data[3]
+        addr = start + np.arange(len(colors), dtype=np.uint32)
+        top = (1 << depth) - 1
+        return (data[0], addr, tuple(widen((colors >> (field * depth)) & top, depth)
+                                     for field in (2, 1, 0)))
+    return None
+
+
+def is_malformed(data):
+    """Whether udp_cb would have to ignore part or all of the packet."""
+    if len(data) < HEADER_SIZE:
+        return True
+    if data[1] == OP_ADDRESSED:
+        return (len(data) - HEADER_SIZE) % 4 != 0
+    if data[1] in PACKED_LAYOUTS:
+        group = group_bytes(PACKED_LAYOUTS[data[1]][0])
+        return len(data) < PACKED_HEADER_SIZE or (len(data) - PACKED_HEADER_SIZE) % group != 0
+    if data[1] == OP_RUNS:
+        return len(data) < PACKED_HEADER_SIZE or (len(data) - PACKED_HEADER_SIZE) % 4 != 0
+    if data[1] == OP_PALETTE:
+        return decode_palette(data) is None
+    if data[1] == OP_PRESENT:
+        return len(data) != HEADER_SIZE
+    return True
+
+
+class WyrmEmulator:
+    """One ledpanel instance's video memories per panel port, plus receive
+    statistics.
+
+    video_mem is what the panels show; with double_buffer, back_mem is what
+    gets written until the next present.
+    """
+
+    def __init__(self, clock=time.monotonic, double_buffer=False, panels=NUM_PANELS):
+        if not 1 <= panels <= MASK_BITS:
+            raise ValueError("panels must be 1-%d, got %d" % (MASK_BITS, panels))
+        self._clock = clock
+        self.panels = panels
+        # [panel][channel][address], channel 0/1/2 = video_mem_r/g/b
+        self.video_mem = np.zeros((panels, 3, VIDEO_MEM_SIZE), dtype=np.uint8)
+        self.back_mem = np.zeros_like(self.video_mem) if double_buffer else None
+        self.presents = 0
+        self.packets = 0
+        self.bytes = 0
+        self.malformed = 0
+        self.out_of_range = 0
+
+        # Which pixels the current frame has touched, per panel
+        self._written = np.zeros((panels, VIDEO_MEM_SIZE), dtype=bool)
+        self._frame_packets = 0
+        self._last_packet = None
+        self.frames = []
+
+    def handle_packet(self, data):
+        now = self._clock()
+        if self._last_packet is not None and now - self._last_packet > FRAME_GAP:
+            self.end_frame()
+        self._last_packet = now
+
+        self.packets += 1
+        self.bytes += len(data)
+        if is_malformed(data):
+            self.malformed += 1
+        if len(data) >= HEADER_SIZE and data[1] == OP_PRESENT:
+            self.present(data[0])
+            return
+        decoded = decode_packet(data)
+        if decoded is None:
+            return
+        mask, addr, fields = decoded
+
+        # ctrl_addr is 16 bits wide but each memory only has 4096 entries;
+        # writes past the end go nowhere
+        valid = addr < VIDEO_MEM_SIZE
+        if not valid.all():
+            self.out_of_range += int((~valid).sum())
+            addr = addr[valid]
+            fields = [f[valid] for f in fields]
+
+        mem = self.video_mem if self.back_mem is None else self.back_mem
+        for panel in range(self.panels):
+            if mask & (1 << panel):
+                # Later words win for repeated addresses, same as the CSR writes
+                for channel, values in enumerate(fields):
+                    mem[panel, channel, addr] = values
+                self._written[panel, addr] = True
+        self._frame_packets += 1
+
+    def present(self, mask):
+        """Swap the front and back buffers of the masked panels."""
+        self.presents += 1
+        if self.back_mem is None:
+            return
+        for panel in range(self.panels):
+            if mask & (1 << panel):
+                front = self.video_mem[panel].copy()
+                self.video_mem[panel] = self.back_mem[panel]
+                self.back_mem[panel] = front
+        # Whatever was drawn before it is one frame
+        self.end_frame()
+
+    def end_frame(self):
+        if not self._frame_packets:
+            return
+        touched = self._written.any(axis=1)
+        self.frames.append({
+            "packets": self._frame_packets,
+            "panels": [int(p) for p in np.flatnonzero(touched)],
+            # Fraction of each touched panel's pixels this frame wrote
+            "completeness": [float(self._written[p].mean()) for p in np.flatnonzero(touched)],
+        })
+        self._written[...] = False
+        self._frame_packets = 0
+
+    def stats(self):
+        return {
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "malformed": self.malformed,
+            "out_of_range": self.out_of_range,
+            "presents": self.presents,
+            "frames": len(self.frames),
+            "complete_frames": sum(1 for f in self.frames
+                                   if f["completeness"] and min(f["completeness"]) == 1.0),
+        }
+
+    def panel_image(self, panel):
+        """The panel's video memory as a 64x64x3 RGB array in the sender's
+        channel order, so it can be compared against the frame that was sent."""
+        fields = self.video_mem[panel].reshape(3, PANEL_SIZE, PANEL_SIZE)
+        image = np.zeros((PANEL_SIZE, PANEL_SIZE, 3), dtype=np.uint8)
+        for field, channel in enumerate(RGB_ORDER):
+            image[:, :, channel] = fields[field] << 2
+        return image
+
+    def canvas_image(self, segments_x=2):
+        """All panels tiled row-major, panel i at segment i (the 128x128 layout).
+        A short last row is filled out with black."""
+        blank = np.zeros((PANEL_SIZE, PANEL_SIZE, 3), dtype=np.uint8)
+        rows = []
+        for y in range(0, self.panels, segments_x):
+            rows.append(np.hstack([self.panel_image(p) if p < self.panels else blank
+                                   for p in range(y, y + segments_x)]))
+        return np.vstack(rows)
+
+    def dump(self, directory):
+        from PIL import Image
+        os.makedirs(directory, exist_ok=True)
+        for panel in range(self.panels):
+            Image.fromarray(self.panel_image(panel)).save(
+                os.path.join(directory, "panel%d.png" % panel))
+        Image.fromarray(self.canvas_image()).save(os.path.join(directory, "canvas.png"))
+
+
+def serve(emu, port, report_every=1.0, dump_dir=None, dump_every=None, duration=None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    s.bind(("0.0.0.0", port))
+    s.settimeout(FRAME_GAP)
+    buf = bytearray(65536)
+    view = memoryview(buf)
+
+    start = last_report = last_dump = time.monotonic()
+    last_packets, last_bytes = 0, 0
+    try:
+        while duration is None or time.monotonic() - start < duration:
+            try:
+                n = s.recv_into(buf)
+                emu.handle_packet(bytes(view[:n]))
+            except socket.timeout:
+                emu.end_frame()
+
+            now = time.monotonic()
+            if now - last_report >= report_every:
+                stats = emu.stats()
+                elapsed = now - last_report
+                stats["packets_per_s"] = (stats["packets"] - last_packets) / elapsed
+                stats["bytes_per_s"] = (stats["bytes"] - last_bytes) / elapsed
+                print(json.dumps(stats), flush=True)
+                last_packets, last_bytes = stats["packets"], stats["bytes"]
+                last_report = now
+            if dump_dir is not None and dump_every and now - last_dump >= dump_every:
+                emu.dump(dump_dir)
+                last_dump = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
+        emu.end_frame()
+        if dump_dir is not None:
+            emu.dump(dump_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the Wyrm board's UDP panel receiver.")
+    parser.add_argument("--port", default=1234, type=int, help="UDP port to listen on.")
+    parser.add_argument("--report-every", default=1.0, type=float,
+                        help="Seconds between JSON statistics lines.")
+    parser.add_argument("--dump-dir", default=None, help="Write panel PNGs here on exit.")
+    parser.add_argument("--dump-every", default=None, type=float,
+                        help="Also write the PNGs every this many seconds.")
+    parser.add_argument("--duration", default=None, type=float, help="Stop after this many seconds.")
+    parser.add_argument("--double-buffer", action="store_true",
+                        help="Draw into a back buffer that OP_PRESENT packets swap in.")
+    parser.add_argument("--panels", default=NUM_PANELS, type=int,
+                        help="Panel ports to emulate, like the number of wyrm.py --panel-connectors "
+                             "(up to %d, one per mask bit)." % MASK_BITS)
+    args = parser.parse_args()
+    if not 1 <= args.panels <= MASK_BITS:
+        parser.error("--panels must be 1-%d" % MASK_BITS)
+
+    emu = WyrmEmulator(double_buffer=args.double_buffer, panels=args.panels)
+    serve(emu, args.port, args.report_every, args.dump_dir, args.dump_every,
+          args.duration)
+
+
+if __name__ == "__main__":
+    main()